@@ -0,0 +1,138 @@
+# micro benchmarks, usage: python bench.py <name> [args...]
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter, sleep
+from src.fstree import FileTree
+from src.appinfo import SteamAppInfo
+from src.store import JsonAppInfoStore
+
+benchmarks = dict()
+
+def benchmark(fn):
+  benchmarks[fn.__name__[len('bench_'):]] = fn
+  return fn
+
+def timeit(fn, repeat=3):
+  best = None
+  for _ in range(repeat):
+    t0 = perf_counter()
+    r = fn()
+    dt = perf_counter() - t0
+    best = dt if best is None else min(best, dt)
+  return best, r
+
+def make_tree(root, depth, fanout, files):
+  if depth == 0:
+    return
+  for i in range(files):
+    with open(os.path.join(root, 'f{}.txt'.format(i)), 'wb') as fh:
+      fh.write(b'x' * i)
+  for i in range(fanout):
+    d = os.path.join(root, 'd{}'.format(i))
+    os.mkdir(d)
+    make_tree(d, depth - 1, fanout, files)
+
+@benchmark
+def bench_scan(depth='5', fanout='4', files='8', workers='8', latency_ms='0'):
+  # sequential vs parallel FileTree.scan_dir on a synthetic deep tree,
+  # latency_ms adds a sleep per directory listing to mimic a network mount
+  depth, fanout, files, workers, latency = int(depth), int(fanout), int(files), int(workers), float(latency_ms) / 1000
+
+  class SlowFileTree(FileTree):
+    @classmethod
+    def list_dir(cls, path):
+      sleep(latency)
+      return super().list_dir(path)
+
+  tree_cls = SlowFileTree if latency > 0 else FileTree
+  root = tempfile.mkdtemp()
+  try:
+    make_tree(root, depth, fanout, files)
+    t_seq, r_seq = timeit(lambda: list(tree_cls.scan_dir(root)))
+    t_par, r_par = timeit(lambda: list(tree_cls.scan_dir(root, workers=workers)))
+    print('entries          : {}'.format(len(r_seq)))
+    print('sequential       : {:.04f}s'.format(t_seq))
+    print('parallel ({:>3d})   : {:.04f}s'.format(workers, t_par))
+    print('same order       : {}'.format(r_seq == r_par))
+  finally:
+    shutil.rmtree(root)
+
+@benchmark
+def bench_tree(entries='100000', fanout='20'):
+  # FileTree -> Node build and streamed repr_tree of a synthetic tree
+  entries, fanout = int(entries), int(fanout)
+  tree = FileTree(FileTree.ModeEnum.folder)
+  tree.root = '/srv'
+  for i in range(entries):
+    path = '/srv/d{}/s{}/f{}.txt'.format(i % fanout, i % (fanout * 7), i)
+    tree.list.append(FileTree.t_scan_info(False, path, i, 0))
+  t_build, root = timeit(lambda: tree.to_node(), repeat=1)
+  t_repr, lines = timeit(lambda: sum(1 for _ in root.iter_repr_tree()), repeat=1)
+  t_limit, limited = timeit(lambda: sum(1 for _ in root.iter_repr_tree(stop_at_depth=2)), repeat=1)
+  print('entries          : {}'.format(entries))
+  print('build            : {:.04f}s'.format(t_build))
+  print('repr_tree        : {:.04f}s ({} lines)'.format(t_repr, lines))
+  print('repr_tree depth 2: {:.04f}s ({} lines)'.format(t_limit, limited))
+
+def make_appinfo(addons, plugins):
+  return {
+    'config': {'name': 'bench', 'appId': '550', 'appIdDedicatedServer': '222860', 'baseDir': 'srv', 'workshopDir': 'srv/workshop'},
+    'plugins': [{
+      'name': 'plugin {}'.format(i), 'exclude': False, 'rel': '',
+      'resources': [{
+        'name': 'resource {}'.format(j), 'exclude': False, 'platform': '*', 'rel': '', 'targetPath': 'left4dead2',
+        'url': 'https://example.com/plugin{}/resource{}.zip'.format(i, j),
+      } for j in range(3)],
+    } for i in range(plugins)],
+    'addons': [{
+      'name': 'addon {}'.format(i), 'exclude': i % 10 == 0,
+      'url': 'https://steamcommunity.com/sharedfiles/filedetails/?id={}'.format(100000000 + i),
+    } for i in range(addons)],
+  }
+
+@benchmark
+def bench_appinfo(addons='50000', plugins='100'):
+  # SteamAppInfo.from_dict/to_dict time and retained model memory
+  d = make_appinfo(int(addons), int(plugins))
+  t_load, _ = timeit(lambda: SteamAppInfo().from_dict(d))
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  appinfo = SteamAppInfo().from_dict(d)
+  size = tracemalloc.get_traced_memory()[0] - base
+  tracemalloc.stop()
+  t_dump, _ = timeit(lambda: appinfo.to_dict())
+  print('addons           : {}'.format(len(appinfo.addons)))
+  print('plugins          : {}'.format(len(appinfo.plugins)))
+  print('from_dict        : {:.04f}s'.format(t_load))
+  print('to_dict          : {:.04f}s'.format(t_dump))
+  print('model memory     : {:.02f} MB'.format(size / 1024**2))
+
+@benchmark
+def bench_load(addons='50000', plugins='100'):
+  # appinfo startup from json vs from the binary snapshot next to it
+  root = tempfile.mkdtemp()
+  try:
+    path = os.path.join(root, 'appinfo.json')
+    JsonAppInfoStore.write_json(path, make_appinfo(int(addons), int(plugins)))
+    def load():
+      for name in os.listdir(root):
+        if name.endswith('.snapshot'):
+          os.unlink(os.path.join(root, name))
+      return JsonAppInfoStore(path).load(SteamAppInfo())
+    t_json, source_json = timeit(load)
+    t_snap, source_snap = timeit(lambda: JsonAppInfoStore(path).load(SteamAppInfo()))
+    print('json size        : {:.02f} MB'.format(os.path.getsize(path) / 1024**2))
+    print('snapshot size    : {:.02f} MB'.format(os.path.getsize(path + '.snapshot') / 1024**2))
+    print('load {:<11} : {:.04f}s (includes writing the snapshot)'.format(source_json, t_json))
+    print('load {:<11} : {:.04f}s'.format(source_snap, t_snap))
+  finally:
+    shutil.rmtree(root)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2 or not sys.argv[1] in benchmarks:
+    print('usage: python bench.py <{}> [args...]'.format('|'.join(benchmarks)))
+    sys.exit(1)
+  benchmarks[sys.argv[1]](*sys.argv[2:])
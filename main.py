@@ -1,10 +1,35 @@
+import os
+import sys
+import signal
 import traceback
+from functools import partial
+from contextlib import contextmanager
+from threading import Thread, RLock, Lock
+from hashlib import sha1
+from time import time, perf_counter
 from collections import namedtuple
 from requests import Session
 from src.argroute import ArgRoute
 from src.config import Config
 from src.appinfo import SteamAppInfo, sSteamAppInfoEntAddon, sSteamAppInfoEntPlugin, sSteamAppInfoEntResource
 from src.utils import PathUtils, HTTPUtils
+from src.staging import StagedTree
+from src.cache import ExtractCache
+from src.planner import InstallPlanner
+from src.fstree import FileTree
+from src.hashcache import HashCache
+from src.dedupe import Deduper
+from src.watcher import Inotify, LiveFileTree
+from src.vpk import VpkConflictIndex
+from src.spcomp import SourcePawnCompiler
+from src.journal import InstallJournal
+from src.autosave import AppInfoSaver
+from src.store import open_store, JsonAppInfoStore
+from src.lockfile import AppInfoLock
+from src.fleet import FleetDeploy
+from src.pipeline import StagePipeline
+from src.jobs import Job, JobManager, job_local, current_job, checkpoint
+from src.daemon import ControlServer, default_socket
 
 def fetch_argv():
   try:
@@ -16,57 +41,126 @@ def fetch_argv():
 class Main:
   config_file = './conf.ini'
   download_dir = './download'
+  cache_dir = './cache'
+  index_dir = './index'
+  compile_cache_dir = './cache/smx'
+  journal_file = './index/journal.json'
+  socket_file = default_socket
+  page_size = 100
+  # install pipeline, threads per stage and jobs queued between two stages.
+  # placing is ordered, a later resource overwrites an earlier one
+  stage_workers = {'download': 4, 'verify': 2, 'extract': 2, 'place': 1}
+  stage_queue_size = 8
   working_dir = PathUtils.dirname(__file__)
+  # a background job works on its own copy of these, see start_job
+  appinfo = job_local()
+  session = job_local()
+  journal = job_local()
+  lockfile = job_local()
 
   def __init__(self):
     self.loop = True
     self.router = ArgRoute(self)
     self.config = Config()
     self.appinfo = SteamAppInfo()
+    # held while a command runs, the background saver reads the model under it
+    self.appinfo_lock = RLock()
+    self.saver = AppInfoSaver(self.appinfo, self.appinfo_lock)
+    self.store = None
     self.session = Session()
     self.stack = list()
+    self.extract_cache = None
+    self.hash_cache = HashCache()
+    self.journal = InstallJournal(self.journal_file)
+    # loaded by use_lock for install --locked and --offline
+    self.lockfile = None
+    self.live_trees = dict()
+    # install stages run on several threads, each message is printed whole
+    self.print_lock = Lock()
+    # one install at a time writes the journal and the download dir
+    self.install_lock = Lock()
+    self.jobs = JobManager()
+    # commands from argv or a script, see run_batch
+    self.batch = False
+    self.assume_yes = False
+    # the daemon runs one long command at a time, see serve_command
+    self.control_server = None
+    self.clients = set()
+    self.task_lock = Lock()
     
     temp_dir, temp_dir_destructor = PathUtils.mkdtemp()
     self.temp_dir = temp_dir
     self._temp_dir_destroy = temp_dir_destructor
 
-  @staticmethod
-  def confirm():
+  def confirm(self):
+    # background jobs and daemon clients have no prompt, they pass --yes
+    job = current_job()
+    if self.assume_yes or 'yes' in self.router.flags or (not job is None and job.assume_yes):
+      print('rsrcman >> Continue? [Y/n] Y')
+      return True
+    if self.batch or not job is None:
+      self.router.root.print_err('confirmation needed, run with --yes')
+      return False
     ret = input('rsrcman >> Continue? [Y/n] ') == 'Y'
     print()
     return ret
 
   @staticmethod
-  def filter_fields(d):
-    return [i for i in d.keys() if not (i.startswith('_') or i.endswith('_')) and not isinstance(d[i], (tuple, list))]
+  def filter_fields(d, list_fields=()):
+    return [i for i in d.keys() if not (i.startswith('_') or i.endswith('_')) and (i in list_fields or not isinstance(d[i], (tuple, list)))]
+
+  @staticmethod
+  def repr_field(value):
+    if isinstance(value, (tuple, list)):
+      return ', '.join(value)
+    return value
 
   @classmethod
   def print_fields(cls, ent):
     d = ent.to_dict()
-    fields = cls.filter_fields(d)
+    fields = cls.filter_fields(d, ent.list_fields)
     print()
     print('current values:')
     for field in fields:
-      print('  {} : {}'.format(field, d.get(field)))
+      print('  {} : {}'.format(field, cls.repr_field(d.get(field))))
     print()
 
   @classmethod
   def resolve_path(cls, path):
     return PathUtils.join(cls.working_dir, path)
 
-  @classmethod
-  def stdin_form_ent(cls, ent):
+  def stdin_form_ent(self, ent):
+    # True once the form is applied to ent
     d = ent.to_dict()
-    fields = cls.filter_fields(d)
-    cls.print_fields(ent)
-    for field in fields:
-      value = input('rsrcman >> {} : '.format(field))
-      if value:
+    fields = self.filter_fields(d, ent.list_fields)
+    values = self.router.values
+    unknown = [i for i in values if not i in fields]
+    if len(unknown) > 0:
+      self.router.root.print_err('unknown fields: {}, expected {}'.format(', '.join(unknown), ', '.join(fields)))
+      return False
+    self.print_fields(ent)
+    if len(values) > 0 or self.batch:
+      # key=value args given with the command replace the prompts
+      for field, value in values.items():
+        if field in ent.list_fields and value == '-':
+          value = []
         d[field] = value
+    else:
+      for field in fields:
+        if field in ent.list_fields:
+          value = input('rsrcman >> {} (comma separated, - to clear) : '.format(field))
+          if value == '-':
+            value = []
+        else:
+          value = input('rsrcman >> {} : '.format(field))
+        if value or isinstance(value, list):
+          d[field] = value
     for field, value in d.items():
       print('  {}: {}'.format(field, value))
-    if cls.confirm():
-      ent.from_dict(d)
+    if not self.confirm():
+      return False
+    ent.from_dict(d)
+    return True
 
   @staticmethod
   def eval_index(ns):
@@ -81,6 +175,16 @@ class Main:
   def clear_temp_dir(self):
     PathUtils.rmtree_d(self.temp_dir)
 
+  @contextmanager
+  def exclusive_install(self):
+    if not self.install_lock.acquire(blocking=False):
+      print('waiting for the running install to finish')
+      self.install_lock.acquire()
+    try:
+      yield
+    finally:
+      self.install_lock.release()
+
   def h_exit(self, ns):
     self.loop = False
     return
@@ -91,20 +195,67 @@ class Main:
     return
 
   def h_configure_appinfo(self, ns):
+    info_file = self.config.info_file
     self.config.info_file = ns.filepath
+    try:
+      store = open_store(self.config.info_file)
+    except Exception as e:
+      ns.node_.print_err('cannot open appinfo {}: {}'.format(self.config.info_file, e))
+      self.config.info_file = info_file
+      return
+    if not self.store is None:
+      self.store.close()
+    self.store = self.saver.store = store
+    # the whole model goes to the new file
+    self.appinfo.touch_all()
     self.h_edit_config(None)
 
+  def h_import(self, ns):
+    print('replacing appinfo with {}'.format(ns.filepath))
+    if not self.confirm():
+      return
+    try:
+      JsonAppInfoStore(ns.filepath, use_snapshot=False).load(self.appinfo)
+    except (OSError, ValueError) as e:
+      ns.node_.print_err('cannot import {}: {}'.format(ns.filepath, e))
+      return
+    print('imported {} plugins, {} addons'.format(len(self.appinfo.plugins), len(self.appinfo.addons)))
+
+  def h_export(self, ns):
+    JsonAppInfoStore.write_json(ns.filepath, self.appinfo.to_dict())
+    print('exported {} plugins, {} addons to {}'.format(len(self.appinfo.plugins), len(self.appinfo.addons), ns.filepath))
+
   def h_configure_platform(self, ns):
     self.config.platform = ns.value
 
-  def print_addons(self, addons, exclude_excluded=False):
-    for n, ent in enumerate(addons):
+  def h_configure_scanworkers(self, ns):
+    if not ns.value.isnumeric() or int(ns.value) < 1:
+      ns.node_.print_err('arg should be a positive number: {}'.format(ns.value))
+      return
+    self.config.scan_workers = ns.value
+
+  def h_configure_hashworkers(self, ns):
+    if not ns.value.isnumeric() or int(ns.value) < 1:
+      ns.node_.print_err('arg should be a positive number: {}'.format(ns.value))
+      return
+    self.config.hash_workers = ns.value
+
+  def h_configure_cachesize(self, ns):
+    if not ns.value.isnumeric():
+      ns.node_.print_err('arg should be numeric: {}'.format(ns.value))
+      return
+    self.config.cache_size = ns.value
+    self.extract_cache.max_bytes = self.config.cache_size * 1024 * 1024
+    self.extract_cache.evict()
+
+  def print_addons(self, addons, exclude_excluded=False, entries=None):
+    for n, ent in enumerate(addons) if entries is None else entries:
       if exclude_excluded and ent.exclude:
         continue
       print('{:>02d}    | - [{}] {}'.format(n, ' ' if ent.exclude else 'x', ent.name))
 
-  def print_plugins(self, plugins, exclude_excluded=False, with_resources=True):
-    for n, ent in enumerate(plugins):
+  def print_plugins(self, plugins, exclude_excluded=False, with_resources=True, entries=None):
+    for n, ent in enumerate(plugins) if entries is None else entries:
       if exclude_excluded and ent.exclude:
         continue
       print('{:>02d}    | - [{}] {}'.format(n, ' ' if ent.exclude else 'x', ent.name))
@@ -117,14 +268,57 @@ class Main:
               continue
           print('{:>02d} {:>02d} |   - [{}] ({}) {}'.format(n, m, ' ' if rsc.exclude else 'x', rsc.platform, rsc.url))
 
+  def query_entries(self, kind, query, node):
+    # (position, entity) pairs of the requested --page, None on a bad query.
+    # a plain listing is paged only when --page or --limit asks for it
+    try:
+      entries = self.appinfo.find(kind, query)
+    except ValueError as e:
+      node.print_err(str(e))
+      return None
+    if not query and self.router.flag_value('page') is None and self.router.flag_value('limit') is None:
+      return entries
+    page = self.router.flag_value('page', '1')
+    limit = self.router.flag_value('limit', str(self.page_size))
+    if not page.isnumeric() or not limit.isnumeric() or int(page) < 1 or int(limit) < 1:
+      node.print_err('--page and --limit should be positive numbers')
+      return None
+    page, limit = int(page), int(limit)
+    n_pages = max(1, (len(entries) + limit - 1) // limit)
+    start = (page - 1) * limit
+    if len(entries) > limit:
+      print('page {}/{}, {} matches, entries {}-{}'.format(page, n_pages, len(entries), start, min(start + limit, len(entries)) - 1))
+    return entries[start:start + limit]
+
   def h_list_addons(self, ns):
+    entries = self.query_entries('addons', self.router.flag_value('where', ''), self.router.root)
+    if entries is None:
+      return
     print('available addons:')
-    self.print_addons(self.appinfo.addons)
+    self.print_addons(self.appinfo.addons, entries=entries)
     print()
 
   def h_list_plugins(self, ns):
+    entries = self.query_entries('plugins', self.router.flag_value('where', ''), self.router.root)
+    if entries is None:
+      return
     print('available plugins:')
-    self.print_plugins(self.appinfo.plugins)
+    self.print_plugins(self.appinfo.plugins, entries=entries)
+    print()
+
+  def h_find_addons(self, ns):
+    entries = self.query_entries('addons', ns.value, ns.node_)
+    if entries is None:
+      return
+    for n, ent in entries:
+      print('{:>02d}    | - [{}] {} ({})'.format(n, ' ' if ent.exclude else 'x', ent.name, ent.url))
+    print()
+
+  def h_find_plugins(self, ns):
+    entries = self.query_entries('plugins', ns.value, ns.node_)
+    if entries is None:
+      return
+    self.print_plugins(self.appinfo.plugins, entries=entries)
     print()
 
   def h_new_addon(self, ns):
@@ -132,8 +326,8 @@ class Main:
     if index is None:
       return
     addon = sSteamAppInfoEntAddon()
-    self.stdin_form_ent(addon)
-    self.appinfo.addons.append(addon)
+    if self.stdin_form_ent(addon):
+      self.appinfo.addons.append(addon)
 
   def h_new_plugin(self, ns):
     index = self.eval_index(ns)
@@ -141,8 +335,8 @@ class Main:
       return
     if index >= len(self.appinfo.plugins) or index < 0:
       plugin = sSteamAppInfoEntPlugin()
-      self.stdin_form_ent(plugin)
-      self.appinfo.plugins.append(plugin)
+      if self.stdin_form_ent(plugin):
+        self.appinfo.plugins.append(plugin)
     else:
       plugin = self.appinfo.plugins[index]
       self.stack.append(plugin)
@@ -155,8 +349,8 @@ class Main:
     plugin = self.stack.pop(0)
     if index >= len(plugin.resources) or index < 0:
       resource = sSteamAppInfoEntResource()
-      self.stdin_form_ent(resource)
-      plugin.resources.append(resource)
+      if self.stdin_form_ent(resource):
+        plugin.resources.append(resource)
     else:
       resource = plugin.resources[index]
       self.stdin_form_ent(resource)
@@ -195,6 +389,7 @@ class Main:
       ns.node_.print_err('index out of bound: {}'.format(index))
       return
     resource = plugin.resources[index]
+    self.stdin_form_ent(resource)
 
   def h_view_config(self, ns):
     self.print_fields(self.appinfo.config)
@@ -271,35 +466,448 @@ class Main:
     print('installation dir : {}'.format(self.appinfo.config.base_dir))
     print('workshop dir     : {}'.format(self.appinfo.config.workshop_dir))
 
-  def auto_download_file(self, url, target_path):
-    status, download_path, file_info = HTTPUtils.download_file(self.session, url, self.download_dir)
-    if not status and not download_path is None:
-      print('destroying unfinished file')
-      PathUtils.delete_file(download_path)
-      return
+  @staticmethod
+  def archive_type(file_info):
     if file_info.content_type == 'application/zip' or file_info.file_type == 'zip':
-      print('extracting zip: {}'.format(file_info.file_name))
-      PathUtils.archive_extract_zip(download_path, target_path, self.temp_dir)
+      return 'zip'
     elif file_info.content_type == 'application/x-xz' or file_info.file_type.startswith('tar'):
-      print('extracting {}: {}'.format(file_info.file_type, file_info.file_name))
-      PathUtils.archive_extract_tar(download_path, target_path, self.temp_dir)
-    else:
-      print('copying file: {}'.format(file_info.file_name))
-      PathUtils.copy2(download_path, PathUtils.join(target_path, file_info.file_name))
-    self.clear_temp_dir()
+      return 'tar'
+    return None
+
+  def is_resource_selected(self, resource, platform=None):
+    if resource.exclude:
+      return False
+    platform = platform or self.config.platform
+    return resource.platform == '*' or resource.platform == platform
+
+  @staticmethod
+  def cache_variant(include=None, exclude=None):
+    if include or exclude:
+      return repr((sorted(include or []), sorted(exclude or [])))
+    return None
+
+  def extract_to_cache(self, archive_path, unpack, include=None, exclude=None, pin=False):
+    unpack = partial(unpack, archive_path, include=include, exclude=exclude)
+    digest, _ = self.extract_cache.fetch(archive_path, unpack, variant=self.cache_variant(include, exclude), pin=pin)
+    return digest
+
+  def archive_ok(self, archive_path, archive_type, include=None, exclude=None):
+    # reading the whole archive is only needed when it gets unpacked, a tree
+    # already cached for this digest was unpacked from the very same bytes
+    if archive_type is None:
+      return True
+    if not self.extract_cache.get(self.extract_cache.entry_digest(archive_path, self.cache_variant(include, exclude))) is None:
+      return True
+    return PathUtils.archive_check(archive_path, archive_type)
+
+  def fetch_download(self, key, url):
+    if not self.lockfile is None:
+      return self.fetch_locked(self.lockfile.get(key)['files'][0])
+    status, download_path, file_info = HTTPUtils.download_file(self.session, url, self.download_dir)
+    if not status:
+      return None, None
+    return download_path, file_info
+
+  def locked_path(self, file_entry):
+    return PathUtils.join(self.download_dir, file_entry['fileName'])
 
-  def auto_download_addon(self, value, need_confirm=True):
+  def fetch_locked(self, file_entry):
+    # the locked file from the download cache, a miss is fetched from its final url only
+    download_path = self.locked_path(file_entry)
+    file_info = AppInfoLock.file_info(file_entry)
+    with HTTPUtils.path_lock(download_path):
+      if AppInfoLock.cached(file_entry, download_path, self.extract_cache.digest):
+        print('using cached download: {}'.format(download_path))
+        return download_path, file_info
+      if 'offline' in self.router.flags:
+        print('not in download cache: {}'.format(file_entry['fileName']))
+        return None, None
+      if not HTTPUtils.fetch_file(self.session, file_entry['finalUrl'], download_path, file_entry['size']):
+        print('cannot fetch {}, the url may have expired, run lock again'.format(file_entry['finalUrl']))
+        if PathUtils.isfile(download_path):
+          PathUtils.delete_file(download_path)
+        return None, None
+      if not AppInfoLock.cached(file_entry, download_path, self.extract_cache.digest):
+        print('destroying file not matching the lock: {}'.format(download_path))
+        PathUtils.delete_file(download_path)
+        return None, None
+    return download_path, file_info
+
+  def lock_file(self, url):
+    status, download_path, file_info = HTTPUtils.download_file(self.session, url, self.download_dir)
+    if not status:
+      return None
+    return AppInfoLock.file_entry(url, file_info, PathUtils.stat(download_path).st_size, self.extract_cache.digest(download_path))
+
+  def selected_keys(self):
+    keys = list()
+    for plugin in self.appinfo.plugins:
+      if plugin.exclude:
+        continue
+      keys.extend(self.resource_key(plugin, i) for i in plugin.resources if self.is_resource_selected(i))
+    keys.extend(self.addon_key(i) for i in self.appinfo.addons if not i.exclude)
+    return keys
+
+  def use_lock(self, node):
+    # loads the lock for --locked/--offline, False if it cannot serve the selection
+    self.lockfile = None
+    if not 'locked' in self.router.flags and not 'offline' in self.router.flags:
+      return True
+    lock = AppInfoLock(AppInfoLock.path_of(self.config.info_file))
+    if not lock.load():
+      node.print_err('no lock file {}, run lock first'.format(lock.path))
+      return False
+    if lock.platform != self.config.platform:
+      node.print_err('lock file is for platform {}, run lock again'.format(lock.platform))
+      return False
+    keys = self.selected_keys()
+    missing = lock.missing(keys)
+    if len(missing) > 0:
+      node.print_err('lock file is out of date, run lock again')
+      for key in missing:
+        print('  not locked: {}'.format(key))
+      return False
+    if 'offline' in self.router.flags:
+      # fail before anything is placed
+      misses = [i for i in lock.files(keys) if not AppInfoLock.cached(i, self.locked_path(i), self.extract_cache.digest)]
+      if len(misses) > 0:
+        node.print_err('{} locked files are not in the download cache'.format(len(misses)))
+        for file_entry in misses:
+          print('  {}'.format(file_entry['fileName']))
+        return False
+    print('installing from {}'.format(lock.path))
+    self.lockfile = lock
+    return True
+
+  def auto_download_addon(self, value, need_confirm=True, workshop_dir=None):
     workshop_ids = HTTPUtils.parse_workshop_ids(value)
     if workshop_ids is None or len(workshop_ids) == 0:
       print('failed to parse workshop id')
-      return
+      return False
     print('found workshop ids:')
     for workshop_id in workshop_ids:
       print('  - {}'.format(workshop_id))
     if need_confirm and not self.confirm():
-      return
+      return False
+    if workshop_dir is None:
+      workshop_dir = self.resolve_path(self.appinfo.config.workshop_dir)
+    status = True
     for workshop_id in workshop_ids:
-      HTTPUtils.download_steam_workshop(self.session, self.resolve_path(self.appinfo.config.workshop_dir), workshop_id)
+      if not HTTPUtils.download_steam_workshop(self.session, workshop_dir, workshop_id):
+        print('cannot download workshop item {}'.format(workshop_id))
+        status = False
+    return status
+
+  def compile_sources(self, jobs, base_dir, track=True):
+    status = True
+    groups = dict()
+    for job in jobs:
+      spcomp = self.config.spcomp or SourcePawnCompiler.locate(PathUtils.dirname(job.output), self.config.platform, stop=base_dir)
+      if spcomp is None:
+        print('cannot find spcomp for {}, is sourcemod installed?'.format(job.source))
+        status = False
+        continue
+      groups.setdefault(spcomp, list()).append(job)
+    for spcomp, group in groups.items():
+      print('compiling {} sources with {}'.format(len(group), spcomp))
+      include_dir = PathUtils.join(PathUtils.dirname(spcomp), 'include')
+      compiler = SourcePawnCompiler(spcomp, [include_dir], self.compile_cache_dir, workers=os.cpu_count() or 1)
+      for result in compiler.compile_all(group):
+        if result.ok:
+          print('{} {}'.format('cached' if result.cached else 'compiled', result.job.output))
+          if track:
+            self.journal.mark(result.job.name, 'extracted')
+        else:
+          print('failed to compile {}:'.format(result.job.source))
+          print(result.log)
+          status = False
+    return status
+
+  @staticmethod
+  def resource_key(plugin, resource):
+    return 'plugin {}: {} ({})'.format(plugin.name, resource.name, resource.url)
+
+  @staticmethod
+  def addon_key(addon):
+    # workshop downloads are tracked per addon only
+    return 'addon {}'.format(addon.url)
+
+  def install_depends(self, plugins):
+    # plugin name -> names of plugins placed before it
+    names = set(i.name for i in self.appinfo.plugins)
+    depends = dict()
+    for plugin in plugins:
+      if plugin.exclude or len(plugin.depends_on) == 0:
+        continue
+      for name in plugin.depends_on:
+        if not name in names:
+          print('plugin {} depends on unknown plugin {}, ignored'.format(plugin.name, name))
+      depends[plugin.name] = [i for i in plugin.depends_on if i in names]
+    return depends
+
+  def install_jobs(self, plugins, addons, base_dir, workshop_dir):
+    jobs = list()
+    for plugin in plugins:
+      if plugin.exclude:
+        print('skipping plugin {}'.format(plugin.name))
+        continue
+      for resource in plugin.resources:
+        if not self.is_resource_selected(resource):
+          print('skipping plugin resource {}'.format(resource.url))
+          continue
+        key = self.resource_key(plugin, resource)
+        if self.journal.done(key, 'extracted'):
+          print('skipping installed plugin resource {}'.format(resource.url))
+          continue
+        url = resource.url
+        if resource.resource_type == 'sourcepawn':
+          url = HTTPUtils.source_url(url)
+        self.journal.mark(key, self.journal.stage(key) or 'resolved', url=url)
+        jobs.append(StagePipeline.Job(key, plugin.name, {'url': url, 'resource': resource, 'target_path': PathUtils.join(base_dir, resource.target_path)}))
+    for addon in addons:
+      if addon.exclude:
+        print('skipping addon {}'.format(addon.name))
+        continue
+      key = self.addon_key(addon)
+      if self.journal.done(key, 'extracted'):
+        print('skipping installed addon {}'.format(addon.name))
+        continue
+      self.journal.mark(key, 'resolved')
+      # addons are not plugins, they never wait for one
+      jobs.append(StagePipeline.Job(key, None, {'addon': addon, 'target_path': workshop_dir}))
+    return jobs
+
+  def stage_print(self, *args):
+    with self.print_lock:
+      print(*args)
+
+  def stage_download(self, job):
+    d = job.data
+    if 'addon' in d:
+      # workshop items are fetched straight into the workshop dir
+      if self.lockfile is None:
+        if not self.auto_download_addon(d['addon'].url, need_confirm=False, workshop_dir=d['target_path']):
+          job.error = 'cannot download workshop items of {}'.format(d['addon'].url)
+          return False
+      elif not self.install_locked_addon(job.key, d['target_path']):
+        job.error = 'cannot install locked addon files'
+        return False
+      return True
+    # a verified download whose stat did not change is reused without any request
+    entry = self.journal.get(job.key)
+    if self.journal.done(job.key, 'verified'):
+      download_path = entry['path']
+      if PathUtils.isfile(download_path):
+        st = PathUtils.stat(download_path)
+        if [st.st_size, st.st_mtime_ns] == entry['stat']:
+          self.stage_print('reusing journaled download: {}'.format(download_path))
+          d['download_path'], d['file_info'], d['verified'] = download_path, HTTPUtils.file_info_t(*entry['fileInfo']), True
+          return True
+      self.stage_print('journaled download changed, downloading again: {}'.format(download_path))
+    self.stage_print('downloading plugin resource {}'.format(d['resource'].url))
+    download_path, file_info = self.fetch_download(job.key, d['url'])
+    if download_path is None:
+      job.error = 'cannot retrieve {}'.format(d['url'])
+      return False
+    self.journal.mark(job.key, 'downloaded', path=download_path, fileInfo=list(file_info))
+    d['download_path'], d['file_info'], d['verified'] = download_path, file_info, False
+    return True
+
+  def stage_verify(self, job):
+    d = job.data
+    if 'addon' in d or d['verified']:
+      return True
+    download_path, file_info = d['download_path'], d['file_info']
+    # other jobs may share the file, see HTTPUtils.path_lock
+    with HTTPUtils.path_lock(download_path):
+      if not PathUtils.isfile(download_path):
+        # destroyed as corrupt by a job verifying the same file first
+        job.error = 'corrupt download {}'.format(download_path)
+        return False
+      size = PathUtils.stat(download_path).st_size
+      resource = d['resource']
+      if (file_info.file_size and size != file_info.file_size) or not self.archive_ok(download_path, self.archive_type(file_info), resource.include_paths, resource.exclude_paths):
+        self.stage_print('destroying corrupt file: {}'.format(download_path))
+        PathUtils.delete_file(download_path)
+        job.error = 'corrupt download {}'.format(download_path)
+        return False
+    st = PathUtils.stat(download_path)
+    self.journal.mark(job.key, 'verified', stat=[st.st_size, st.st_mtime_ns], digest=self.extract_cache.digest(download_path))
+    return True
+
+  def stage_extract(self, job):
+    d = job.data
+    if 'addon' in d or d['resource'].resource_type == 'sourcepawn':
+      return True
+    archive_type = self.archive_type(d['file_info'])
+    if archive_type is None:
+      return True
+    self.stage_print('extracting {}: {}'.format(d['file_info'].file_type, d['file_info'].file_name))
+    unpack = PathUtils.archive_unpack_zip if archive_type == 'zip' else PathUtils.archive_unpack_tar
+    # pinned until placed, other extractions may evict in between
+    d['digest'] = self.extract_to_cache(d['download_path'], unpack, d['resource'].include_paths, d['resource'].exclude_paths, pin=True)
+    return True
+
+  def stage_place(self, job, compile_jobs):
+    d = job.data
+    if 'addon' in d:
+      self.journal.mark(job.key, 'extracted')
+      return True
+    if d['resource'].resource_type == 'sourcepawn':
+      # compiled once everything is placed, spcomp comes with the installed sourcemod
+      stem = PathUtils.extract_file_type(d['file_info'].file_name).file_name
+      compile_jobs.append(SourcePawnCompiler.t_job(job.key, d['download_path'], PathUtils.join(d['target_path'], stem + '.smx')))
+      return True
+    if 'digest' in d:
+      digest = d.pop('digest')
+      try:
+        placed = self.extract_cache.materialize(digest, d['target_path'], verbose=False)
+        self.stage_print('placed {}: {} files copied, {} in place'.format(d['file_info'].file_name, placed['copied'], placed['skipped']))
+      finally:
+        self.extract_cache.unpin(digest)
+    else:
+      self.stage_print('copying file: {}'.format(d['file_info'].file_name))
+      PathUtils.copy2(d['download_path'], PathUtils.join(d['target_path'], d['file_info'].file_name))
+    self.journal.mark(job.key, 'extracted')
+    return True
+
+  def print_pipeline(self, pipeline):
+    print('{:<10} {:>7} {:>6} {:>9} {:>9} {:>12}'.format('stage', 'workers', 'jobs', 'busy', 'blocked', 'utilization'))
+    for report in pipeline.report():
+      print('{:<10} {:>7d} {:>6d} {:>8.02f}s {:>8.02f}s {:>11.01%}'.format(report.name, report.workers, report.jobs, report.busy, report.blocked, report.utilization))
+    print('pipeline wall time {:.02f}s'.format(pipeline.wall))
+
+  def run_install(self, plugins, addons, base_dir, workshop_dir):
+    # download -> verify -> extract -> place, placement follows plugin dependsOn
+    depends = self.install_depends(plugins)
+    cycle = StagePipeline.find_cycle(depends)
+    if not cycle is None:
+      print('plugin dependency cycle: {}'.format(' -> '.join(cycle)))
+      return False
+    jobs = self.install_jobs(plugins, addons, base_dir, workshop_dir)
+    compile_jobs = list()
+    pipeline = StagePipeline([
+      StagePipeline.t_stage('download', self.stage_download, self.stage_workers['download']),
+      StagePipeline.t_stage('verify', self.stage_verify, self.stage_workers['verify']),
+      StagePipeline.t_stage('extract', self.stage_extract, self.stage_workers['extract']),
+      StagePipeline.t_stage('place', partial(self.stage_place, compile_jobs=compile_jobs), self.stage_workers['place']),
+    ], queue_size=self.stage_queue_size, depends=depends)
+    job = current_job()
+    if not job is None:
+      job.progress = pipeline.progress
+    status = pipeline.run(jobs)
+    for job in pipeline.failed:
+      if 'digest' in job.data:
+        self.extract_cache.unpin(job.data['digest'])
+      if job.error != 'cancelled':
+        print('failed {}: {}'.format(job.key, job.error or 'see log'))
+    if pipeline.cancelled:
+      self.clear_temp_dir()
+      print('install cancelled, {} jobs not finished'.format(sum(1 for i in pipeline.failed if i.error == 'cancelled')))
+      checkpoint()
+    status = self.compile_sources(compile_jobs, base_dir) and status
+    self.clear_temp_dir()
+    print()
+    self.print_pipeline(pipeline)
+    return status
+
+  def plan_install(self, plugins, base_dir):
+    planner = InstallPlanner()
+    for plugin in plugins:
+      if plugin.exclude:
+        continue
+      for resource in plugin.resources:
+        if not self.is_resource_selected(resource):
+          continue
+        download_path, file_info = self.fetch_download(self.resource_key(plugin, resource), resource.url)
+        if download_path is None:
+          print('cannot retrieve plugin resource {}'.format(resource.url))
+          continue
+        owner = '{}: {}'.format(plugin.name, resource.name)
+        target_path = PathUtils.join(base_dir, resource.target_path)
+        archive_type = self.archive_type(file_info)
+        if archive_type is None:
+          planner.add_file(owner, PathUtils.join(target_path, file_info.file_name), file_info.file_size)
+        else:
+          planner.add_archive(owner, download_path, archive_type, target_path, resource.include_paths, resource.exclude_paths)
+    return planner
+
+  def print_plan(self, planner):
+    conflicts = list(planner.conflicts())
+    existing = dict()
+    for conflict in planner.existing(self.path_exists):
+      for placement in conflict.placements:
+        existing[placement.owner] = existing.get(placement.owner, 0) + 1
+    print('planned files    : {}'.format(planner.count()))
+    print('conflicting files: {}'.format(len(conflicts)))
+    for conflict in conflicts:
+      print('  {}'.format(conflict.path))
+      for placement in conflict.placements:
+        print('    <- {} ({})'.format(placement.owner, placement.source))
+    print('overwritten files: {}'.format(sum(existing.values())))
+    for owner in planner.owners:
+      if owner in existing:
+        print('  {:>6d} <- {}'.format(existing[owner], owner))
+    print()
+    return len(conflicts)
+
+  def h_plan(self, ns):
+    print()
+    print('planning install')
+    self.print_stats()
+    self.print_appinfo_stats()
+    print()
+    if not self.use_lock(self.router.root):
+      return
+    planner = self.plan_install(self.appinfo.plugins, self.resolve_path(self.appinfo.config.base_dir))
+    self.print_plan(planner)
+
+  def begin_install(self):
+    base_dir = self.resolve_path(self.appinfo.config.base_dir)
+    workshop_dir = self.resolve_path(self.appinfo.config.workshop_dir)
+    self.journal = InstallJournal(self.journal_file)
+    recovered = StagedTree(base_dir).recover()
+    if not recovered is None:
+      print('{}: {}'.format(recovered, base_dir))
+    resume = 'resume' in self.router.flags
+    if resume and self.journal.load() and self.journal.resumable(base_dir):
+      print('resuming install: {} resources done, {} pending'.format(
+        self.journal.count('extracted'), len(self.journal.entries) - self.journal.count('extracted')))
+      use_staging = self.journal.run.get('staged', False)
+    else:
+      if resume:
+        print('no interrupted install to resume, starting over')
+      resume = False
+      use_staging = 'staged' in self.router.flags
+      self.journal.begin(base_dir, use_staging)
+    if not use_staging:
+      return None, base_dir, workshop_dir
+    staged = StagedTree(base_dir)
+    if staged.remap(workshop_dir) == PathUtils.normpath(PathUtils.abspath(workshop_dir)):
+      print('workshop dir is outside the base dir, addons are not staged: {}'.format(workshop_dir))
+    if resume and PathUtils.isdir(staged.staging_dir):
+      print('reusing staging tree: {}'.format(staged.staging_dir))
+    else:
+      # files placed into a staging tree that is gone have to be placed again
+      self.journal.rewind('verified')
+      print('preparing staging tree: {}'.format(staged.staging_dir))
+      staged.prepare()
+    return staged, staged.remap(base_dir), staged.remap(workshop_dir)
+
+  def end_install(self, staged, status):
+    if not status:
+      print('install incomplete, continue with install --resume')
+    if not staged is None:
+      if not status:
+        # kept for --resume, the next prepare replaces it
+        print('live tree left untouched, staging tree kept at {}'.format(staged.staging_dir))
+        return
+      staged.commit()
+      print('swapped in new tree, previous tree kept at {}'.format(staged.snapshot_dir))
+    if status:
+      self.journal.finish()
+    if status and 'record' in self.router.flags:
+      self.record_manifest(self.resolve_path(self.appinfo.config.base_dir))
 
   def h_install(self, ns):
     print()
@@ -313,32 +921,241 @@ class Main:
     print('selected addons:')
     self.print_addons(self.appinfo.addons, exclude_excluded=True)
     print()
-    if not self.confirm():
+    if not self.confirm() or not self.use_lock(self.router.root):
       return
+    if 'plan' in self.router.flags:
+      planner = self.plan_install(self.appinfo.plugins, self.resolve_path(self.appinfo.config.base_dir))
+      if self.print_plan(planner) > 0 and not self.confirm():
+        return
+    with self.exclusive_install():
+      staged, base_dir, workshop_dir = self.begin_install()
+      status = True
+      try:
+        status = self.run_install(self.appinfo.plugins, self.appinfo.addons, base_dir, workshop_dir)
+      except BaseException:
+        status = False
+        raise
+      finally:
+        self.end_install(staged, status)
+    return status
+
+  def install_locked_addon(self, key, workshop_dir):
+    for file_entry in self.lockfile.get(key)['files']:
+      download_path, file_info = self.fetch_locked(file_entry)
+      if download_path is None:
+        return False
+      print('copying addon file: {}'.format(file_info.file_name))
+      PathUtils.copy2(download_path, PathUtils.join(workshop_dir, file_info.file_name))
+    return True
+
+  def lock_selection(self):
+    print()
+    print('locking selected resources')
+    self.print_stats()
+    print()
+    lock = AppInfoLock(AppInfoLock.path_of(self.config.info_file))
+    lock.platform = self.config.platform
+    status = True
     for plugin in self.appinfo.plugins:
       if plugin.exclude:
-        print('skipping plugin {}'.format(plugin.name))
         continue
-      print('installing plugin {}'.format(plugin.name))
       for resource in plugin.resources:
-        if resource.exclude:
-          print('skipping plugin resource {}'.format(resource.url))
+        if not self.is_resource_selected(resource):
           continue
-        if resource.platform != '*':
-          if resource.platform != self.config.platform:
-            print('skipping plugin resource {}'.format(resource.url))
-            continue
-        print('downloading plugin resource {}'.format(resource.url))
+        print('locking plugin resource {}'.format(resource.url))
         url = resource.url
-        target_path = resource.target_path
-        target_path = PathUtils.join(self.resolve_path(self.appinfo.config.base_dir), target_path)
-        self.auto_download_file(url, target_path)
-
+        if resource.resource_type == 'sourcepawn':
+          url = HTTPUtils.source_url(url)
+        file_entry = self.lock_file(url)
+        if file_entry is None:
+          print('cannot retrieve plugin resource {}'.format(resource.url))
+          status = False
+          continue
+        lock.add(self.resource_key(plugin, resource), resource.url, [file_entry])
     for addon in self.appinfo.addons:
       if addon.exclude:
-        print('skipping addon {}'.format(addon.name))
         continue
-      self.auto_download_addon(addon.url, need_confirm=False)
+      print('locking addon {}'.format(addon.name))
+      files = list()
+      for workshop_id in HTTPUtils.parse_workshop_ids(addon.url) or []:
+        urls = HTTPUtils.resolve_steam_workshop(self.session, workshop_id)
+        if urls is None:
+          print('cannot resolve workshop id {}'.format(workshop_id))
+          status = False
+          continue
+        for url in urls:
+          file_entry = self.lock_file(url)
+          if file_entry is None:
+            print('cannot retrieve addon file {}'.format(url))
+            status = False
+            continue
+          files.append(file_entry)
+      lock.add(self.addon_key(addon), addon.url, files)
+    if not status:
+      self.router.root.print_err('lock incomplete, {} not written'.format(lock.path))
+      return
+    lock.save()
+    print('locked {} entries, {} files to {}'.format(len(lock.entries), sum(len(i['files']) for i in lock.entries.values()), lock.path))
+    print()
+
+  def h_lock(self, ns):
+    with self.exclusive_install():
+      self.lock_selection()
+
+  def fleet_target(self, path):
+    # an appinfo file brings its own config and selection, a server root reuses the current ones
+    path = self.resolve_path(path)
+    if PathUtils.isfile(path):
+      appinfo = SteamAppInfo()
+      store = open_store(path)
+      try:
+        store.load(appinfo)
+        for kind in appinfo.kinds:
+          appinfo.items(kind)
+      finally:
+        store.close()
+      base_dir = PathUtils.normpath(self.resolve_path(appinfo.config.base_dir))
+      workshop_dir = PathUtils.normpath(self.resolve_path(appinfo.config.workshop_dir))
+      return FleetDeploy.t_target(path, appinfo, base_dir, workshop_dir)
+    base_dir = PathUtils.normpath(path)
+    current_base_dir = PathUtils.normpath(self.resolve_path(self.appinfo.config.base_dir))
+    workshop_dir = PathUtils.normpath(self.resolve_path(self.appinfo.config.workshop_dir))
+    # a workshop dir outside the server root is shared by all roots
+    if workshop_dir.startswith(current_base_dir + PathUtils.sep):
+      workshop_dir = PathUtils.join(base_dir, PathUtils.relpath(workshop_dir, current_base_dir))
+    return FleetDeploy.t_target(path, self.appinfo, base_dir, workshop_dir)
+
+  def fleet_sources(self, targets):
+    # unique source -> (entity, {dst: target}), a resource is keyed by what it unpacks to
+    sources = dict()
+    for target in targets:
+      for plugin in target.appinfo.plugins:
+        if plugin.exclude:
+          continue
+        for resource in plugin.resources:
+          # an appinfo target may be a server of another platform
+          if not self.is_resource_selected(resource, target.appinfo.config.platform):
+            continue
+          url = resource.url
+          if resource.resource_type == 'sourcepawn':
+            url = HTTPUtils.source_url(url)
+          key = (url, resource.resource_type, tuple(sorted(resource.include_paths or [])), tuple(sorted(resource.exclude_paths or [])))
+          placements = sources.setdefault(key, (resource, dict()))[1]
+          placements.setdefault(PathUtils.join(target.base_dir, resource.target_path), target)
+      for addon in target.appinfo.addons:
+        if addon.exclude:
+          continue
+        placements = sources.setdefault(('addon', addon.url), (addon, dict()))[1]
+        placements.setdefault(target.workshop_dir, target)
+    return sources
+
+  def fleet_download(self, url, include=None, exclude=None):
+    status, download_path, file_info = HTTPUtils.download_file(self.session, url, self.download_dir)
+    if not status:
+      return None, None
+    with HTTPUtils.path_lock(download_path):
+      if self.archive_ok(download_path, self.archive_type(file_info), include, exclude):
+        return download_path, file_info
+      if PathUtils.isfile(download_path):
+        PathUtils.delete_file(download_path)
+    return None, None
+
+  def deploy_resource(self, fleet, key, resource, placements, compile_jobs):
+    url = key[0]
+    print('fetching plugin resource {} for {} targets'.format(resource.url, len(set(i.name for i in placements.values()))))
+    download_path, file_info = self.fleet_download(url, resource.include_paths, resource.exclude_paths)
+    if download_path is None:
+      for target in placements.values():
+        fleet.fail(target, 'cannot retrieve {}'.format(url))
+      return
+    if resource.resource_type == 'sourcepawn':
+      # compiled per target, every target may ship its own sourcemod
+      stem = PathUtils.extract_file_type(file_info.file_name).file_name
+      for target_path, target in placements.items():
+        compile_jobs.setdefault(target.name, list()).append(SourcePawnCompiler.t_job(url, download_path, PathUtils.join(target_path, stem + '.smx')))
+      return
+    archive_type = self.archive_type(file_info)
+    if archive_type is None:
+      placements = {PathUtils.join(i, file_info.file_name): j for i, j in placements.items()}
+      fleet.place_file(download_path, placements, file_info.file_name)
+      return
+    unpack = PathUtils.archive_unpack_zip if archive_type == 'zip' else PathUtils.archive_unpack_tar
+    digest = self.extract_to_cache(download_path, unpack, resource.include_paths, resource.exclude_paths)
+    fleet.place_tree(digest, placements, file_info.file_name)
+
+  def deploy_addon(self, fleet, addon, placements):
+    print('fetching addon {} for {} targets'.format(addon.name, len(set(i.name for i in placements.values()))))
+    for workshop_id in HTTPUtils.parse_workshop_ids(addon.url) or []:
+      urls = HTTPUtils.resolve_steam_workshop(self.session, workshop_id)
+      if urls is None:
+        for target in placements.values():
+          fleet.fail(target, 'cannot resolve workshop id {}'.format(workshop_id))
+        continue
+      for url in urls:
+        download_path, file_info = self.fleet_download(url)
+        if download_path is None:
+          for target in placements.values():
+            fleet.fail(target, 'cannot retrieve {}'.format(url))
+          continue
+        fleet.place_file(download_path, {PathUtils.join(i, file_info.file_name): j for i, j in placements.items()}, file_info.file_name)
+
+  def print_fleet_results(self, fleet, elapsed):
+    print('{:<40} {:>7} {:>9} {:>7} {:>7} {:>6} {:>8}'.format('target', 'linked', 'reflinked', 'copied', 'skipped', 'failed', 'time'))
+    for target in fleet.targets:
+      result = fleet.results[target.name]
+      print('{:<40} {:>7d} {:>9d} {:>7d} {:>7d} {:>6d} {:>7.02f}s'.format(target.name, result.linked, result.reflinked, result.copied, result.skipped, result.failed, result.elapsed))
+      for error in result.errors:
+        print('  {}'.format(error))
+    print('deployed to {} targets in {:.02f}s'.format(len(fleet.targets), elapsed))
+
+  def h_deploy(self, ns):
+    targets = list()
+    for path in [i for i in ns.value.split(',') if i]:
+      try:
+        target = self.fleet_target(path)
+      except (OSError, ValueError) as e:
+        ns.node_.print_err('cannot open target {}: {}'.format(path, e))
+        return
+      if not target.base_dir in [i.base_dir for i in targets]:
+        targets.append(target)
+    if len(targets) == 0:
+      ns.node_.print_err('no targets given')
+      return
+    print()
+    print('deploying to {} targets'.format(len(targets)))
+    self.print_stats()
+    for target in targets:
+      print('  {} -> {}, {}'.format(target.name, target.base_dir, target.workshop_dir))
+    print()
+    if not self.confirm():
+      return
+    t0 = time()
+    sources = self.fleet_sources(targets)
+    fleet = FleetDeploy(self.extract_cache, targets, workers=os.cpu_count() or 1, link='link' in self.router.flags)
+    n_done = 0
+    job = current_job()
+    if not job is None:
+      job.progress = lambda: '{}/{} sources placed'.format(n_done, len(sources))
+    try:
+      compile_jobs = dict()
+      with self.exclusive_install():
+        # every source is fetched and extracted once, then placed into all of its targets
+        for key, (ent, placements) in sources.items():
+          if key[0] == 'addon':
+            self.deploy_addon(fleet, ent, placements)
+          else:
+            self.deploy_resource(fleet, key, ent, placements, compile_jobs)
+          self.clear_temp_dir()
+          n_done += 1
+      for target in targets:
+        if target.name in compile_jobs and not self.compile_sources(compile_jobs[target.name], target.base_dir, track=False):
+          fleet.fail(target, 'cannot compile sourcepawn sources')
+    finally:
+      fleet.close()
+    print()
+    self.print_fleet_results(fleet, time() - t0)
+    print()
+    return all(i.failed == 0 for i in fleet.results.values())
 
   def h_install_plugin(self, ns):
     index = self.eval_index(ns)
@@ -353,38 +1170,353 @@ class Main:
         print('skipping plugin {}'.format(plugin.name))
         return
       print('installing plugin {}'.format(plugin.name))
-      if not self.confirm():
+      if not self.confirm() or not self.use_lock(ns.node_):
         return
-      for resource in plugin.resources:
-        if resource.exclude:
-          print('skipping plugin resource {}'.format(resource.url))
-          return
-        if resource.platform != '*':
-          if resource.platform != self.config.platform:
-            print('skipping plugin resource {}'.format(resource.url))
-            return
-        print('downloading plugin resource {}'.format(resource.url))
-        url = resource.url
-        target_path = resource.target_path
-        target_path = PathUtils.join(self.resolve_path(self.appinfo.config.base_dir), target_path)
-        self.auto_download_file(url, target_path)
+      with self.exclusive_install():
+        staged, base_dir, workshop_dir = self.begin_install()
+        status = False
+        try:
+          status = self.run_install([plugin], [], base_dir, workshop_dir)
+        finally:
+          self.end_install(staged, status)
+      return status
 
   def h_install_workshop(self, ns):
     print()
     print('installing workshop {}'.format(ns.value))
+    if 'staged' in self.router.flags:
+      print('workshop items are not staged, they go into the live workshop dir')
+    self.print_stats()
+    self.print_appinfo_stats()
+    print()
+    return self.auto_download_addon(ns.value)
+
+  def h_cache_info(self, ns):
+    entries = sorted(self.extract_cache.entries(), key=lambda x: x.atime, reverse=True)
+    total = sum(i.size for i in entries)
+    print('cache dir        : {}'.format(self.extract_cache.cache_dir))
+    print('cache usage      : {:.02f} / {:.02f} MB'.format(total / 1024**2, self.extract_cache.max_bytes / 1024**2))
+    for entry in entries:
+      print('  {} {:>12.02f} MB'.format(entry.digest, entry.size / 1024**2))
+    print()
+
+  def h_cache_clear(self, ns):
+    if not self.confirm():
+      return
+    self.extract_cache.clear()
+
+  def index_path(self, path, prefix='fstree'):
+    name = sha1(bytes(PathUtils.abspath(path), 'utf8')).hexdigest()[:16]
+    return PathUtils.join(self.index_dir, '{}-{}.bin'.format(prefix, name))
+
+  def hash_cache_path(self):
+    return PathUtils.join(self.index_dir, 'hashes.bin')
+
+  def live_tree(self, path):
+    path = PathUtils.normpath(PathUtils.abspath(path))
+    for root, tree in self.live_trees.items():
+      if path == root or path.startswith(root + PathUtils.sep):
+        return tree
+    return None
+
+  def path_exists(self, path):
+    tree = self.live_tree(path)
+    if tree is None:
+      return PathUtils.lexists(path)
+    return tree.exists(PathUtils.normpath(PathUtils.abspath(path)))
+
+  def scan_tree(self, path, full=False):
+    tree = self.live_trees.get(PathUtils.normpath(PathUtils.abspath(path)))
+    if not tree is None and not full:
+      return tree, None
+    tree = FileTree(FileTree.ModeEnum.folder, workers=self.config.scan_workers)
+    index_path = self.index_path(path)
+    if PathUtils.isfile(index_path):
+      tree.load_index(index_path)
+    delta = tree.scan_incremental(path, full=full)
+    tree.save_index(index_path)
+    return tree, delta
+
+  def h_scan(self, ns):
+    base_dir = self.resolve_path(self.appinfo.config.base_dir)
+    print('scanning {}'.format(base_dir))
+    tree, delta = self.scan_tree(base_dir, full='full' in self.router.flags)
+    print('entries          : {}'.format(len(tree.list)))
+    if delta is None:
+      print('answered from live index')
+      print()
+      return
+    for name, scan_infos in zip(delta._fields, delta):
+      print('{:<17}: {}'.format(name, len(scan_infos)))
+      if 'verbose' in self.router.flags:
+        for scan_info in scan_infos:
+          print('  {}'.format(scan_info.path))
+    print()
+
+  def hash_tree(self, path, use_cache=True):
+    tree, _ = self.scan_tree(path)
+    tree.hash(self.hash_cache, self.config.hash_workers, use_cache=use_cache)
+    self.hash_cache.save(self.hash_cache_path())
+    return tree
+
+  def record_manifest(self, path):
+    print('recording file hashes of {}'.format(path))
+    tree = self.hash_tree(path)
+    tree.save_bin(self.index_path(path, 'manifest'))
+    print('recorded {} entries'.format(len(tree.list)))
+
+  def h_record(self, ns):
+    self.record_manifest(self.resolve_path(self.appinfo.config.base_dir))
+    print()
+
+  def h_verify(self, ns):
+    base_dir = self.resolve_path(self.appinfo.config.base_dir)
+    manifest_path = self.index_path(base_dir, 'manifest')
+    if not PathUtils.isfile(manifest_path):
+      print('no recorded hashes for {}, run record first'.format(base_dir))
+      return False
+    print('verifying {}'.format(base_dir))
+    tree = self.hash_tree(base_dir, use_cache=not 'full' in self.router.flags)
+    current = {i.path: i for i in tree.list if not i.isdir}
+    missing = list()
+    changed = list()
+    with FileTree.load_bin(manifest_path) as recorded:
+      for scan_info in recorded:
+        if scan_info.isdir:
+          continue
+        current_info = current.pop(scan_info.path, None)
+        if current_info is None:
+          missing.append(scan_info.path)
+        elif current_info.hash != scan_info.hash:
+          changed.append(scan_info.path)
+    unrecorded = list(current)
+    for name, paths in [('missing', missing), ('changed', changed), ('unrecorded', unrecorded)]:
+      print('{:<17}: {}'.format(name, len(paths)))
+      for path in paths:
+        print('  {}'.format(path))
+    print('hash cache       : {} hits, {} misses'.format(self.hash_cache.hits, self.hash_cache.misses))
+    print()
+    # drift fails batch runs, unrecorded files alone do not
+    return len(missing) + len(changed) == 0
+
+  def dedupe(self, roots):
+    dry_run = 'dry' in self.router.flags
+    print('deduplicating {}'.format(', '.join(roots)))
+    deduper = Deduper(self.hash_cache, workers=self.config.hash_workers)
+    groups = deduper.find(roots)
+    self.hash_cache.save(self.hash_cache_path())
+    for group in groups:
+      print('  {} ({} bytes)'.format(group.keep.path, group.size))
+      for duplicate in group.duplicates:
+        print('    = {}'.format(duplicate.path))
+    print('duplicate files  : {}'.format(sum(len(i.duplicates) for i in groups)))
+    print('reclaimable      : {:.02f} MB'.format(sum(i.reclaimed for i in groups) / 1024**2))
+    if dry_run or len(groups) == 0:
+      print()
+      return
+    if not self.confirm():
+      return
+    n = deduper.apply(groups, use_reflink='reflink' in self.router.flags)
+    print('replaced {} files with {}'.format(n, 'reflinks' if 'reflink' in self.router.flags else 'hardlinks'))
+    print()
+
+  def h_dedupe(self, ns):
+    self.dedupe([self.resolve_path(self.appinfo.config.workshop_dir)])
+
+  def h_dedupe_dir(self, ns):
+    self.dedupe([self.resolve_path(i) for i in ns.value.split(',') if i])
+
+  def watched_dirs(self):
+    base_dir = PathUtils.normpath(self.resolve_path(self.appinfo.config.base_dir))
+    workshop_dir = PathUtils.normpath(self.resolve_path(self.appinfo.config.workshop_dir))
+    if workshop_dir == base_dir or workshop_dir.startswith(base_dir + PathUtils.sep):
+      return [base_dir]
+    return [base_dir, workshop_dir]
+
+  def h_watch(self, ns):
+    if not Inotify.supported():
+      print('live index requires linux inotify')
+      return
+    for path in self.watched_dirs():
+      path = PathUtils.abspath(path)
+      if path in self.live_trees or not PathUtils.isdir(path):
+        continue
+      print('watching {}'.format(path))
+      tree = LiveFileTree(path, workers=self.config.scan_workers)
+      tree.start()
+      self.live_trees[path] = tree
+
+  def h_unwatch(self, ns):
+    for path, tree in self.live_trees.items():
+      print('stop watching {}'.format(path))
+      tree.stop()
+    self.live_trees.clear()
+
+  def h_status(self, ns):
+    print()
     self.print_stats()
     self.print_appinfo_stats()
+    for path in self.watched_dirs():
+      if not PathUtils.isdir(path):
+        print('{} does not exist'.format(path))
+        continue
+      tree, _ = self.scan_tree(path)
+      files = [i for i in tree.list if not i.isdir]
+      live = self.live_trees.get(PathUtils.abspath(path))
+      print('{}'.format(path))
+      print('  files          : {}'.format(len(files)))
+      print('  size           : {:.02f} MB'.format(sum(i.size for i in files) / 1024**2))
+      if not live is None:
+        print('  live index     : {} events, {} overflows'.format(live.n_events, live.n_overflows))
+    print()
+
+  def h_conflicts_addons(self, ns):
+    workshop_dir = self.resolve_path(self.appinfo.config.workshop_dir)
+    print('indexing addons in {}'.format(workshop_dir))
+    t0 = time()
+    conflict_index = VpkConflictIndex()
+    conflict_index.add_dir(workshop_dir, workers=self.config.scan_workers)
+    print('indexed {} addons, {} paths in {:.03f}s'.format(len(conflict_index.addons), len(conflict_index.index), time() - t0))
+    for addon_path, e in conflict_index.errors:
+      print('  cannot read {}: {}'.format(addon_path, e))
+    conflicts = conflict_index.conflicts()
+    print('conflicts        : {}'.format(len(conflicts)))
+    for conflict in conflicts:
+      print('  {} paths overridden by:'.format(len(conflict.paths)))
+      for addon_path in conflict.addons:
+        print('    - {}'.format(PathUtils.basename(addon_path)))
+      paths = conflict.paths if 'verbose' in self.router.flags else conflict.paths[:5]
+      for path in paths:
+        print('      {}'.format(path))
+      if len(paths) < len(conflict.paths):
+        print('      ... {} more'.format(len(conflict.paths) - len(paths)))
+    print()
+
+  @staticmethod
+  def repr_file_node(node):
+    if node.data is None or node.data.isdir:
+      return '{}/'.format(node.name)
+    return '{} ({} bytes)'.format(node.name, node.data.size)
+
+  def h_tree(self, ns):
+    if not ns.depth.isnumeric():
+      ns.node_.print_err('arg should be numeric: {}'.format(ns.depth))
+      return
+    depth = int(ns.depth) if int(ns.depth) > 0 else None
+    base_dir = self.resolve_path(self.appinfo.config.base_dir)
+    tree, _ = self.scan_tree(base_dir)
+    for line in tree.to_node(base_dir).iter_repr_tree(self.repr_file_node, stop_at_depth=depth):
+      print(line, end='')
+    print()
+
+  def h_rollback(self, ns):
+    staged = StagedTree(self.resolve_path(self.appinfo.config.base_dir))
+    recovered = staged.recover()
+    if not recovered is None:
+      print('{}: {}'.format(recovered, staged.base_dir))
+      return
+    if not staged.has_snapshot():
+      print('no snapshot found: {}'.format(staged.snapshot_dir))
+      return
+    print('rolling back {} to {}'.format(staged.base_dir, staged.snapshot_dir))
+    if not self.confirm():
+      return
+    staged.rollback()
+
+  def snapshot_appinfo(self):
+    # edits made while a job runs do not reach it and it cannot edit the live appinfo
+    with self.appinfo_lock:
+      return SteamAppInfo().from_tuple(self.appinfo.to_tuple())
+
+  def start_job(self, argv):
+    node = self.router.resolve(argv)
+    if node is None or not node.is_background():
+      self.router.root.print_err('cannot run in the background: {}'.format(' '.join(argv)))
+      return False
+    def run():
+      try:
+        self.router.route_argv(argv)
+      finally:
+        self.session.close()
+    job_locals = {
+      'appinfo': self.snapshot_appinfo(),
+      'session': self.new_session(),
+      'journal': InstallJournal(self.journal_file),
+      'lockfile': None,
+    }
+    # like batch and daemon commands, --bg without --yes fails at a confirmation
+    job = self.jobs.start(' '.join(argv), run, job_locals, assume_yes='yes' in ArgRoute.split_flags(argv)[1])
+    print('[{}] started: {}'.format(job.id, job.command))
+    return True
+
+  def job_arg(self, ns):
+    if not ns.index.isnumeric() or self.jobs.get(int(ns.index)) is None:
+      ns.node_.print_err('no such job: {}'.format(ns.index))
+      return None
+    return self.jobs.get(int(ns.index))
+
+  def print_finished_jobs(self):
+    for job in self.jobs.newly_finished():
+      print('[{}] {} after {:.1f}s: {}'.format(job.id, job.state, job.elapsed, job.command))
+
+  def h_jobs(self, ns):
+    if len(self.jobs.jobs) == 0:
+      print('no jobs')
+      return
+    print('{:>4} {:<10} {:>9}  {}'.format('id', 'state', 'elapsed', 'command'))
+    for job in self.jobs.jobs.values():
+      print('{:>4d} {:<10} {:>8.1f}s  {}'.format(job.id, job.state, job.elapsed, job.command))
+    print()
+
+  def h_wait(self, ns):
+    job = self.job_arg(ns)
+    if job is None:
+      return
+    try:
+      for line in self.jobs.follow(job, job.shown):
+        print(line)
+        job.shown += 1
+    except KeyboardInterrupt:
+      print('stopped waiting, job {} keeps running'.format(job.id))
+      return
+    self.jobs.mark_reported(job)
+    print('[{}] {} after {:.1f}s: {}'.format(job.id, job.state, job.elapsed, job.command))
+
+  def h_cancel(self, ns):
+    job = self.job_arg(ns)
+    if job is None:
+      return
+    if job.finished.is_set():
+      print('job {} already {}'.format(job.id, job.state))
+      return
+    job.cancel()
+    print('cancelling job {}, it stops at its next request or install step'.format(job.id))
+
+  def h_progress(self, ns):
+    job = self.job_arg(ns)
+    if job is None:
+      return
+    print('[{}] {} for {:.1f}s: {}'.format(job.id, job.state, job.elapsed, job.command))
+    if not job.progress is None:
+      print('  {}'.format(job.progress()))
+    lines, n_lines = job.tail(max(0, job.n_lines - 5))
+    print('  output: {} lines, {} not shown yet'.format(n_lines, n_lines - job.shown))
+    for line in lines:
+      print('  | {}'.format(line))
     print()
-    self.auto_download_addon(ns.value)
 
   def boot_router(self):
     ns_index = namedtuple('Index', ['node_', 'index'])
     ns_filepath = namedtuple('FilePath', ['node_', 'filepath'])
     ns_value = namedtuple('Value', ['node_', 'value'])
+    ns_depth = namedtuple('Depth', ['node_', 'depth'])
 
     r_0     = self.router.register('configure')
     r_0_0   = self.router.register('appinfo', r_0).set_namespace(ns_filepath).set_hook(self.h_configure_appinfo)
     r_0_1   = self.router.register('platform', r_0).set_namespace(ns_value).set_hook(self.h_configure_platform)
+    r_0_2   = self.router.register('cachesize', r_0).set_namespace(ns_value).set_hook(self.h_configure_cachesize)
+    r_0_3   = self.router.register('scanworkers', r_0).set_namespace(ns_value).set_hook(self.h_configure_scanworkers)
+    r_0_4   = self.router.register('hashworkers', r_0).set_namespace(ns_value).set_hook(self.h_configure_hashworkers)
 
     r_1     = self.router.register('list')
     r_1_1   = self.router.register('addons', r_1).set_hook(self.h_list_addons)
@@ -413,18 +1545,51 @@ class Main:
     r_5_1_0 = self.router.register('resource', r_5_1).set_namespace(ns_index).set_optional().set_hook(self.h_remove_plugin_resource)
 
     r_6     = self.router.register('save').set_hook(self.h_save)
-    r_7     = self.router.register('install').set_hook(self.h_install)
-    r_8     = self.router.register('installplugin').set_namespace(ns_index).set_hook(self.h_install_plugin)
-    r_9     = self.router.register('installworkshop').set_namespace(ns_value).set_hook(self.h_install_workshop)
-    r_10    = self.router.register('exit').set_hook(self.h_exit)
+    r_7     = self.router.register('install').set_hook(self.h_install).set_background()
+    r_8     = self.router.register('installplugin').set_namespace(ns_index).set_hook(self.h_install_plugin).set_background()
+    r_9     = self.router.register('installworkshop').set_namespace(ns_value).set_hook(self.h_install_workshop).set_background()
+    r_10    = self.router.register('rollback').set_hook(self.h_rollback)
+    r_11    = self.router.register('cache')
+    r_11_0  = self.router.register('info', r_11).set_hook(self.h_cache_info)
+    r_11_1  = self.router.register('clear', r_11).set_hook(self.h_cache_clear)
+    r_12    = self.router.register('plan').set_hook(self.h_plan).set_background()
+    r_13    = self.router.register('scan').set_hook(self.h_scan).set_background()
+    r_14    = self.router.register('record').set_hook(self.h_record).set_background()
+    r_15    = self.router.register('verify').set_hook(self.h_verify).set_background()
+    r_16    = self.router.register('dedupe').set_hook(self.h_dedupe).set_background()
+    r_17    = self.router.register('dedupedir').set_namespace(ns_value).set_hook(self.h_dedupe_dir).set_background()
+    r_18    = self.router.register('watch').set_hook(self.h_watch)
+    r_19    = self.router.register('unwatch').set_hook(self.h_unwatch)
+    r_20    = self.router.register('status').set_hook(self.h_status)
+    r_21    = self.router.register('conflicts')
+    r_21_0  = self.router.register('addons', r_21).set_hook(self.h_conflicts_addons).set_background()
+    r_22    = self.router.register('tree').set_namespace(ns_depth).set_hook(self.h_tree)
+    r_23    = self.router.register('find')
+    r_23_0  = self.router.register('addons', r_23).set_namespace(ns_value).set_hook(self.h_find_addons)
+    r_23_1  = self.router.register('plugins', r_23).set_namespace(ns_value).set_hook(self.h_find_plugins)
+    r_24    = self.router.register('import').set_namespace(ns_filepath).set_hook(self.h_import)
+    r_25    = self.router.register('export').set_namespace(ns_filepath).set_hook(self.h_export)
+    r_26    = self.router.register('lock').set_hook(self.h_lock).set_background()
+    r_27    = self.router.register('deploy').set_namespace(ns_value).set_hook(self.h_deploy).set_background()
+    r_28    = self.router.register('jobs').set_hook(self.h_jobs)
+    r_29    = self.router.register('wait').set_namespace(ns_index).set_hook(self.h_wait)
+    r_30    = self.router.register('cancel').set_namespace(ns_index).set_hook(self.h_cancel)
+    r_31    = self.router.register('progress').set_namespace(ns_index).set_hook(self.h_progress)
+    r_32    = self.router.register('exit').set_hook(self.h_exit)
 
-    print(self.router.root.repr_tree(str))
+    if not self.batch:
+      print(self.router.root.repr_tree(str))
     return
 
   def boot_config(self):
     self.config.load(self.config_file)
     return
 
+  def new_session(self):
+    session = Session()
+    session.headers.update(self.session.headers)
+    return session
+
   def boot_sess(self):
     self.session.headers.update({
       'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36',
@@ -432,39 +1597,179 @@ class Main:
 
   def boot_dirs(self):
     PathUtils.ensure_dir(self.download_dir)
+    PathUtils.ensure_dir(self.cache_dir)
+    PathUtils.ensure_dir(self.index_dir)
+    self.extract_cache = ExtractCache(self.cache_dir, self.config.cache_size * 1024 * 1024)
+    if PathUtils.isfile(self.hash_cache_path()):
+      self.hash_cache.load(self.hash_cache_path())
 
   def load_appinfo(self):
-    import json
     invoke_edit_config = False
     if self.config.info_file is None:
       self.config.info_file = 'appinfo.json'
-      invoke_edit_config = True
-    with open(self.config.info_file, 'r') as fh:
-      self.appinfo.from_dict(json.load(fh))
+      invoke_edit_config = not self.batch
+    self.store = self.saver.store = open_store(self.config.info_file)
+    t0 = perf_counter()
+    source = self.store.load(self.appinfo)
+    print('loaded {} from {} in {:.1f}ms'.format(self.config.info_file, source, (perf_counter() - t0) * 1000))
+    self.appinfo.take_changes()
+    self.appinfo.mark_saved()
     if invoke_edit_config:
       self.h_edit_config(None)
 
   def save_appinfo(self):
-    import json
-    if self.config.info_file is None:
-      self.config.info_file = 'appinfo.json'
-    with open(self.config.info_file, 'w') as fh:
-      json.dump(self.appinfo.to_dict(), fh, indent=2)
+    self.saver.save()
 
-  def run(self):
+  def boot(self):
     self.boot_config()
     self.boot_router()
     self.boot_sess()
     self.boot_dirs()
     self.load_appinfo()
+    self.saver.start()
+
+  @staticmethod
+  def read_script(path):
+    # one command per line, blank lines and lines starting with # are skipped
+    commands = list()
+    with open(path, 'r') as fh:
+      for line in fh:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          commands.append(line.split())
+    return commands
+
+  def run_batch(self, argv):
+    # rsrcman [--yes] [--keep-going] <command> ...
+    # rsrcman [--yes] [--keep-going] --script=<file>
+    # exit code: 0 all commands ok, 1 a command failed, 2 usage error, 130 interrupted
+    self.batch = True
+    _, flags = ArgRoute.split_flags(argv)
+    self.assume_yes = 'yes' in flags
+    script = None
+    for flag in flags:
+      if flag.startswith('script='):
+        script = flag[len('script='):]
+    if script is None:
+      commands = [argv]
+    else:
+      try:
+        commands = self.read_script(script)
+      except OSError as e:
+        self.router.root.print_err('cannot read script {}: {}'.format(script, e))
+        return ArgRoute.usage
+    self.boot()
+    status = ArgRoute.ok
+    for argv in commands:
+      if not self.loop:
+        break
+      if 'bg' in ArgRoute.split_flags(argv)[1]:
+        self.router.root.print_err('--bg needs the interactive prompt: {}'.format(' '.join(argv)))
+        code = ArgRoute.usage
+      else:
+        with self.appinfo_lock:
+          code = self.router.route_argv(argv)
+          self.stack.clear()
+      status = max(status, code)
+      if code != ArgRoute.ok and not 'keep-going' in flags:
+        break
+    return status
+
+  def serve_command(self, argv, send, closed):
+    # one client command, run as a job so its output goes to the client only
+    _, flags = ArgRoute.split_flags(argv)
+    node = self.router.resolve(argv)
+    status = [ArgRoute.ok]
+    job_locals = None
+    if 'bg' in flags:
+      def run():
+        if not self.start_job(argv):
+          status[0] = ArgRoute.usage
+    elif not node is None and node.is_background():
+      # long commands share the warm session and indexes but not the model,
+      # clients keep editing it while they run
+      job_locals = {'appinfo': self.snapshot_appinfo(), 'lockfile': None}
+      def run():
+        if not self.task_lock.acquire(blocking=False):
+          print('waiting for the running command to finish')
+          self.task_lock.acquire()
+        try:
+          status[0] = self.router.route_argv(argv)
+        finally:
+          self.task_lock.release()
+    else:
+      def run():
+        with self.appinfo_lock:
+          status[0] = self.router.route_argv(argv)
+          self.stack.clear()
+        self.saver.request()
+    # not kept by the job manager, a long running daemon would pile them up
+    job = Job('client', ' '.join(argv), run, job_locals, sink=send, assume_yes='yes' in flags)
+    self.clients.add(job)
+    job.start()
+    try:
+      while not job.wait(0.5):
+        if closed():
+          job.cancel()
+    finally:
+      self.clients.discard(job)
+    if not self.loop:
+      # exit stops the daemon
+      self.control_server.shutdown()
+    if job.state == 'cancelled':
+      return 130
+    if job.state == 'failed':
+      return ArgRoute.failed
+    return status[0]
+
+  def run_daemon(self, argv):
+    # rsrcman --daemon [--socket=<path>], serves commands until exit, SIGTERM or SIGINT
+    self.batch = True
+    _, flags = ArgRoute.split_flags(argv)
+    path = next((i[len('socket='):] for i in flags if i.startswith('socket=')), self.socket_file)
+    self.boot()
+    try:
+      self.control_server = ControlServer(path, self.serve_command)
+    except OSError as e:
+      self.router.root.print_err('cannot listen on {}: {}'.format(path, e))
+      return ArgRoute.failed
+    self.jobs.install()
+    # serve_forever runs on this thread, it is stopped from another one
+    signal.signal(signal.SIGTERM, lambda *_: Thread(target=self.control_server.shutdown).start())
+    print('listening on {}'.format(path))
+    try:
+      self.control_server.serve_forever()
+    finally:
+      for job in list(self.clients):
+        job.cancel()
+      self.jobs.cancel_all()
+      self.control_server.close()
+    return ArgRoute.ok
+
+  def run(self):
+    self.boot()
+    self.jobs.install()
     while self.loop:
+      self.print_finished_jobs()
       argv = fetch_argv()
-      self.router.route_argv(argv)
-      self.stack.clear()
-      self.save_appinfo()
+      if 'bg' in ArgRoute.split_flags(argv)[1]:
+        self.start_job(argv)
+        continue
+      with self.appinfo_lock:
+        self.router.route_argv(argv)
+        self.stack.clear()
+      self.saver.request()
 
   def exit(self):
+    if len(self.jobs.running()) > 0:
+      print('cancelling {} running jobs'.format(len(self.jobs.running())))
+      self.jobs.cancel_all()
+    self.jobs.uninstall()
+    self.h_unwatch(None)
+    self.saver.stop()
     self.save_appinfo()
+    if not self.store is None:
+      self.store.close()
     self.config.save(self.config_file)
     self.stack.clear()
     self.session.close()
@@ -472,15 +1777,26 @@ class Main:
 
 if __name__ == '__main__':
   main = Main()
+  status = ArgRoute.ok
   try:
-    main.run()
+    if '--daemon' in sys.argv:
+      status = main.run_daemon(sys.argv[1:])
+    elif len(sys.argv) > 1:
+      status = main.run_batch(sys.argv[1:])
+    else:
+      main.run()
   except KeyboardInterrupt:
     print('interrupt: KeyboardInterrupt')
+    status = 130
   except Exception as e:
     print(traceback.format_exc())
+    status = ArgRoute.failed
 
   try:
-    print('exiting app...')
+    if not main.batch:
+      print('exiting app...')
     main.exit()
   except Exception as e:
     print(traceback.format_exc())
+    status = max(status, ArgRoute.failed)
+  sys.exit(status)
@@ -0,0 +1,16 @@
+import sys
+from src.daemon import ControlClient, default_socket
+
+# thin client of main.py --daemon, exits with the status of the command
+# rsrcctl.py [--socket=<path>] <command> ... [--yes] [--flag]
+if __name__ == '__main__':
+  argv = sys.argv[1:]
+  path = default_socket
+  for arg in [i for i in argv if i.startswith('--socket=')]:
+    path = arg[len('--socket='):]
+    argv.remove(arg)
+  try:
+    status = ControlClient(path).run(argv)
+  except KeyboardInterrupt:
+    status = 130
+  sys.exit(status)
@@ -1,18 +1,42 @@
+import re
 import typing as t
 from hashlib import sha1
+from fnmatch import fnmatchcase
 
+# entities use __slots__ and compute _uid lazily: setters only drop the cached
+# uid and it is hashed again on the next read of uid.
+# _owner is the container holding the entity (SteamAppInfo for plugins and
+# addons, the plugin for resources), it is told about changes through
+# changed() so indexes stay current. _row is the row id in a sqlite store.
 class sSteamAppInfoEntity:
 
+  __slots__ = ('_uid', '_name', '_exclude', '_owner', '_row')
+
+  # dict keys holding lists of strings, edited as comma separated values
+  list_fields = ()
+
   @staticmethod
   def hash(v):
     return sha1(bytes(str(v), encoding='utf8'), usedforsecurity=False).hexdigest()
 
+  @staticmethod
+  def parse_list(v):
+    if v is None:
+      return []
+    if isinstance(v, str):
+      return [i.strip() for i in v.split(',') if i.strip()]
+    return [str(i) for i in v]
+
   def __init__(self):
-    self._uid: str = ''
+    self._uid: t.Optional[str] = None
     self._name: str = str(id(self))
     self._exclude: bool = False
-    self._update_uid()
+    self._owner = None
+    self._row: t.Optional[int] = None
 
+  def _changed(self):
+    if not self._owner is None:
+      self._owner.changed(self)
 
   @property
   def exclude(self):
@@ -27,9 +51,19 @@ class sSteamAppInfoEntity:
         print('invalid boolean value: {}'.format(v))
         v = True
     self._exclude = bool(v)
+    self._changed()
+
+  def _uid_source(self):
+    return self._name
 
   def _update_uid(self):
-    self._uid: str = self.hash(self._name)
+    self._uid = None
+
+  @property
+  def uid(self):
+    if self._uid is None:
+      self._uid = self.hash(self._uid_source())
+    return self._uid
 
   @property
   def name(self):
@@ -39,6 +73,7 @@ class sSteamAppInfoEntity:
   def name(self, v):
     self._name = str(v)
     self._update_uid()
+    self._changed()
 
   def to_dict(self) -> dict:
     raise NotImplementedError()
@@ -47,24 +82,44 @@ class sSteamAppInfoEntity:
     raise NotImplementedError()
     return self
 
+  # compact tuple form used by the binary snapshot, it carries the uid so
+  # entities are rebuilt without setters or hashing
+  def to_tuple(self) -> tuple:
+    raise NotImplementedError()
+
+  @classmethod
+  def _new(cls, uid, name, exclude):
+    self = cls.__new__(cls)
+    self._uid = uid
+    self._name = name
+    self._exclude = exclude
+    self._owner = None
+    self._row = None
+    return self
+
 
 class sSteamAppInfoEntConfig(sSteamAppInfoEntity):
+
+  __slots__ = ('appid', 'appid_ds', 'base_dir', 'workshop_dir', 'platform')
+
   def __init__(self):
     super().__init__()
     self.appid: str = ''
     self.appid_ds: str = ''
     self.base_dir: str = ''
     self.workshop_dir: str = ''
+    # platform of the server when deployed to as a target, empty uses the configured one
+    self.platform: str = ''
 
   def to_dict(self) -> dict:
-    self._update_uid()
     return {
-      '_id': self._uid,
+      '_id': self.uid,
       'name': self.name,
       'appId': self.appid,
       'appIdDedicatedServer': self.appid_ds,
       'baseDir': self.base_dir,
       'workshopDir': self.workshop_dir,
+      'platform': self.platform,
     }
 
   def from_dict(self, d: t.Dict):
@@ -73,29 +128,54 @@ class sSteamAppInfoEntConfig(sSteamAppInfoEntity):
     self.appid_ds = d.get('appIdDedicatedServer')
     self.base_dir = d.get('baseDir')
     self.workshop_dir = d.get('workshopDir')
-    # self._uid = d.get('_id')
-    self._update_uid()
+    self.platform = d.get('platform') or ''
+    self._changed()
+    return self
+
+  def to_tuple(self) -> tuple:
+    return (self.uid, self._name, self.appid, self.appid_ds, self.base_dir, self.workshop_dir, self.platform)
+
+  @classmethod
+  def from_tuple(cls, v):
+    uid, name, appid, appid_ds, base_dir, workshop_dir, platform = v
+    self = cls._new(uid, name, False)
+    self.appid = appid
+    self.appid_ds = appid_ds
+    self.base_dir = base_dir
+    self.workshop_dir = workshop_dir
+    self.platform = platform
     return self
 
 
 class sSteamAppInfoEntResource(sSteamAppInfoEntity):
+
+  __slots__ = ('_url', '_platform', 'rel', 'target_path', 'resource_type', '_include_paths', '_exclude_paths')
+
+  list_fields = ('includePaths', 'excludePaths')
+
   def __init__(self):
     self._url: str = ''
     super().__init__()
-    self.platform: str = ''
+    self._platform: str = ''
     self.rel: str = ''
     self.target_path: str = ''
+    # '' installs the download as is, 'sourcepawn' compiles a .sp source locally
+    self.resource_type: str = ''
+    self._include_paths: list[str] = []
+    self._exclude_paths: list[str] = []
 
   def to_dict(self) -> dict:
-    self._update_uid()
     return {
-      '_id': self._uid,
+      '_id': self.uid,
       'name': self.name,
       'exclude': self.exclude,
       'platform': self.platform,
       'url': self.url,
       'rel': self.rel,
       'targetPath': self.target_path,
+      'type': self.resource_type,
+      'includePaths': self.include_paths,
+      'excludePaths': self.exclude_paths,
     }
 
   def from_dict(self, d: t.Dict):
@@ -105,8 +185,29 @@ class sSteamAppInfoEntResource(sSteamAppInfoEntity):
     self.platform = d.get('platform')
     self.url = d.get('url')
     self.target_path = d.get('targetPath')
-    # self._uid = d.get('_id')
-    self._update_uid()
+    self.resource_type = d.get('type') or ''
+    self.include_paths = d.get('includePaths')
+    self.exclude_paths = d.get('excludePaths')
+    self._changed()
+    return self
+
+  def to_tuple(self) -> tuple:
+    return (
+      self.uid, self._name, self._exclude, self._url, self._platform, self.rel, self.target_path,
+      self.resource_type, tuple(self._include_paths), tuple(self._exclude_paths),
+    )
+
+  @classmethod
+  def from_tuple(cls, v):
+    uid, name, exclude, url, platform, rel, target_path, resource_type, include_paths, exclude_paths = v
+    self = cls._new(uid, name, exclude)
+    self._url = url
+    self._platform = platform
+    self.rel = rel
+    self.target_path = target_path
+    self.resource_type = resource_type
+    self._include_paths = list(include_paths)
+    self._exclude_paths = list(exclude_paths)
     return self
 
   @property
@@ -117,23 +218,86 @@ class sSteamAppInfoEntResource(sSteamAppInfoEntity):
   def url(self, v):
     self._url = str(v)
     self._update_uid()
+    self._changed()
 
-  def _update_uid(self):
-    self._uid: str = self.hash(self._url)
+  @property
+  def platform(self):
+    return self._platform
+
+  @platform.setter
+  def platform(self, v):
+    self._platform = v
+    self._changed()
+
+  @property
+  def include_paths(self):
+    return self._include_paths
+
+  @include_paths.setter
+  def include_paths(self, v):
+    self._include_paths = self.parse_list(v)
+
+  @property
+  def exclude_paths(self):
+    return self._exclude_paths
+
+  @exclude_paths.setter
+  def exclude_paths(self, v):
+    self._exclude_paths = self.parse_list(v)
+
+  def _uid_source(self):
+    return self._url
 
 class sSteamAppInfoEntPlugin(sSteamAppInfoEntity):
+
+  __slots__ = ('rel', '_resources', '_depends_on')
+
+  # names of plugins that are placed before this one on install
+  list_fields = ('dependsOn',)
+
   def __init__(self):
     super().__init__()
     self.rel: str = ''
-    self.resources: list[sSteamAppInfoEntResource] = []
+    self._resources: EntityList = EntityList(owner=self)
+    self._depends_on: t.List[str] = []
+
+  @property
+  def depends_on(self):
+    return self._depends_on
+
+  @depends_on.setter
+  def depends_on(self, v):
+    self._depends_on = self.parse_list(v)
+    self._changed()
+
+  @property
+  def resources(self):
+    return self._resources
+
+  @resources.setter
+  def resources(self, v):
+    self._resources.set_owner(None)
+    self._resources = EntityList(v, owner=self)
+    self._changed()
+
+  def attach(self, ent):
+    ent._owner = self
+    self._changed()
+
+  def detach(self, ent):
+    ent._owner = None
+    self._changed()
+
+  def changed(self, ent):
+    self._changed()
 
   def to_dict(self) -> dict:
-    self._update_uid()
     return {
-      '_id': self._uid,
+      '_id': self.uid,
       'name': self.name,
       'exclude': self.exclude,
       'rel': self.rel,
+      'dependsOn': list(self.depends_on),
       'resources': [i.to_dict() for i in self.resources],
     }
 
@@ -141,21 +305,54 @@ class sSteamAppInfoEntPlugin(sSteamAppInfoEntity):
     self.exclude = d.get('exclude')
     self.name = d.get('name')
     self.rel = d.get('rel')
+    self.depends_on = d.get('dependsOn')
     self.resources = [sSteamAppInfoEntResource().from_dict(i) for i in d.get('resources')]
-    # self._uid = d.get('_id')
-    self._update_uid()
+    self._changed()
+    return self
+
+  def to_tuple(self) -> tuple:
+    return (self.uid, self._name, self._exclude, self.rel, tuple(self._depends_on), tuple(i.to_tuple() for i in self._resources))
+
+  @classmethod
+  def from_tuple(cls, v):
+    uid, name, exclude, rel, depends_on, resources = v
+    self = cls._new(uid, name, exclude)
+    self.rel = rel
+    self._depends_on = list(depends_on)
+    self._resources = EntityList([sSteamAppInfoEntResource.from_tuple(i) for i in resources], owner=self)
     return self
 
 
 class sSteamAppInfoEntAddon(sSteamAppInfoEntity):
+
+  __slots__ = ('_url',)
+
   def __init__(self):
     super().__init__()
-    self.url: str = ''
+    self._url: str = ''
+
+  @property
+  def url(self):
+    return self._url
+
+  @url.setter
+  def url(self, v):
+    self._url = v
+    self._changed()
+
+  r_workshop_id = re.compile(r'[?&]id=(\d+)')
+
+  @property
+  def workshop_id(self):
+    url = str(self._url or '')
+    if url.isnumeric():
+      return url
+    m = self.r_workshop_id.search(url)
+    return m.group(1) if m else None
 
   def to_dict(self) -> dict:
-    self._update_uid()
     return {
-      '_id': self._uid,
+      '_id': self.uid,
       'name': self.name,
       'exclude': self.exclude,
       'url': self.url,
@@ -165,16 +362,372 @@ class sSteamAppInfoEntAddon(sSteamAppInfoEntity):
     self.exclude = d.get('exclude')
     self.name = d.get('name')
     self.url = d.get('url')
-    # self._uid = d.get('_id')
-    self._update_uid()
+    self._changed()
     return self
 
+  def to_tuple(self) -> tuple:
+    return (self.uid, self._name, self._exclude, self._url)
+
+  @classmethod
+  def from_tuple(cls, v):
+    uid, name, exclude, url = v
+    self = cls._new(uid, name, exclude)
+    self._url = url
+    return self
+
+
+# list that tells its owner about entities entering and leaving it
+class EntityList(list):
+
+  __slots__ = ('_owner',)
+
+  def __init__(self, items=(), owner=None):
+    super().__init__(items)
+    self._owner = None
+    self.set_owner(owner)
+
+  def set_owner(self, owner):
+    self._detach(self)
+    self._owner = owner
+    self._attach(self)
+
+  def _attach(self, items):
+    if not self._owner is None:
+      for ent in items:
+        self._owner.attach(ent)
+
+  def _detach(self, items):
+    if not self._owner is None:
+      for ent in items:
+        self._owner.detach(ent)
+
+  def _moved(self):
+    if not self._owner is None:
+      self._owner.moved()
+
+  def append(self, ent):
+    super().append(ent)
+    self._attach((ent,))
+
+  def extend(self, items):
+    items = list(items)
+    super().extend(items)
+    self._attach(items)
+
+  def __iadd__(self, items):
+    self.extend(items)
+    return self
+
+  def insert(self, index, ent):
+    super().insert(index, ent)
+    self._attach((ent,))
+    self._moved()
+
+  def pop(self, index=-1):
+    ent = super().pop(index)
+    self._detach((ent,))
+    return ent
+
+  def remove(self, ent):
+    super().remove(ent)
+    self._detach((ent,))
+
+  def clear(self):
+    items = list(self)
+    super().clear()
+    self._detach(items)
+
+  def __setitem__(self, index, v):
+    old = self[index]
+    super().__setitem__(index, v)
+    if isinstance(index, slice):
+      self._detach(old)
+      self._attach(self[index])
+    else:
+      self._detach((old,))
+      self._attach((v,))
+
+  def __delitem__(self, index):
+    old = self[index]
+    super().__delitem__(index)
+    self._detach(old if isinstance(index, slice) else (old,))
+
+  def sort(self, *args, **kwargs):
+    super().sort(*args, **kwargs)
+    self._moved()
+
+  def reverse(self):
+    super().reverse()
+    self._moved()
+
+
+# field -> key -> entities. a field is built from the live list on its first
+# lookup, later lookups only re-key the entities touched since, so loading and
+# bursts of edits cost nothing up front.
+class SteamAppInfoIndex:
+
+  def __init__(self, fields):
+    self.fields = fields
+    self.items = ()
+    self.maps: dict[str, dict] = dict()
+    self.keys: dict[str, dict] = dict()
+    self.pending: dict[str, dict] = dict()
+
+  def reset(self, items):
+    self.items = items
+    self.maps.clear()
+    self.keys.clear()
+    self.pending.clear()
+
+  def touch(self, ent):
+    for pending in self.pending.values():
+      pending[id(ent)] = ent
+
+  def discard(self, ent):
+    for field in self.maps:
+      self.pending[field].pop(id(ent), None)
+      self._remove(field, ent)
+
+  def _remove(self, field, ent):
+    values = self.keys[field].pop(id(ent), None)
+    if values is None:
+      return
+    m = self.maps[field]
+    for value in values:
+      ents = m.get(value)
+      if ents is None:
+        continue
+      ents.pop(id(ent), None)
+      if not ents:
+        del m[value]
+
+  def _add(self, field, ent):
+    values = tuple(self.fields[field](ent))
+    self.keys[field][id(ent)] = values
+    m = self.maps[field]
+    for value in values:
+      m.setdefault(value, dict())[id(ent)] = ent
+
+  def build(self, field):
+    if not field in self.maps:
+      self.maps[field] = dict()
+      self.keys[field] = dict()
+      self.pending[field] = dict()
+      for ent in self.items:
+        self._add(field, ent)
+      return self.maps[field]
+    pending = self.pending[field]
+    for ent in pending.values():
+      self._remove(field, ent)
+      self._add(field, ent)
+    pending.clear()
+    return self.maps[field]
+
+  def lookup(self, field, value):
+    # id -> entity, value may be a glob pattern
+    m = self.build(field)
+    if not any(c in value for c in '*?['):
+      return dict(m.get(value, dict()))
+    found = dict()
+    for key, ents in m.items():
+      if fnmatchcase(key, value):
+        found.update(ents)
+    return found
+
 
 class SteamAppInfo:
+
+  kinds = ('plugins', 'addons')
+
+  plugin_fields = {
+    'uid': lambda x: (x.uid,),
+    'name': lambda x: (x.name.lower(),),
+    'url': lambda x: set(i.url for i in x.resources),
+    'platform': lambda x: set(i.platform for i in x.resources),
+  }
+  addon_fields = {
+    'uid': lambda x: (x.uid,),
+    'name': lambda x: (x.name.lower(),),
+    'url': lambda x: (x.url,),
+    'workshop': lambda x: (x.workshop_id,) if x.workshop_id else (),
+  }
+
   def __init__(self):
     self.config: sSteamAppInfoEntConfig = sSteamAppInfoEntConfig() 
-    self.plugins: list[sSteamAppInfoEntPlugin] = []
-    self.addons: list[sSteamAppInfoEntAddon] = []
+    self.indexes = {
+      'plugins': SteamAppInfoIndex(self.plugin_fields),
+      'addons': SteamAppInfoIndex(self.addon_fields),
+    }
+    self._positions = None
+    # bumped on every change, the model is dirty until saved_version catches up
+    self.version = 0
+    self.saved_version = 0
+    # what changed since take_changes, stores that write per row use these
+    self.changes = dict()
+    self.removed = dict()
+    self.replaced = set()
+    self.moved_kinds = set()
+    # kind -> callable returning the entities, run on first access
+    self.loaders = dict()
+    # store answering find() for kinds that are not loaded yet
+    self.store = None
+    self.config._owner = self
+    self._items = {
+      'plugins': self.adopt(EntityList(), 'plugins', track=False),
+      'addons': self.adopt(EntityList(), 'addons', track=False),
+    }
+
+  def items(self, kind):
+    if kind in self.loaders:
+      entities = self.loaders.pop(kind)()
+      self._items[kind] = self.adopt(EntityList(entities), kind, track=False)
+    return self._items[kind]
+
+  def replace(self, kind, entities):
+    self.loaders.pop(kind, None)
+    self._items[kind].set_owner(None)
+    self._items[kind] = self.adopt(EntityList(entities), kind)
+
+  def loaded(self, kind):
+    return not kind in self.loaders
+
+  @property
+  def plugins(self):
+    return self.items('plugins')
+
+  @plugins.setter
+  def plugins(self, v):
+    self.replace('plugins', v)
+
+  @property
+  def addons(self):
+    return self.items('addons')
+
+  @addons.setter
+  def addons(self, v):
+    self.replace('addons', v)
+
+  def adopt(self, items, kind, track=True):
+    # bulk attach, the index is rebuilt on the next lookup
+    for ent in items:
+      ent._owner = self
+    items._owner = self
+    self.indexes[kind].reset(items)
+    self._positions = None
+    if track:
+      self.replaced.add(kind)
+      self.version += 1
+    return items
+
+  @staticmethod
+  def kind_of(ent):
+    return 'plugins' if isinstance(ent, sSteamAppInfoEntPlugin) else 'addons'
+
+  def index_of(self, ent):
+    return self.indexes[self.kind_of(ent)]
+
+  def attach(self, ent):
+    ent._owner = self
+    self.index_of(ent).touch(ent)
+    self._positions = None
+    self.changes[id(ent)] = ent
+    self.removed.pop(id(ent), None)
+    self.moved_kinds.add(self.kind_of(ent))
+    self.version += 1
+
+  def detach(self, ent):
+    ent._owner = None
+    self.index_of(ent).discard(ent)
+    self._positions = None
+    self.changes.pop(id(ent), None)
+    self.removed[id(ent)] = ent
+    self.moved_kinds.add(self.kind_of(ent))
+    self.version += 1
+
+  def changed(self, ent):
+    if not ent is self.config:
+      self.index_of(ent).touch(ent)
+    self.changes[id(ent)] = ent
+    self.version += 1
+
+  def moved(self):
+    self._positions = None
+    self.moved_kinds.update(self.kinds)
+    self.version += 1
+
+  def take_changes(self):
+    # (changed, removed, replaced kinds, moved kinds) since the last call
+    changes = (list(self.changes.values()), list(self.removed.values()), self.replaced, self.moved_kinds)
+    self.changes = dict()
+    self.removed = dict()
+    self.replaced = set()
+    self.moved_kinds = set()
+    return changes
+
+  def touch_all(self):
+    # everything is written again on the next save, e.g. to a new file
+    for kind in self.kinds:
+      self.items(kind)
+    self.replaced.update(self.kinds)
+    self.changes[id(self.config)] = self.config
+    self.version += 1
+
+  @property
+  def dirty(self):
+    return self.version != self.saved_version
+
+  def mark_saved(self, version=None):
+    self.saved_version = self.version if version is None else version
+
+  def position(self, ent):
+    if self._positions is None:
+      self._positions = dict()
+    kind = self.kind_of(ent)
+    if not kind in self._positions:
+      self._positions[kind] = {id(e): n for n, e in enumerate(self.items(kind))}
+    return self._positions[kind].get(id(ent))
+
+  @staticmethod
+  def parse_query(query):
+    # "field=value&field=value", values may be glob patterns
+    conditions = list()
+    for term in query.split('&'):
+      if not term.strip():
+        continue
+      field, sep, value = term.partition('=')
+      if not sep or not field.strip():
+        raise ValueError('invalid condition: {}'.format(term))
+      conditions.append((field.strip().lower(), value.strip()))
+    return conditions
+
+  def find(self, kind, query):
+    # (position, entity) pairs matching every condition, in list order
+    if not kind in self.kinds:
+      raise ValueError('invalid kind: {}'.format(kind))
+    index = self.indexes[kind]
+    conditions = self.parse_query(query)
+    for field, value in conditions:
+      if field != 'exclude' and not field in index.fields:
+        raise ValueError('unknown field: {}, expected one of: exclude, {}'.format(field, ', '.join(index.fields)))
+    if not self.loaded(kind) and not self.store is None:
+      return self.store.find(kind, conditions)
+    items = self.items(kind)
+    candidates = None
+    filters = list()
+    for field, value in conditions:
+      if field == 'exclude':
+        want = value.lower() in ('1', 'true', 'yes', 'y')
+        filters.append(lambda x, want=want: x.exclude == want)
+        continue
+      if field == 'name':
+        value = value.lower()
+      found = index.lookup(field, value)
+      candidates = found if candidates is None else {k: v for k, v in candidates.items() if k in found}
+    if candidates is None:
+      entries = enumerate(items)
+    else:
+      entries = sorted(((self.position(i), i) for i in candidates.values()), key=lambda x: x[0])
+    return [(n, ent) for n, ent in entries if all(f(ent) for f in filters)]
 
   def to_dict(self) -> dict:
     return {
@@ -188,3 +741,19 @@ class SteamAppInfo:
     self.plugins = [sSteamAppInfoEntPlugin().from_dict(i) for i in d.get('plugins')]
     self.addons = [sSteamAppInfoEntAddon().from_dict(i) for i in d.get('addons')]
     return self
+
+  def to_tuple(self) -> tuple:
+    return (
+      self.config.to_tuple(),
+      tuple(i.to_tuple() for i in self.plugins),
+      tuple(i.to_tuple() for i in self.addons),
+    )
+
+  def from_tuple(self, v):
+    config, plugins, addons = v
+    self.config = sSteamAppInfoEntConfig.from_tuple(config)
+    self.config._owner = self
+    self.changes[id(self.config)] = self.config
+    self.plugins = [sSteamAppInfoEntPlugin.from_tuple(i) for i in plugins]
+    self.addons = [sSteamAppInfoEntAddon.from_tuple(i) for i in addons]
+    return self
@@ -9,8 +9,24 @@
 # fragment <command> <none>
 # fragment <command> <opt>
 # fragment <command> <arg>
+#
+# flags  <command> ... --flag
+#        tokens starting with "--" are collected into ArgRoute.flags
+#        <command> ... --flag=value, read with ArgRoute.flag_value
+#        flags are kept per context, so commands routed on other threads
+#        (background jobs) and the threads they start see their own flags
+#
+# values <command> arg key=value ... <command> key=value
+#        key=value tokens following a command are its field values, read
+#        with ArgRoute.values by the hook of that command only
+#
+# status route_argv returns ArgRoute.ok, ArgRoute.failed when a hook
+#        returned False or printed an error, ArgRoute.usage when argv did not
+#        match the tree
 
+import re
 from collections import namedtuple
+from contextvars import ContextVar
 from functools import wraps
 from itertools import chain
 from src.node import Node
@@ -24,6 +40,7 @@ class ArgNode(Node, PrintMethods):
     self._namespace = namedtuple('DefaultArgNamespace', ['node_'])
     self._hook = self._default_hook
     self._f_optional = False
+    self._f_background = False
 
   def _print_pads(self):
     print('\t' * self.depth, end='')
@@ -38,7 +55,19 @@ class ArgNode(Node, PrintMethods):
 
   @property
   def router(self):
-    return self._router
+    node = self
+    while not node.is_root():
+      node = node.parent
+    return node._router
+
+  def print_err(self, *args, **kwargs):
+    super().print_err(*args, **kwargs)
+    self.router.set_status(ArgRoute.failed)
+
+  def print_usage_err(self, *args, **kwargs):
+    super().print_err(*args, **kwargs)
+    self.print(self.repr_help())
+    self.router.set_status(ArgRoute.usage)
 
   @property
   def hook(self):
@@ -62,6 +91,9 @@ class ArgNode(Node, PrintMethods):
   def is_optional(self):
     return self._f_optional
 
+  def is_background(self):
+    return self._f_background
+
   def child_is_optional(self):
     if self.is_leaf():
       return False
@@ -79,6 +111,11 @@ class ArgNode(Node, PrintMethods):
     self._f_optional = True
     return self
 
+  def set_background(self):
+    # may run as a background job
+    self._f_background = True
+    return self
+
   def repr_help(self):
     return 'usage: {}'.format(self)
 
@@ -87,21 +124,23 @@ class ArgNode(Node, PrintMethods):
       if len(argv) >= self.field_count:
         args, argv = argv[:self.field_count], argv[self.field_count:]
         arg_namespace = self._namespace(self, *args)
-        _ = self._hook(arg_namespace)
+        self.router.values, argv = ArgRoute.split_values(argv)
+        if self._hook(arg_namespace) is False:
+          self.router.set_status(ArgRoute.failed)
       else:
         # raise error
-        self.print_err('"{}" command requires args'.format(self.name))
-        self.print(self.repr_help())
+        self.print_usage_err('"{}" command requires args'.format(self.name))
     else:
-      _ = self._hook(None)
+      self.router.values, argv = ArgRoute.split_values(argv)
+      if self._hook(None) is False:
+        self.router.set_status(ArgRoute.failed)
 
     if self.is_leaf():
       return
 
     if len(argv) == 0:
       if not self.child_is_optional():
-        self.print_err('"{}" command requires args'.format(self.name))
-        self.print(self.repr_help())
+        self.print_usage_err('"{}" command requires args'.format(self.name))
         return
       else:
         return
@@ -112,8 +151,7 @@ class ArgNode(Node, PrintMethods):
       node = self.get_child_by_name(arg)
       node.invoke(argv)
     else:
-      self.print_err('args did not match: {}'.format(arg))
-      self.print(self.repr_help())
+      self.print_usage_err('args did not match: {}'.format(arg))
     return
 
   def __repr__(self):
@@ -131,11 +169,20 @@ class ArgNode(Node, PrintMethods):
 class ArgRoute:
   ar_n_root = '_root_'
   ar_n_help = '_leaf_help_'
+  # route_argv status, also the exit code of batch runs
+  ok = 0
+  failed = 1
+  usage = 2
+  re_value = re.compile(r'^[A-Za-z_]\w*=')
 
   def __init__(self, prog):
     self._root: ArgNode = ArgNode(self.ar_n_root)
     self._prog = prog
     self._root._router = self
+    self._flags = ContextVar('flags', default=frozenset())
+    self._values = ContextVar('values', default=dict())
+    # a mutable holder, so errors from threads started with a copy of the context count
+    self._status = ContextVar('status', default=None)
 
   @property
   def root(self):
@@ -145,6 +192,27 @@ class ArgRoute:
   def prog(self):
     return self._prog
 
+  @property
+  def flags(self):
+    return self._flags.get()
+
+  @flags.setter
+  def flags(self, v):
+    self._flags.set(v)
+
+  @property
+  def values(self):
+    return self._values.get()
+
+  @values.setter
+  def values(self, v):
+    self._values.set(v)
+
+  def set_status(self, status):
+    holder = self._status.get()
+    if not holder is None:
+      holder[0] = max(holder[0], status)
+
   def register(self, name, parent=None):
     if parent is None:
       parent = self.root
@@ -152,9 +220,52 @@ class ArgRoute:
     # print('registered {} <- {}'.format(arg_node, parent))
     return arg_node
 
+  @staticmethod
+  def split_flags(argv):
+    flags = set(i[2:] for i in argv if i.startswith('--') and len(i) > 2)
+    argv = [i for i in argv if not (i.startswith('--') and len(i) > 2)]
+    return argv, flags
+
+  @classmethod
+  def split_values(cls, argv):
+    # leading key=value tokens of argv as a dict, rest of argv
+    values = dict()
+    while len(argv) > 0 and cls.re_value.match(argv[0]):
+      key, value = argv.pop(0).split('=', 1)
+      values[key] = value
+    return values, argv
+
+  def flag_value(self, name, default=None):
+    prefix = name + '='
+    for flag in self.flags:
+      if flag.startswith(prefix):
+        return flag[len(prefix):]
+    return default
+
+  def resolve(self, argv):
+    # the node argv routes to without invoking any hook, None if it does not match
+    argv, _ = self.split_flags(argv)
+    node = self._root
+    while True:
+      if node.accepts_args:
+        if len(argv) < node.field_count:
+          return None
+        argv = argv[node.field_count:]
+      _, argv = self.split_values(argv)
+      if node.is_leaf() or len(argv) == 0:
+        return node
+      arg = argv.pop(0)
+      if not node.has(arg):
+        return None
+      node = node.get_child_by_name(arg)
+
   def route_argv(self, argv):
+    argv, self.flags = self.split_flags(argv)
+    holder = [self.ok]
+    self._status.set(holder)
     root = self._root
     while not root.is_root():
       root = root.parent
     root.invoke(argv)
+    return holder[0]
 
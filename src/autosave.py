@@ -0,0 +1,69 @@
+from threading import Thread, Event, Lock
+from src.logger import init_logger
+
+logger = init_logger('autosave')
+
+# writes SteamAppInfo to its store in the background once it is dirty.
+# requests arriving within delay of each other are coalesced into one write.
+# the model is only read while holding lock, the store does its io outside.
+class AppInfoSaver:
+
+  def __init__(self, appinfo, lock, store=None, delay=1.0):
+    self.appinfo = appinfo
+    self.lock = lock
+    self.store = store
+    self.delay = delay
+    self.n_writes = 0
+    self._write_lock = Lock()
+    self._requested = Event()
+    self._stop = Event()
+    self._thread = None
+
+  def save(self):
+    with self.lock:
+      if not self.appinfo.dirty or self.store is None:
+        return False
+      version = self.appinfo.version
+      store = self.store
+      batch = store.snapshot(self.appinfo)
+      # taken before the model lock is released so writes land in snapshot order
+      self._write_lock.acquire()
+    try:
+      store.write(batch)
+      self.appinfo.mark_saved(version)
+    finally:
+      self._write_lock.release()
+    self.n_writes += 1
+    logger.debug('saved {} (version {})'.format(store.path, version))
+    return True
+
+  def request(self):
+    if self.appinfo.dirty:
+      self._requested.set()
+
+  def start(self):
+    self._stop.clear()
+    self._thread = Thread(target=self._run, name='autosave', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    self._requested.set()
+    if not self._thread is None:
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    while not self._stop.is_set():
+      self._requested.wait()
+      # keep waiting while requests keep coming in
+      while not self._stop.is_set():
+        self._requested.clear()
+        if not self._requested.wait(self.delay):
+          break
+      if self._stop.is_set():
+        return
+      try:
+        self.save()
+      except Exception as e:
+        logger.error('failed to save appinfo: {}'.format(e))
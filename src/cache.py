@@ -0,0 +1,182 @@
+import os
+import json
+import shutil
+import hashlib
+from threading import Lock
+from collections import namedtuple
+from src.logger import init_logger
+from src.utils import PathUtils
+
+logger = init_logger('cache')
+
+# extracted archive trees keyed by archive digest
+#
+# <cache_dir>/<digest>/tree/...      unpacked archive
+# <cache_dir>/<digest>/index.json    {"size": n, "files": [[relpath, size, sha1], ...]}
+#
+# index.json mtime doubles as the lru access time.
+class ExtractCache:
+
+  t_entry = namedtuple('CacheEntry', ['digest', 'path', 'size', 'atime'])
+
+  index_name = 'index.json'
+  tree_name = 'tree'
+  buffer_size = 1 << 20
+
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._digests = dict()
+    # digests being placed are never evicted, see pin()
+    self._lock = Lock()
+    self._pinned = dict()
+    self._fetching = dict()
+
+  @classmethod
+  def hash_file(cls, path, algorithm='sha256'):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as fh:
+      while True:
+        b = fh.read(cls.buffer_size)
+        if not b:
+          break
+        h.update(b)
+    return h.hexdigest()
+
+  def digest(self, path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if not key in self._digests:
+      self._digests[key] = self.hash_file(path)
+    return self._digests[key]
+
+  def _entry_dir(self, digest):
+    return os.path.join(self.cache_dir, digest)
+
+  def _index_path(self, digest):
+    return os.path.join(self._entry_dir(digest), self.index_name)
+
+  def load_index(self, digest):
+    with open(self._index_path(digest), 'r') as fh:
+      return json.load(fh)
+
+  def get(self, digest):
+    index_path = self._index_path(digest)
+    if not os.path.isfile(index_path):
+      return None
+    os.utime(index_path)
+    return os.path.join(self._entry_dir(digest), self.tree_name)
+
+  def put(self, digest, unpack):
+    entry_dir = self._entry_dir(digest)
+    temp_dir = entry_dir + '.tmp'
+    if os.path.isdir(temp_dir):
+      shutil.rmtree(temp_dir)
+    tree_dir = os.path.join(temp_dir, self.tree_name)
+    os.makedirs(tree_dir)
+    try:
+      unpack(tree_dir)
+      files = list()
+      total = 0
+      for root, dirs, names in os.walk(tree_dir):
+        for name in names:
+          path = os.path.join(root, name)
+          size = os.path.getsize(path)
+          files.append([os.path.relpath(path, tree_dir), size, self.hash_file(path, 'sha1')])
+          total += size
+      with open(os.path.join(temp_dir, self.index_name), 'w') as fh:
+        json.dump({'size': total, 'files': files}, fh)
+      if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+      os.rename(temp_dir, entry_dir)
+    except BaseException:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      raise
+    logger.info('cached extracted tree {} ({} files, {} bytes)'.format(digest, len(files), total))
+    self.evict(keep=digest)
+    return os.path.join(entry_dir, self.tree_name)
+
+  def entry_digest(self, archive_path, variant=None):
+    # variant distinguishes trees unpacked from the same archive with different member filters
+    digest = self.digest(archive_path)
+    if variant:
+      digest += '-' + hashlib.sha1(bytes(variant, 'utf8')).hexdigest()[:12]
+    return digest
+
+  def fetch(self, archive_path, unpack, variant=None, pin=False):
+    digest = self.entry_digest(archive_path, variant)
+    # pinned before unpacking so put does not evict it, a failed unpack never
+    # reaches the caller's unpin
+    if pin:
+      self.pin(digest)
+    try:
+      with self._lock:
+        fetch_lock = self._fetching.setdefault(digest, Lock())
+      # one unpack per digest when the same archive is fetched concurrently
+      with fetch_lock:
+        tree_dir = self.get(digest)
+        if tree_dir is None:
+          logger.info('cache miss: {}'.format(os.path.basename(archive_path)))
+          tree_dir = self.put(digest, unpack)
+        else:
+          logger.info('cache hit: {}'.format(os.path.basename(archive_path)))
+    except BaseException:
+      if pin:
+        self.unpin(digest)
+      raise
+    return digest, tree_dir
+
+  def pin(self, digest):
+    with self._lock:
+      self._pinned[digest] = self._pinned.get(digest, 0) + 1
+
+  def unpin(self, digest):
+    with self._lock:
+      if self._pinned.get(digest, 0) <= 1:
+        self._pinned.pop(digest, None)
+      else:
+        self._pinned[digest] -= 1
+
+  def materialize(self, digest, dst, link=False, reflink=False, verbose=True):
+    # copy2 keeps mtime, so files with matching size and mtime are already in place
+    tree_dir = os.path.join(self._entry_dir(digest), self.tree_name)
+    placed = {'linked': 0, 'reflinked': 0, 'copied': 0, 'skipped': 0}
+    for relpath, _, _ in self.load_index(digest)['files']:
+      dst_file = os.path.join(dst, relpath)
+      how = PathUtils.place_file(os.path.join(tree_dir, relpath), dst_file, link=link, reflink=reflink)
+      placed[how] += 1
+      if verbose and how != 'skipped':
+        print('> {}'.format(dst_file))
+    return placed
+
+  def entries(self):
+    if not os.path.isdir(self.cache_dir):
+      return
+    for digest in os.listdir(self.cache_dir):
+      if digest.endswith('.tmp'):
+        continue
+      index_path = self._index_path(digest)
+      if not os.path.isfile(index_path):
+        continue
+      with open(index_path, 'r') as fh:
+        size = json.load(fh).get('size', 0)
+      yield self.t_entry(digest, self._entry_dir(digest), size, os.stat(index_path).st_mtime)
+
+  def total_size(self):
+    return sum(i.size for i in self.entries())
+
+  def evict(self, keep=None):
+    entries = sorted(self.entries(), key=lambda x: x.atime)
+    total = sum(i.size for i in entries)
+    for entry in entries:
+      if total <= self.max_bytes:
+        break
+      if entry.digest == keep or entry.digest in self._pinned:
+        continue
+      logger.info('evicting cached tree {} ({} bytes)'.format(entry.digest, entry.size))
+      shutil.rmtree(entry.path)
+      total -= entry.size
+
+  def clear(self):
+    for entry in list(self.entries()):
+      shutil.rmtree(entry.path)
@@ -1,6 +1,8 @@
+import os
 import configparser
 from functools import partial
 from src.utils import PathUtils
+from src.store import stores
 
 class Config:
 
@@ -28,7 +30,8 @@ class Config:
   def info_file(self, v):
     v = str(v)
     p = PathUtils.extract_file_type(v)
-    if not p.file_extension == 'json':
+    # the extension selects the storage backend
+    if not p.file_extension.lower() in stores:
       v += '.json'
     self._parser['DEFAULT']['appinfo'] = v
 
@@ -49,4 +52,42 @@ class Config:
   @target_dir.setter
   def target_dir(self, v):
     v = str(v)
-    self._parser['DEFAULT']['tgtdir'] = v
\ No newline at end of file
+    self._parser['DEFAULT']['tgtdir'] = v
+
+  @property
+  def cache_size(self):
+    # extracted archive cache budget in megabytes
+    return self._parser['DEFAULT'].getint('cachesize', 2048)
+
+  @cache_size.setter
+  def cache_size(self, v):
+    v = str(int(v))
+    self._parser['DEFAULT']['cachesize'] = v
+
+  @property
+  def scan_workers(self):
+    return self._parser['DEFAULT'].getint('scanworkers', 1)
+
+  @scan_workers.setter
+  def scan_workers(self, v):
+    v = str(int(v))
+    self._parser['DEFAULT']['scanworkers'] = v
+
+  @property
+  def hash_workers(self):
+    return self._parser['DEFAULT'].getint('hashworkers', os.cpu_count() or 1)
+
+  @hash_workers.setter
+  def hash_workers(self, v):
+    v = str(int(v))
+    self._parser['DEFAULT']['hashworkers'] = v
+
+  @property
+  def spcomp(self):
+    # overrides the spcomp found in the installed sourcemod package
+    return self._parser['DEFAULT'].get('spcomp')
+
+  @spcomp.setter
+  def spcomp(self, v):
+    v = str(v)
+    self._parser['DEFAULT']['spcomp'] = v
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import select
+import socket
+import socketserver
+from src.logger import init_logger
+
+logger = init_logger('daemon')
+
+default_socket = './index/rsrcman.sock'
+
+# rsrcman as a long running process, commands arrive over a unix domain
+# socket and run against the loaded model, session pool and indexes. every
+# connection carries one command:
+#
+# client -> {"argv": [...]}
+# daemon -> {"out": line} ... {"status": code}
+#
+# the client only needs this module, so it starts without loading requests,
+# the config or the appinfo. closing the connection cancels the command.
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+  class Handler(socketserver.StreamRequestHandler):
+
+    # for reading the request only, closing the server waits for the handlers
+    timeout = 10
+
+    def handle(self):
+      try:
+        line = self.rfile.readline()
+        if not line:
+          # a probe, see remove_stale
+          return
+        argv = json.loads(line)['argv']
+      except (OSError, ValueError, KeyError, TypeError):
+        logger.warning('bad request on control socket')
+        return
+      self.connection.settimeout(None)
+      status = self.server.run_command(argv, self.send, self.closed)
+      try:
+        self.send_msg({'status': status})
+      except OSError:
+        pass
+
+    def send_msg(self, msg):
+      self.wfile.write(bytes(json.dumps(msg) + '\n', 'utf8'))
+      self.wfile.flush()
+
+    def send(self, line):
+      self.send_msg({'out': line})
+
+    def closed(self):
+      # the client sends nothing after its request, readable means it hung up
+      readable, _, _ = select.select([self.connection], [], [], 0)
+      return len(readable) > 0
+
+  def __init__(self, path, run_command):
+    # run_command(argv, send, closed) runs a command, passing every output line
+    # to send and polling closed to notice the client going away, returns its status
+    self.path = path
+    self.run_command = run_command
+    self.remove_stale(path)
+    super().__init__(path, self.Handler)
+    # anyone able to connect can run installs
+    os.chmod(path, 0o600)
+
+  @staticmethod
+  def remove_stale(path):
+    if not os.path.exists(path):
+      return
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+    except OSError:
+      logger.info('removing stale socket {}'.format(path))
+      os.unlink(path)
+      return
+    raise OSError('a daemon is already listening on {}'.format(path))
+
+  def close(self):
+    self.server_close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+
+class ControlClient:
+
+  # exit code when no daemon is listening
+  unavailable = 3
+  # exit code when the output pipe closed, as if killed by SIGPIPE
+  broken_pipe = 141
+
+  def __init__(self, path=default_socket):
+    self.path = path
+
+  def run(self, argv, out=sys.stdout):
+    # sends argv to the daemon and prints its output, returns the command status
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      try:
+        sock.connect(self.path)
+      except OSError as e:
+        print('ERROR: no daemon on {}: {}'.format(self.path, e), file=sys.stderr)
+        return self.unavailable
+      sock.sendall(bytes(json.dumps({'argv': argv}) + '\n', 'utf8'))
+      with sock.makefile('r', encoding='utf8') as fh:
+        try:
+          for line in fh:
+            msg = json.loads(line)
+            if 'status' in msg:
+              return msg['status']
+            print(msg['out'], file=out)
+          out.flush()
+        except BrokenPipeError:
+          # the reader went away (| head), leaving closes the socket and the
+          # daemon cancels the command. stdout goes to devnull so the flush
+          # at interpreter exit does not fail again
+          os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+          return self.broken_pipe
+    print('ERROR: daemon closed the connection', file=sys.stderr)
+    return 1
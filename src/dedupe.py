@@ -0,0 +1,118 @@
+import os
+from hashlib import sha1
+from collections import namedtuple
+from src.fstree import FileTree
+from src.utils import PathUtils
+from src.logger import init_logger
+
+logger = init_logger('dedupe')
+
+# finds identical files across directories and replaces the copies with
+# hardlinks (or reflinks) to one kept file. candidates are narrowed by size,
+# then by a hash of a sampled prefix, then by a full content hash.
+class Deduper:
+
+  t_file = namedtuple('DedupeFile', ['path', 'size', 'dev', 'ino', 'nlink'])
+  t_group = namedtuple('DedupeGroup', ['keep', 'duplicates', 'size', 'reclaimed'])
+
+  sample_size = 1 << 16
+
+  def __init__(self, hash_cache, workers=1, min_size=1):
+    self.hash_cache = hash_cache
+    self.workers = workers
+    self.min_size = min_size
+
+  @classmethod
+  def sample_hash(cls, path):
+    try:
+      with open(path, 'rb') as fh:
+        return sha1(fh.read(cls.sample_size), usedforsecurity=False).hexdigest()
+    except OSError:
+      return None
+
+  @staticmethod
+  def group_by(items, key):
+    groups = dict()
+    for item in items:
+      k = key(item)
+      if k is None:
+        continue
+      groups.setdefault(k, list()).append(item)
+    return [i for i in groups.values() if len(set((j.dev, j.ino) for j in i)) > 1]
+
+  def find(self, roots):
+    by_size = dict()
+    for root in roots:
+      for scan_info in FileTree.scan_dir(root, workers=self.workers):
+        if scan_info.isdir or scan_info.size < self.min_size:
+          continue
+        by_size.setdefault(scan_info.size, list()).append(scan_info.path)
+
+    candidates = list()
+    for size, paths in by_size.items():
+      if len(paths) < 2:
+        continue
+      files = list()
+      for path in paths:
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        files.append(self.t_file(path, size, st.st_dev, st.st_ino, st.st_nlink))
+      # links only work within one device
+      candidates.extend(self.group_by(files, lambda x: x.dev))
+
+    groups = list()
+    for files in candidates:
+      for sampled in self.group_by(files, lambda x: self.sample_hash(x.path)):
+        if sampled[0].size > self.sample_size:
+          digests = self.hash_cache.hash_files([i.path for i in sampled], self.workers)
+          full = self.group_by(sampled, lambda x: digests.get(x.path))
+        else:
+          full = [sampled]
+        for same in full:
+          groups.append(self.make_group(same))
+    return groups
+
+  def make_group(self, files):
+    # keep the inode with the most names, every other inode is replaced
+    inodes = dict()
+    for f in files:
+      inodes.setdefault(f.ino, list()).append(f)
+    keep_ino = max(inodes, key=lambda x: (len(inodes[x]), inodes[x][0].nlink))
+    keep = inodes[keep_ino][0]
+    duplicates = list()
+    reclaimed = 0
+    for ino, names in inodes.items():
+      if ino == keep_ino:
+        continue
+      duplicates.extend(names)
+      # space is only freed once the last name of an inode is replaced
+      if names[0].nlink == len(names):
+        reclaimed += names[0].size
+    return self.t_group(keep, duplicates, keep.size, reclaimed)
+
+  def replace(self, keep, duplicate, use_reflink=False):
+    temp_path = duplicate.path + '.dedupe'
+    try:
+      if use_reflink:
+        PathUtils.reflink(keep.path, temp_path)
+        st = os.stat(duplicate.path)
+        os.utime(temp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+      else:
+        os.link(keep.path, temp_path)
+      os.replace(temp_path, duplicate.path)
+    except OSError as e:
+      logger.warning('cannot replace {}: {}'.format(duplicate.path, e))
+      if os.path.lexists(temp_path):
+        os.unlink(temp_path)
+      return False
+    return True
+
+  def apply(self, groups, use_reflink=False):
+    n = 0
+    for group in groups:
+      for duplicate in group.duplicates:
+        if self.replace(group.keep, duplicate, use_reflink):
+          n += 1
+    return n
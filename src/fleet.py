@@ -0,0 +1,82 @@
+from time import perf_counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import PathUtils
+from src.logger import init_logger
+
+logger = init_logger('fleet')
+
+# one install fanned out to many server roots. the caller fetches and extracts
+# every source once, then it is placed into all targets selecting it at the
+# same time, one thread per target. files are reflinked from the cache where
+# the filesystem supports it and copied otherwise, so a server editing a
+# shipped config changes only its own copy. hardlinks are opt-in, they share
+# every file with the cache and all other targets.
+class FleetDeploy:
+
+  t_target = namedtuple('FleetTarget', ['name', 'appinfo', 'base_dir', 'workshop_dir'])
+
+  class Result:
+
+    __slots__ = ('linked', 'reflinked', 'copied', 'skipped', 'failed', 'errors', 'elapsed')
+
+    def __init__(self):
+      self.linked = 0
+      self.reflinked = 0
+      self.copied = 0
+      self.skipped = 0
+      self.failed = 0
+      self.errors = list()
+      self.elapsed = 0.0
+
+    def add(self, placed):
+      self.linked += placed['linked']
+      self.reflinked += placed['reflinked']
+      self.copied += placed['copied']
+      self.skipped += placed['skipped']
+
+  def __init__(self, extract_cache, targets, workers=4, link=False):
+    self.extract_cache = extract_cache
+    self.targets = targets
+    self.link = link
+    self.results = {i.name: self.Result() for i in targets}
+    self._pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets))))
+
+  def close(self):
+    self._pool.shutdown()
+
+  def fail(self, target, reason):
+    result = self.results[target.name]
+    result.failed += 1
+    result.errors.append(reason)
+
+  def place(self, placements, place_one, what):
+    # placements maps dst -> target, a dst shared by targets is placed once
+    groups = dict()
+    for dst, target in placements.items():
+      groups.setdefault(target.name, (target, list()))[1].append(dst)
+
+    def run(group):
+      target, dsts = group
+      result = self.results[target.name]
+      t0 = perf_counter()
+      for dst in dsts:
+        try:
+          result.add(place_one(dst))
+        except OSError as e:
+          logger.warning('cannot place {} into {}: {}'.format(what, dst, e))
+          result.failed += 1
+          result.errors.append('{}: {}'.format(what, e))
+      result.elapsed += perf_counter() - t0
+
+    list(self._pool.map(run, groups.values()))
+
+  def place_tree(self, digest, placements, what):
+    self.place(placements, lambda dst: self.extract_cache.materialize(digest, dst, link=self.link, reflink=not self.link, verbose=False), what)
+
+  def place_file(self, path, placements, what):
+    def place_one(dst):
+      placed = {'linked': 0, 'reflinked': 0, 'copied': 0, 'skipped': 0}
+      placed[PathUtils.place_file(path, dst, link=self.link, reflink=not self.link)] += 1
+      return placed
+    self.place(placements, place_one, what)
@@ -1,13 +1,20 @@
 import typing as t
 import os
 import io
+import mmap
+import struct
 import tarfile
+from bisect import bisect_left
+from functools import partial
 from zipfile import ZipFile, is_zipfile
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from src.node import Node
 
 class FileTree:
 
-  t_scan_info = namedtuple('ScanInfo', ['isdir', 'path', 'size'])
+  t_scan_info = namedtuple('ScanInfo', ['isdir', 'path', 'size', 'mtime', 'hash'], defaults=(0, None))
+  t_scan_delta = namedtuple('ScanDelta', ['added', 'removed', 'modified'])
 
   class ModeEnum:
     folder = 1
@@ -19,14 +26,78 @@ class FileTree:
   def walk(path):
     yield from os.walk(path)
 
+  @staticmethod
+  def fanout(path, visit, workers=1):
+    # visit(dir) -> (result, subdirs), yields (dir, result) in depth-first order.
+    # with workers > 1 each visit fans its subdirs out to the pool right away,
+    # while results are still consumed in the same order as the sequential walk.
+    if workers <= 1:
+      stack = [path]
+      while stack:
+        root = stack.pop()
+        result, subdirs = visit(root)
+        yield root, result
+        stack.extend(reversed(subdirs))
+      return
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = dict()
+    def task(root):
+      result, subdirs = visit(root)
+      for subdir in subdirs:
+        try:
+          futures[subdir] = pool.submit(task, subdir)
+        except RuntimeError:
+          # consumer stopped and the pool is shut down
+          break
+      return result, subdirs
+    futures[path] = pool.submit(task, path)
+    try:
+      stack = [path]
+      while stack:
+        root = stack.pop()
+        result, subdirs = futures.pop(root).result()
+        yield root, result
+        stack.extend(reversed(subdirs))
+    finally:
+      pool.shutdown(wait=False, cancel_futures=True)
+
   @classmethod
-  def scan_dir(cls, path):
-    for root, dirs, files in cls.walk(path):
-      for d in dirs:
-        yield cls.t_scan_info(True, os.path.join(root, d),  0)
-      for f in files:
-        fpath = os.path.join(root, f)
-        yield cls.t_scan_info(False, fpath, os.stat(fpath).st_size)
+  def list_dir(cls, path):
+    # ((dir scan infos, file scan infos), subdirs to descend), symlinked dirs are listed but not followed
+    dirs = list()
+    files = list()
+    subdirs = list()
+    try:
+      with os.scandir(path) as it:
+        for entry in it:
+          if entry.is_dir():
+            dirs.append(cls.scan_entry(entry))
+            if not entry.is_symlink():
+              subdirs.append(entry.path)
+          else:
+            files.append(cls.scan_entry(entry))
+    except OSError:
+      return None, []
+    return (dirs, files), subdirs
+
+  @classmethod
+  def scan_entry(cls, entry):
+    try:
+      st = entry.stat()
+    except OSError:
+      return cls.t_scan_info(entry.is_dir(), entry.path, 0, 0)
+    if entry.is_dir():
+      return cls.t_scan_info(True, entry.path, 0, st.st_mtime_ns)
+    return cls.t_scan_info(False, entry.path, st.st_size, st.st_mtime_ns)
+
+  @classmethod
+  def scan_dir(cls, path, workers=1):
+    for root, listing in cls.fanout(path, cls.list_dir, workers):
+      if listing is None:
+        continue
+      dirs, files = listing
+      yield from dirs
+      yield from files
 
   @classmethod
   def scan_zip_file(cls, filelike: t.Union[t.AnyStr, t.IO[bytes]]):
@@ -45,34 +116,295 @@ class FileTree:
       yield cls.t_scan_info(ti.isdir(), ti.name, ti.size)
     th.close()
 
-  def __init__(self, mode):
+  @classmethod
+  def diff(cls, old, new):
+    old = {i.path: i for i in old}
+    new = {i.path: i for i in new}
+    added = [i for p, i in new.items() if not p in old]
+    removed = [i for p, i in old.items() if not p in new]
+    modified = list()
+    for p, i in new.items():
+      j = old.get(p)
+      if j is None or i.isdir:
+        continue
+      if i.isdir != j.isdir or i.size != j.size or i.mtime != j.mtime:
+        modified.append(i)
+    return cls.t_scan_delta(added, removed, modified)
+
+  def __init__(self, mode, workers=1):
     self._modes = [self.ModeEnum.folder, self.ModeEnum.zip, self.ModeEnum.tar]
     self.mode = mode
+    self.workers = workers
     self.list = list()
+    self.root = ''
+    # incremental index, dir path -> (mtime_ns, subdir paths, file scan infos)
+    self.index = dict()
 
-  def set_mode(mode):
+  def set_mode(self, mode):
     if not mode in self._modes:
-      raise ValueError('invalid scan mode: {}'.format(self.mode))
+      raise ValueError('invalid scan mode: {}'.format(mode))
     self.mode = mode
 
   def scan(self, path, mode=None):
     if not mode is None:
       self.set_mode(mode)
     if self.mode == self.ModeEnum.folder:
-      scanner = self.scan_dir
+      scanner = partial(self.scan_dir, workers=self.workers)
     elif self.mode == self.ModeEnum.zip:
       scanner = self.scan_zip_file
     elif self.mode == self.ModeEnum.tar:
       scanner = self.scan_tar_file
     self.list.clear()
+    self.root = path if self.mode == self.ModeEnum.folder else ''
     for scan_info in scanner(path):
       self.list.append(scan_info)
 
+  def scan_incremental(self, path, full=False):
+    # directories whose mtime did not change reuse their cached listing without
+    # stat-ing their files. in-place file rewrites do not touch the directory
+    # mtime, pass full=True to re-stat every file.
+    path = os.path.normpath(path)
+    def visit(root):
+      try:
+        mtime = os.stat(root).st_mtime_ns
+      except OSError:
+        return None, []
+      cached = self.index.get(root)
+      if not full and not cached is None and cached[0] == mtime:
+        return cached, cached[1]
+      listing, subdirs = self.list_dir(root)
+      if listing is None:
+        return None, []
+      entry = (mtime, sorted(subdirs), sorted(listing[1], key=lambda x: x.path))
+      return entry, entry[1]
+    index = dict()
+    for root, entry in self.fanout(path, visit, self.workers):
+      if not entry is None:
+        index[root] = entry
+
+    scan_list = self.flatten_index(index)
+    delta = self.diff(self.list, scan_list)
+    self.root = path
+    self.index = index
+    self.list = scan_list
+    return delta
+
+  def hash(self, hash_cache, workers=1, use_cache=True):
+    digests = hash_cache.hash_files([i.path for i in self.list if not i.isdir], workers, use_cache)
+    def update(scan_info):
+      if scan_info.isdir:
+        return scan_info
+      return scan_info._replace(hash=digests.get(scan_info.path))
+    self.list = [update(i) for i in self.list]
+    for root, (mtime, dirs, files) in self.index.items():
+      files[:] = [update(i) for i in files]
+
+  def flatten_index(self, index):
+    scan_list = list()
+    for root, (mtime, dirs, files) in index.items():
+      for d in dirs:
+        if d in index:
+          scan_list.append(self.t_scan_info(True, d, 0, index[d][0]))
+      scan_list.extend(files)
+    return scan_list
+
+  def save_index(self, path):
+    self.save_bin(path)
+
+  def load_index(self, path):
+    with self.load_bin(path) as ix:
+      # the root itself has no record, mtime -1 forces its listing to be refreshed
+      index = {ix.root: (-1, list(), list())}
+      for scan_info in ix:
+        parent = index.get(os.path.dirname(scan_info.path))
+        if scan_info.isdir:
+          index[scan_info.path] = (scan_info.mtime, list(), list())
+          if not parent is None:
+            parent[1].append(scan_info.path)
+        elif not parent is None:
+          parent[2].append(scan_info)
+      self.root = ix.root
+    self.index = index
+    self.list = self.flatten_index(index)
+
+  def to_node(self, name=None):
+    # Node hierarchy of the scanned paths, each node carries its ScanInfo as data
+    root = Node(name if not name is None else (self.root or '.'))
+    prefix = os.path.normpath(self.root) + os.sep if self.root else ''
+    for scan_info in self.list:
+      path = scan_info.path
+      if prefix and path.startswith(prefix):
+        path = path[len(prefix):]
+      node = root
+      for part in path.replace('\\', '/').split('/'):
+        if not part or part == '.':
+          continue
+        child = node.children.get(part)
+        if child is None:
+          child = Node(part, node)
+        node = child
+      if not node is root:
+        node.data = scan_info
+    return root
+
   def save_str(self):
-    r = ''
+    r = list()
     for scan_info in self.list:
-      isdir, path, size = scan_info
-      r += str(int(isdir)) + '"'
-      r += path + '"'
-      r += str(size)
-      r += '\n'
\ No newline at end of file
+      r.append('{}"{}"{}\n'.format(int(scan_info.isdir), scan_info.path, scan_info.size))
+    return ''.join(r)
+
+  def save_bin(self, path):
+    with open(path, 'wb') as fh:
+      fh.write(FileTreeIndex.pack(self.list, self.root))
+
+  @staticmethod
+  def load_bin(path):
+    return FileTreeIndex(path)
+
+
+# compact binary FileTree index, read through mmap without a full parse
+#
+# header   magic, version, root string id, string count, record count,
+#          string table offset, record table offset
+# strings  (offset, length) pairs followed by a utf8 blob, one per unique path component
+# records  fixed width: parent record, name string id, isdir, size, mtime_ns, hash
+#
+# records are sorted by path components, parents always precede children and
+# lookups binary search the record table reconstructing paths on demand.
+class FileTreeIndex:
+
+  magic = b'RSFT'
+  version = 1
+  s_header = struct.Struct('<4sHxxIIIQQ')
+  s_string = struct.Struct('<II')
+  s_record = struct.Struct('<iIB3xQq20s')
+  hash_size = 20
+
+  @classmethod
+  def pack(cls, scan_infos, root=''):
+    root = os.path.normpath(root) if root else ''
+    entries = dict()
+    for scan_info in scan_infos:
+      path = scan_info.path
+      if root and (path == root or path.startswith(root + os.sep)):
+        path = path[len(root) + 1:]
+      parts = tuple(i for i in path.replace('\\', '/').split('/') if i and i != '.')
+      if not parts:
+        continue
+      entries[parts] = scan_info
+      # archive listings may omit directory members
+      for n in range(1, len(parts)):
+        if not parts[:n] in entries:
+          entries[parts[:n]] = None
+
+    strings = dict()
+    def string_id(v):
+      if not v in strings:
+        strings[v] = len(strings)
+      return strings[v]
+    root_id = string_id(root)
+
+    keys = sorted(entries)
+    positions = {k: n for n, k in enumerate(keys)}
+    records = list()
+    for k in keys:
+      scan_info = entries[k]
+      parent = positions[k[:-1]] if len(k) > 1 else -1
+      if scan_info is None:
+        isdir, size, mtime, digest = True, 0, 0, None
+      else:
+        isdir, size, mtime, digest = scan_info.isdir, scan_info.size, scan_info.mtime, scan_info.hash
+      digest = bytes.fromhex(digest)[:cls.hash_size] if digest else b''
+      records.append(cls.s_record.pack(parent, string_id(k[-1]), int(bool(isdir)), size, mtime, digest))
+
+    blobs = [bytes(i, 'utf8', 'surrogateescape') for i in strings]
+    string_table = list()
+    offset = 0
+    for b in blobs:
+      string_table.append(cls.s_string.pack(offset, len(b)))
+      offset += len(b)
+
+    strings_offset = cls.s_header.size
+    records_offset = strings_offset + cls.s_string.size * len(blobs) + offset
+    header = cls.s_header.pack(cls.magic, cls.version, root_id, len(blobs), len(records), strings_offset, records_offset)
+    return b''.join([header] + string_table + blobs + records)
+
+  def __init__(self, path):
+    self._fh = open(path, 'rb')
+    self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, root_id, self.n_strings, self.n_records, self._strings_offset, self._records_offset = \
+      self.s_header.unpack_from(self._mm, 0)
+    if magic != self.magic or version != self.version:
+      self.close()
+      raise ValueError('invalid file tree index: {}'.format(path))
+    self._blob_offset = self._strings_offset + self.s_string.size * self.n_strings
+    self._strings = dict()
+    self.root = self.string(root_id)
+
+  def close(self):
+    self._mm.close()
+    self._fh.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self.n_records
+
+  def string(self, i):
+    v = self._strings.get(i)
+    if v is None:
+      offset, length = self.s_string.unpack_from(self._mm, self._strings_offset + i * self.s_string.size)
+      start = self._blob_offset + offset
+      v = str(self._mm[start:start + length], 'utf8', 'surrogateescape')
+      self._strings[i] = v
+    return v
+
+  def record(self, i):
+    return self.s_record.unpack_from(self._mm, self._records_offset + i * self.s_record.size)
+
+  def parts(self, i):
+    r = list()
+    while i >= 0:
+      parent, name_id, *_ = self.record(i)
+      r.append(self.string(name_id))
+      i = parent
+    return tuple(reversed(r))
+
+  def scan_info(self, i, parts=None):
+    parent, name_id, isdir, size, mtime, digest = self.record(i)
+    if parts is None:
+      parts = self.parts(i)
+    path = os.path.join(self.root, *parts) if self.root else '/'.join(parts)
+    digest = digest.hex() if digest.strip(b'\x00') else None
+    return FileTree.t_scan_info(bool(isdir), path, size, mtime, digest)
+
+  def find(self, path):
+    if self.root and (path == self.root or path.startswith(self.root + os.sep)):
+      path = path[len(self.root) + 1:]
+    key = tuple(i for i in path.replace('\\', '/').split('/') if i and i != '.')
+    lo = bisect_left(range(self.n_records), key, key=self.parts)
+    if lo < self.n_records and self.parts(lo) == key:
+      return lo
+    return None
+
+  def lookup(self, path):
+    i = self.find(path)
+    if i is None:
+      return None
+    return self.scan_info(i)
+
+  def __contains__(self, path):
+    return not self.find(path) is None
+
+  def __iter__(self):
+    # parents precede children, so component tuples are built incrementally
+    parts = dict()
+    for i in range(self.n_records):
+      parent, name_id, *_ = self.record(i)
+      p = parts[parent] + (self.string(name_id),) if parent >= 0 else (self.string(name_id),)
+      parts[i] = p
+      yield self.scan_info(i, p)
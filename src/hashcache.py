@@ -0,0 +1,86 @@
+import os
+import struct
+from hashlib import sha1
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# content hashes keyed by (device, inode, size, mtime_ns), so files whose stat
+# did not change are never read again. hashlib releases the gil while hashing
+# large buffers, which lets hash_files spread the work over a thread pool.
+class HashCache:
+
+  s_record = struct.Struct('<QQQq20s')
+  buffer_size = 1 << 20
+
+  def __init__(self, max_entries=1 << 20):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self._lock = Lock()
+
+  @staticmethod
+  def stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+  @classmethod
+  def hash_file(cls, path):
+    h = sha1(usedforsecurity=False)
+    buf = bytearray(cls.buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fh:
+      while True:
+        n = fh.readinto(buf)
+        if not n:
+          break
+        h.update(view[:n])
+    return h.hexdigest()
+
+  def get_hash(self, path, use_cache=True):
+    key = self.stat_key(os.stat(path))
+    if use_cache:
+      with self._lock:
+        digest = self.entries.get(key)
+        if not digest is None:
+          self.entries.move_to_end(key)
+          self.hits += 1
+          return digest
+    digest = self.hash_file(path)
+    # only remember the digest if the file did not change while it was read
+    if self.stat_key(os.stat(path)) == key:
+      with self._lock:
+        self.entries[key] = digest
+        self.misses += 1
+    return digest
+
+  def _get_hash_safe(self, path, use_cache=True):
+    try:
+      return self.get_hash(path, use_cache)
+    except OSError:
+      return None
+
+  def hash_files(self, paths, workers=1, use_cache=True):
+    paths = list(paths)
+    if workers <= 1:
+      return {p: self._get_hash_safe(p, use_cache) for p in paths}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      digests = pool.map(lambda p: self._get_hash_safe(p, use_cache), paths)
+      return dict(zip(paths, digests))
+
+  def load(self, path):
+    with open(path, 'rb') as fh:
+      data = fh.read()
+    self.entries.clear()
+    for dev, ino, size, mtime, digest in self.s_record.iter_unpack(data):
+      self.entries[(dev, ino, size, mtime)] = digest.hex()
+
+  def save(self, path):
+    with self._lock:
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+      data = b''.join(self.s_record.pack(*key, bytes.fromhex(digest)) for key, digest in self.entries.items())
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as fh:
+      fh.write(data)
+    os.replace(temp_path, path)
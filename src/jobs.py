@@ -0,0 +1,247 @@
+import sys
+import logging
+import traceback
+from time import time, sleep
+from queue import Queue
+from threading import Thread, Event, Lock
+from contextvars import ContextVar
+from collections import deque
+from src.logger import init_logger
+
+logger = init_logger('jobs')
+
+# commands running in the background of the repl. every job runs on its own
+# thread and the job it belongs to is kept in a context variable, so threads
+# started with a copy of that context (the install pipeline) belong to it too.
+# output printed or logged from a job is kept in the job instead of the
+# terminal, cancelling is cooperative through checkpoint().
+_current = ContextVar('job', default=None)
+
+
+# not an Exception, the generic error handlers on its way up must not swallow it
+class JobCancelled(BaseException): pass
+
+
+def current_job():
+  return _current.get()
+
+
+def checkpoint():
+  # raises JobCancelled inside a cancelled job, a no-op everywhere else
+  job = _current.get()
+  if not job is None and job.cancelled.is_set():
+    raise JobCancelled('job {} cancelled'.format(job.id))
+
+
+# an attribute every job has its own value of, seeded when the job starts.
+# outside of jobs it is a plain instance attribute.
+class job_local:
+
+  def __set_name__(self, owner, name):
+    self.name = name
+    self.attr = '_' + name
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    job = _current.get()
+    if not job is None and self.name in job.locals:
+      return job.locals[self.name]
+    return obj.__dict__[self.attr]
+
+  def __set__(self, obj, value):
+    job = _current.get()
+    if not job is None and self.name in job.locals:
+      job.locals[self.name] = value
+    else:
+      obj.__dict__[self.attr] = value
+
+
+class JobOutput:
+
+  def __init__(self, stream):
+    self.stream = stream
+
+  def write(self, s):
+    job = _current.get()
+    if job is None:
+      return self.stream.write(s)
+    return job.write(s)
+
+  def flush(self):
+    if _current.get() is None:
+      self.stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+class Job:
+
+  max_lines = 2000
+
+  def __init__(self, job_id, command, fn, job_locals=None, sink=None, assume_yes=False):
+    self.id = job_id
+    self.command = command
+    self.fn = fn
+    self.locals = dict(job_locals or dict())
+    # called with every output line on a thread of its own, so a slow sink does
+    # not hold up writers. a sink raising OSError cancels the job
+    self.sink = sink
+    self._sink_queue = None if sink is None else Queue()
+    # a job has no prompt, confirmations fail unless it was started with --yes
+    self.assume_yes = assume_yes
+    self.state = 'running'
+    self.started = time()
+    self.ended = None
+    self.cancelled = Event()
+    self.finished = Event()
+    # callable describing how far the job is, set by the command it runs
+    self.progress = None
+    self.n_lines = 0
+    # lines already shown by wait
+    self.shown = 0
+    self.lines = deque(maxlen=self.max_lines)
+    self._partial = ''
+    self._lock = Lock()
+    self._thread = Thread(target=self._run, name='job-{}'.format(job_id), daemon=True)
+    self._sink_thread = None if sink is None else Thread(target=self._drain, name='job-{}-sink'.format(job_id), daemon=True)
+
+  def start(self):
+    if not self._sink_thread is None:
+      self._sink_thread.start()
+    self._thread.start()
+
+  def _drain(self):
+    while True:
+      line = self._sink_queue.get()
+      if line is None:
+        return
+      if self.sink is None:
+        continue
+      try:
+        self.sink(line)
+      except OSError:
+        self.sink = None
+        self.cancel()
+
+  def _run(self):
+    _current.set(self)
+    try:
+      self.fn()
+      self.state = 'cancelled' if self.cancelled.is_set() else 'done'
+    except JobCancelled:
+      self.state = 'cancelled'
+    except Exception:
+      self.write(traceback.format_exc())
+      self.state = 'failed'
+    finally:
+      self.ended = time()
+      with self._lock:
+        if self._partial:
+          self._append(self._partial)
+          self._partial = ''
+      # finished once the sink got every line
+      if not self._sink_thread is None:
+        self._sink_queue.put(None)
+        self._sink_thread.join()
+      self.finished.set()
+
+  def _append(self, line):
+    self.lines.append(line)
+    self.n_lines += 1
+    if not self._sink_queue is None:
+      self._sink_queue.put(line)
+
+  def write(self, s):
+    with self._lock:
+      lines = (self._partial + s).split('\n')
+      self._partial = lines.pop()
+      for line in lines:
+        self._append(line)
+    return len(s)
+
+  def tail(self, start=0):
+    # (lines from line number start on, next line number)
+    with self._lock:
+      first = self.n_lines - len(self.lines)
+      return list(self.lines)[max(0, start - first):], self.n_lines
+
+  @property
+  def elapsed(self):
+    return (self.ended or time()) - self.started
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def wait(self, timeout=None):
+    return self.finished.wait(timeout)
+
+
+class JobManager:
+
+  def __init__(self):
+    self.jobs: dict[int, Job] = dict()
+    self._next_id = 1
+    self._reported = set()
+    self._lock = Lock()
+    self._streams = list()
+
+  def install(self):
+    # route job output away from the terminal: stdout and the stream log handlers
+    sys.stdout = JobOutput(sys.stdout)
+    for name in list(logging.Logger.manager.loggerDict):
+      for handler in logging.getLogger(name).handlers:
+        if type(handler) is logging.StreamHandler and not isinstance(handler.stream, JobOutput):
+          self._streams.append((handler, handler.stream))
+          handler.setStream(JobOutput(handler.stream))
+
+  def uninstall(self):
+    if isinstance(sys.stdout, JobOutput):
+      sys.stdout = sys.stdout.stream
+    for handler, stream in self._streams:
+      handler.setStream(stream)
+    self._streams.clear()
+
+  def start(self, command, fn, job_locals=None, assume_yes=False):
+    with self._lock:
+      job = Job(self._next_id, command, fn, job_locals, assume_yes=assume_yes)
+      self._next_id += 1
+      self.jobs[job.id] = job
+    logger.info('starting job {}: {}'.format(job.id, command))
+    job.start()
+    return job
+
+  def get(self, job_id):
+    return self.jobs.get(job_id)
+
+  def running(self):
+    return [i for i in self.jobs.values() if not i.finished.is_set()]
+
+  def mark_reported(self, job):
+    with self._lock:
+      self._reported.add(job.id)
+
+  def newly_finished(self):
+    # finished jobs not reported yet, reported once
+    with self._lock:
+      jobs = [i for i in self.jobs.values() if i.finished.is_set() and not i.id in self._reported]
+      self._reported.update(i.id for i in jobs)
+    return jobs
+
+  def follow(self, job, start=0, poll=0.2):
+    # yields output lines of job until it finishes
+    while True:
+      checkpoint()
+      done = job.finished.is_set()
+      lines, start = job.tail(start)
+      yield from lines
+      if done:
+        return
+      sleep(poll)
+
+  def cancel_all(self, timeout=None):
+    for job in self.running():
+      job.cancel()
+    for job in self.running():
+      job.wait(timeout)
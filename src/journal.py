@@ -0,0 +1,90 @@
+import os
+import json
+from threading import RLock
+from time import time
+from src.logger import init_logger
+
+logger = init_logger('journal')
+
+# progress of the current install run. every resource moves through the
+# stages below and each step is written out before the next one starts, so an
+# interrupted install can continue where it stopped (install --resume).
+#
+# {"run": {"baseDir": ..., "staged": bool, "started": t, "finished": bool},
+#  "entries": {key: {"stage": ..., ...}}}
+class InstallJournal:
+
+  stages = ('resolved', 'downloaded', 'verified', 'extracted')
+
+  def __init__(self, path):
+    self.path = path
+    self.run = dict()
+    self.entries: dict[str, dict] = dict()
+    # install stages mark entries from several threads
+    self._lock = RLock()
+
+  @classmethod
+  def stage_index(cls, stage):
+    return -1 if stage is None else cls.stages.index(stage)
+
+  def load(self):
+    try:
+      with open(self.path, 'r') as fh:
+        d = json.load(fh)
+    except (OSError, ValueError):
+      return False
+    self.run = d.get('run', dict())
+    self.entries = d.get('entries', dict())
+    return True
+
+  def save(self):
+    temp_path = self.path + '.tmp'
+    with self._lock:
+      with open(temp_path, 'w') as fh:
+        json.dump({'run': self.run, 'entries': self.entries}, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+      os.replace(temp_path, self.path)
+
+  def begin(self, base_dir, staged):
+    self.run = {'baseDir': base_dir, 'staged': staged, 'started': time(), 'finished': False}
+    self.entries = dict()
+    self.save()
+
+  def resumable(self, base_dir):
+    return bool(self.run) and not self.run.get('finished') and self.run.get('baseDir') == base_dir
+
+  def finish(self):
+    self.run['finished'] = True
+    self.save()
+
+  def get(self, key):
+    return self.entries.get(key, dict())
+
+  def stage(self, key):
+    return self.get(key).get('stage')
+
+  def done(self, key, stage):
+    return self.stage_index(self.stage(key)) >= self.stage_index(stage)
+
+  def mark(self, key, stage, **fields):
+    with self._lock:
+      entry = self.entries.setdefault(key, dict())
+      entry.update(fields)
+      entry['stage'] = stage
+      self.save()
+
+  def rewind(self, stage):
+    # entries past stage fall back to it, e.g. when the placed files are gone
+    n = 0
+    for entry in self.entries.values():
+      if self.stage_index(entry.get('stage')) > self.stage_index(stage):
+        entry['stage'] = stage
+        n += 1
+    if n > 0:
+      logger.info('rewound {} journal entries to {}'.format(n, stage))
+      self.save()
+    return n
+
+  def count(self, stage):
+    return sum(1 for i in self.entries.values() if i.get('stage') == stage)
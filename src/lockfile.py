@@ -0,0 +1,93 @@
+import os
+import json
+from time import time
+from src.utils import HTTPUtils
+from src.logger import init_logger
+
+logger = init_logger('lockfile')
+
+# every selected plugin resource and addon pinned to the files it resolved to,
+# written next to the appinfo as <appinfo>.lock by the lock command. keys are
+# the install journal keys, so the selection of an appinfo maps onto it.
+#
+# {"version": 1, "platform": ..., "created": t,
+#  "entries": {key: {"url": ..., "files": [{"url", "finalUrl", "fileName",
+#    "fileType", "size", "contentType", "contentDisposition", "etag",
+#    "lastModified", "digest"}, ...]}}}
+class AppInfoLock:
+
+  version = 1
+  suffix = '.lock'
+
+  def __init__(self, path):
+    self.path = path
+    self.platform = None
+    self.created = None
+    self.entries: dict[str, dict] = dict()
+
+  @classmethod
+  def path_of(cls, info_file):
+    return os.path.splitext(info_file)[0] + cls.suffix
+
+  def load(self):
+    try:
+      with open(self.path, 'r') as fh:
+        d = json.load(fh)
+    except (OSError, ValueError):
+      return False
+    if d.get('version') != self.version:
+      logger.warning('unsupported lock version {}: {}'.format(d.get('version'), self.path))
+      return False
+    self.platform = d.get('platform')
+    self.created = d.get('created')
+    self.entries = d.get('entries', dict())
+    return True
+
+  def save(self):
+    self.created = time()
+    temp_path = self.path + '.tmp'
+    with open(temp_path, 'w') as fh:
+      json.dump({'version': self.version, 'platform': self.platform, 'created': self.created, 'entries': self.entries}, fh, indent=2)
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(temp_path, self.path)
+
+  def get(self, key):
+    return self.entries.get(key)
+
+  def add(self, key, url, files):
+    self.entries[key] = {'url': url, 'files': files}
+
+  def missing(self, keys):
+    return [i for i in keys if not i in self.entries]
+
+  def files(self, keys):
+    for key in keys:
+      yield from self.entries[key]['files']
+
+  @staticmethod
+  def file_entry(url, file_info, size, digest):
+    return {
+      'url': url,
+      'finalUrl': file_info.url or url,
+      'fileName': file_info.file_name,
+      'fileType': file_info.file_type,
+      'size': size,
+      'contentType': file_info.content_type,
+      'contentDisposition': file_info.content_disposition,
+      'etag': file_info.etag,
+      'lastModified': file_info.last_modified,
+      'digest': digest,
+    }
+
+  @staticmethod
+  def file_info(file_entry):
+    return HTTPUtils.file_info_t(file_entry['fileName'], file_entry['fileType'], file_entry['size'],
+      file_entry['contentDisposition'], file_entry['contentType'], file_entry['finalUrl'], file_entry['etag'], file_entry['lastModified'])
+
+  @staticmethod
+  def cached(file_entry, path, digest):
+    # digest is memoized by stat in ExtractCache, only new files get hashed
+    if not os.path.isfile(path) or os.path.getsize(path) != file_entry['size']:
+      return False
+    return digest(path) == file_entry['digest']
@@ -1,15 +1,22 @@
 import typing as t
-from collections import OrderedDict
+from itertools import islice
 
 class Node:
 
+  # sibling position and depth are fixed when a node is attached to its
+  # parent, so navigation stays O(1) on file tree sized hierarchies
+  __slots__ = ('_name', 'parent', 'children', 'data', '_index', '_depth')
+
   def __repr__(self):
     return f'{self.__class__.__name__}::[{self.name}] <- [{self.parent.name if not self.parent is None else "None"}]'
 
-  def __init__(self, name=None, parent=None):
+  def __init__(self, name=None, parent=None, data=None):
     self._name = name if not name is None else id(self)
     self.parent = parent
-    self.children = OrderedDict()
+    self.children = dict()
+    self.data = data
+    self._index = 0
+    self._depth = 0
     if not parent is None:
       parent.append_child(self)
 
@@ -27,9 +34,7 @@ class Node:
 
   @property
   def depth(self) -> int:
-    if self.is_root():
-      return 0
-    return len(list(self.iter_parent_node()))
+    return self._depth
 
   @property
   def nchild(self) -> int:
@@ -39,7 +44,7 @@ class Node:
   def atindex(self) -> int:
     if self.parent is None:
       return 0
-    return tuple(self.parent.children.keys()).index(self.name)
+    return self._index
 
   def is_leaf(self) -> bool:
     return len(self.children) == 0
@@ -66,6 +71,8 @@ class Node:
     if node.name in self.children:
       print('child name conflict:', node.name)
       return
+    node._index = len(self.children)
+    node._depth = self._depth + 1
     self.children[node.name] = node
 
   def iter_children(self) -> t.Generator["Node", None, None]:
@@ -73,12 +80,11 @@ class Node:
       yield node
 
   def recurse_children_node(self) -> t.Generator["Node", None, None]:
-    yield self
-    for node in self.iter_children():
-      if not node.is_leaf():
-        yield from node.recurse_children_node()
-      else:
-        yield node
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node.children.values()))
 
   def iter_parent_node(self) -> t.Generator["Node", None, None]:
     a = self
@@ -90,36 +96,42 @@ class Node:
     return self.children.get(name, None)
 
   def get_child_by_index(self, _index) -> "Node":
-    return self.get_child_by_name(list(self.children.keys())[_index])
-
-  def repr_tree(self, repr_callback=lambda x: x.name, stop_at_depth=None):
-    r = ''
-    r += '□ ' if self.is_leaf() else '■ '
-    r += repr_callback(self)
-    r += '\n'
-
+    if _index < 0:
+      _index += len(self.children)
+    return next(islice(self.children.values(), _index, None), None)
+
+  @staticmethod
+  def _repr_pad(node):
+    return '     ' if node.is_on_end() else ' ┆   '
+
+  def iter_repr_tree(self, repr_callback=lambda x: x.name, stop_at_depth=None):
+    # streams repr_tree line by line, iteratively, so deep and wide trees
+    # neither recurse nor rebuild ancestor prefixes for every child
+    yield ('□ ' if self.is_leaf() else '■ ') + repr_callback(self) + '\n'
     if not stop_at_depth is None and self.depth > stop_at_depth - 1:
-      return r
-
-    for child in self.iter_children():
-      spaces = list(
-          map(lambda x: int(x.is_on_end()),
-              filter(lambda y: not y.is_root() and y.name != child.name, child.iter_parent_node())
-          )
-      )
-      for space in reversed(spaces):
-        if space == 0:
-          r += ' ┆   '
-        else:
-          r += '     '
-      if child.is_on_beginning() and not child.is_root() and child.parent.nchild == 1:
-        r += '└───▸'
+      return
+    prefix = ''.join(self._repr_pad(i) for i in reversed(list(self.iter_parent_node())))
+    stack = [(prefix, iter(self.children.values()))]
+    while stack:
+      prefix, children = stack[-1]
+      child = next(children, None)
+      if child is None:
+        stack.pop()
+        continue
+      if child.is_on_beginning() and child.parent.nchild == 1:
+        connector = '└───▸'
       elif child.is_on_beginning():
-        r += '└┬──▸'
+        connector = '└┬──▸'
       elif child.is_on_end():
-        r += ' └──▸'
+        connector = ' └──▸'
       else:
-        r += ' ├──▸'
-      r += child.repr_tree(repr_callback=repr_callback, stop_at_depth=stop_at_depth)
+        connector = ' ├──▸'
+      yield prefix + connector + ('□ ' if child.is_leaf() else '■ ') + repr_callback(child) + '\n'
+      if child.is_leaf():
+        continue
+      if not stop_at_depth is None and child.depth > stop_at_depth - 1:
+        continue
+      stack.append((prefix + self._repr_pad(child), iter(child.children.values())))
 
-    return r
+  def repr_tree(self, repr_callback=lambda x: x.name, stop_at_depth=None):
+    return ''.join(self.iter_repr_tree(repr_callback=repr_callback, stop_at_depth=stop_at_depth))
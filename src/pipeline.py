@@ -0,0 +1,255 @@
+from time import perf_counter
+from queue import Queue
+from threading import Thread, Condition
+from collections import namedtuple
+from contextvars import copy_context
+from src.jobs import checkpoint, JobCancelled
+from src.logger import init_logger
+
+logger = init_logger('pipeline')
+
+# stages connected by bounded queues, every stage runs its own worker threads.
+# a stage returns False (or raises) to drop a job, the job then counts as
+# failed. the last stage is gated by order: a job enters it only once every
+# job submitted before it has left the pipeline, so it runs in submission
+# order whatever the timing of the earlier stages, which never wait on each
+# other. jobs are submitted grouped and sorted by group dependencies, a job
+# whose group depends on a failed group fails without entering it. workers
+# run in a copy of the caller's context. once the background job is cancelled
+# no more jobs are fed in, queued ones fail without running and run returns
+# with cancelled set.
+class StagePipeline:
+
+  t_stage = namedtuple('PipelineStage', ['name', 'run', 'workers'])
+  t_report = namedtuple('PipelineStageReport', ['name', 'workers', 'jobs', 'busy', 'blocked', 'utilization'])
+
+  class Job:
+
+    __slots__ = ('key', 'group', 'data', 'error', 'seq')
+
+    def __init__(self, key, group=None, data=None):
+      self.key = key
+      self.group = group
+      self.data = data
+      self.error = None
+      # submission order, set by run
+      self.seq = None
+
+  _done = object()
+
+  def __init__(self, stages, queue_size=4, depends=None):
+    self.stages = stages
+    self.queue_size = queue_size
+    # group -> groups that have to be fully placed first
+    self.depends = depends or dict()
+    self.failed = list()
+    self.wall = 0.0
+    self.cancelled = False
+    self.total = 0
+    self._cond = Condition()
+    self._remaining = dict()
+    self._failed_groups = set()
+    self._held = list()
+    self._gate_closed = False
+    # lowest seq still in the pipeline
+    self._low = 0
+    self._left = set()
+    self._stats = [{'jobs': 0, 'busy': 0.0, 'blocked': 0.0} for _ in stages]
+
+  @staticmethod
+  def find_cycle(depends):
+    # a list of groups forming a cycle, or None
+    state = dict()
+    def visit(group, path):
+      state[group] = 1
+      path.append(group)
+      for dep in depends.get(group, ()):
+        if state.get(dep) == 1:
+          return path[path.index(dep):] + [dep]
+        if state.get(dep) is None:
+          cycle = visit(dep, path)
+          if not cycle is None:
+            return cycle
+      path.pop()
+      state[group] = 2
+      return None
+    for group in depends:
+      if state.get(group) is None:
+        cycle = visit(group, list())
+        if not cycle is None:
+          return cycle
+    return None
+
+  @staticmethod
+  def order_jobs(jobs, depends):
+    # jobs grouped in order of first appearance, groups after the groups they depend on
+    groups = dict()
+    for job in jobs:
+      groups.setdefault(job.group, list()).append(job)
+    ordered = list()
+    visited = set()
+    def visit(group):
+      visited.add(group)
+      for dep in depends.get(group, ()):
+        if dep in groups and not dep in visited:
+          visit(dep)
+      ordered.extend(groups[group])
+    for group in groups:
+      if not group in visited:
+        visit(group)
+    return ordered
+
+  def _finish(self, job, ok):
+    with self._cond:
+      if not ok:
+        self.failed.append(job)
+        self._failed_groups.add(job.group)
+      self._remaining[job.group] -= 1
+      self._left.add(job.seq)
+      while self._low in self._left:
+        self._left.remove(self._low)
+        self._low += 1
+      self._cond.notify_all()
+
+  def _is_cancelled(self):
+    try:
+      checkpoint()
+    except JobCancelled:
+      self.cancelled = True
+    return self.cancelled
+
+  def _run_job(self, n, job):
+    stats = self._stats[n]
+    t0 = perf_counter()
+    try:
+      if self._is_cancelled():
+        job.error = 'cancelled'
+        ok = False
+      else:
+        ok = self.stages[n].run(job) is not False
+    except JobCancelled:
+      self.cancelled = True
+      job.error = 'cancelled'
+      ok = False
+    except Exception as e:
+      logger.error('{} failed in {}: {}'.format(job.key, self.stages[n].name, e))
+      job.error = str(e)
+      ok = False
+    with self._cond:
+      stats['busy'] += perf_counter() - t0
+      stats['jobs'] += 1
+    return ok
+
+  def _put(self, n, q, job):
+    t0 = perf_counter()
+    q.put(job)
+    with self._cond:
+      self._stats[n]['blocked'] += perf_counter() - t0
+
+  def _worker(self, n, q_in, q_out):
+    while True:
+      job = q_in.get()
+      if job is self._done:
+        # pass the sentinel on to the next worker of this stage
+        q_in.put(job)
+        return
+      if self._run_job(n, job):
+        self._put(n, q_out, job)
+      else:
+        self._finish(job, False)
+
+  def _gate(self, q_in):
+    while True:
+      job = q_in.get()
+      with self._cond:
+        if job is self._done:
+          self._gate_closed = True
+        else:
+          self._held.append(job)
+        self._cond.notify_all()
+      if job is self._done:
+        return
+
+  def _blocked_by(self, job):
+    # (ready, failed dependency)
+    for dep in self.depends.get(job.group, ()):
+      if dep in self._failed_groups:
+        return False, dep
+    return self._low == job.seq, None
+
+  def _last_worker(self, n):
+    while True:
+      with self._cond:
+        while True:
+          job = None
+          for held in self._held:
+            ready, failed_dep = self._blocked_by(held)
+            if ready or not failed_dep is None:
+              job = held
+              break
+          if not job is None:
+            self._held.remove(job)
+            break
+          if self._gate_closed and len(self._held) == 0:
+            return
+          self._cond.wait()
+      if not failed_dep is None:
+        job.error = 'dependency {} failed'.format(failed_dep)
+        ok = False
+      else:
+        ok = self._run_job(n, job)
+      self._finish(job, ok)
+
+  @staticmethod
+  def _thread(target, args, name):
+    # a context can only be entered by one thread at a time, one copy each
+    return Thread(target=copy_context().run, args=(target,) + args, name=name, daemon=True)
+
+  def run(self, jobs):
+    cycle = self.find_cycle(self.depends)
+    if not cycle is None:
+      raise ValueError('dependency cycle: {}'.format(' -> '.join(str(i) for i in cycle)))
+    t0 = perf_counter()
+    jobs = self.order_jobs(jobs, self.depends)
+    self.total = len(jobs)
+    for seq, job in enumerate(jobs):
+      job.seq = seq
+      self._remaining[job.group] = self._remaining.get(job.group, 0) + 1
+    last = len(self.stages) - 1
+    queues = [Queue(self.queue_size) for _ in self.stages]
+    threads = list()
+    for n, stage in enumerate(self.stages[:-1]):
+      for i in range(stage.workers):
+        threads.append((n, self._thread(self._worker, (n, queues[n], queues[n + 1]), '{}-{}'.format(stage.name, i))))
+    threads.append((last, self._thread(self._gate, (queues[last],), 'gate')))
+    for i in range(self.stages[last].workers):
+      threads.append((last, self._thread(self._last_worker, (last,), '{}-{}'.format(self.stages[last].name, i))))
+    for _, thread in threads:
+      thread.start()
+    for job in jobs:
+      if self._is_cancelled():
+        job.error = 'cancelled'
+        self._finish(job, False)
+        continue
+      queues[0].put(job)
+    # stages are shut down front to back once all their workers are done
+    for n in range(len(self.stages)):
+      queues[n].put(self._done)
+      for m, thread in threads:
+        if m == n:
+          thread.join()
+    self.wall = perf_counter() - t0
+    return len(self.failed) == 0
+
+  def progress(self):
+    with self._cond:
+      done = self.total - sum(self._remaining.values())
+      stages = ', '.join('{} {}'.format(stage.name, stats['jobs']) for stage, stats in zip(self.stages, self._stats))
+    return '{}/{} jobs finished ({}), {} failed'.format(done, self.total, stages, len(self.failed))
+
+  def report(self):
+    reports = list()
+    for stage, stats in zip(self.stages, self._stats):
+      capacity = stage.workers * self.wall
+      reports.append(self.t_report(stage.name, stage.workers, stats['jobs'], stats['busy'], stats['blocked'], stats['busy'] / capacity if capacity > 0 else 0.0))
+    return reports
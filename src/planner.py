@@ -0,0 +1,65 @@
+import os
+from collections import namedtuple
+from src.fstree import FileTree
+from src.utils import PathUtils
+
+# maps archive members of every selected resource onto their install path
+# before anything is extracted, so overlapping files can be reported up front
+class InstallPlanner:
+
+  t_placement = namedtuple('Placement', ['owner', 'source', 'size'])
+  t_conflict = namedtuple('Conflict', ['path', 'placements'])
+
+  def __init__(self):
+    self.index: dict[str, list] = dict()
+    self.owners = list()
+
+  @staticmethod
+  def normpath(path):
+    return os.path.normcase(os.path.normpath(path))
+
+  def add(self, owner, path, source, size=0):
+    key = self.normpath(path)
+    placements = self.index.setdefault(key, list())
+    placements.append(self.t_placement(owner, source, size))
+
+  def add_scan(self, owner, scan_infos, target_dir, include=None, exclude=None):
+    if not owner in self.owners:
+      self.owners.append(owner)
+    n = 0
+    for scan_info in scan_infos:
+      if scan_info.isdir:
+        continue
+      if not PathUtils.match_path_filters(scan_info.path, include, exclude):
+        continue
+      self.add(owner, os.path.join(target_dir, scan_info.path), scan_info.path, scan_info.size)
+      n += 1
+    return n
+
+  def add_archive(self, owner, archive_path, archive_type, target_dir, include=None, exclude=None):
+    if archive_type == 'zip':
+      scanner = FileTree.scan_zip_file
+    elif archive_type == 'tar':
+      scanner = FileTree.scan_tar_file
+    else:
+      raise ValueError('invalid archive type: {}'.format(archive_type))
+    return self.add_scan(owner, scanner(archive_path), target_dir, include, exclude)
+
+  def add_file(self, owner, path, size=0):
+    if not owner in self.owners:
+      self.owners.append(owner)
+    self.add(owner, path, os.path.basename(path), size)
+
+  def conflicts(self):
+    # same path placed by more than one owner, in install order
+    for path, placements in self.index.items():
+      if len(set(i.owner for i in placements)) > 1:
+        yield self.t_conflict(path, placements)
+
+  def existing(self, exists=os.path.lexists):
+    for path, placements in self.index.items():
+      if exists(path):
+        yield self.t_conflict(path, placements)
+
+  def count(self):
+    return len(self.index)
@@ -0,0 +1,61 @@
+import os
+import sys
+import struct
+import marshal
+from hashlib import sha1
+from src.logger import init_logger
+
+logger = init_logger('snapshot')
+
+# the built model of a json appinfo in marshal form, stored next to it as
+# <appinfo>.snapshot. the header pins the source path, size and mtime, and the
+# python version since the marshal format may change between releases.
+class AppInfoSnapshot:
+
+  magic = b'RSMSNAP3'
+  s_header = struct.Struct('<8sIQq20s')
+  suffix = '.snapshot'
+
+  @classmethod
+  def path_of(cls, source_path):
+    return source_path + cls.suffix
+
+  @classmethod
+  def key(cls, source_path, st):
+    path_digest = sha1(bytes(os.path.abspath(source_path), 'utf8'), usedforsecurity=False).digest()
+    return cls.s_header.pack(cls.magic, sys.hexversion, st.st_size, st.st_mtime_ns, path_digest)
+
+  @classmethod
+  def load(cls, source_path):
+    # model tuple, or None if there is no snapshot for this exact source
+    try:
+      st = os.stat(source_path)
+      with open(cls.path_of(source_path), 'rb') as fh:
+        data = fh.read()
+    except OSError:
+      return None
+    header = cls.key(source_path, st)
+    if data[:len(header)] != header:
+      logger.info('snapshot is stale: {}'.format(source_path))
+      return None
+    try:
+      return marshal.loads(memoryview(data)[len(header):])
+    except (EOFError, ValueError, TypeError) as e:
+      logger.warning('corrupt snapshot {}: {}'.format(cls.path_of(source_path), e))
+      return None
+
+  @classmethod
+  def save(cls, source_path, v):
+    # keyed on the source as it is on disk now, call right after writing it
+    path = cls.path_of(source_path)
+    temp_path = path + '.tmp'
+    try:
+      header = cls.key(source_path, os.stat(source_path))
+      with open(temp_path, 'wb') as fh:
+        fh.write(header)
+        fh.write(marshal.dumps(v))
+      os.replace(temp_path, path)
+    except OSError as e:
+      logger.warning('cannot write snapshot {}: {}'.format(path, e))
+      return False
+    return True
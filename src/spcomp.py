@@ -0,0 +1,112 @@
+import os
+import hashlib
+import tempfile
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import PathUtils
+from src.logger import init_logger
+
+logger = init_logger('spcomp')
+
+# compiles sourcepawn sources with the spcomp shipped in the installed
+# sourcemod package. compiles run in parallel subprocesses and every .smx is
+# cached by hash of source, compiler binary and include files.
+class SourcePawnCompiler:
+
+  t_job = namedtuple('CompileJob', ['name', 'source', 'output'])
+  t_result = namedtuple('CompileResult', ['job', 'ok', 'cached', 'log'])
+
+  compilers = {
+    'linux': ['spcomp64', 'spcomp'],
+    'windows': ['spcomp64.exe', 'spcomp.exe'],
+  }
+  buffer_size = 1 << 20
+
+  def __init__(self, spcomp, include_dirs, cache_dir, workers=1, timeout=120):
+    self.spcomp = spcomp
+    self.include_dirs = [i for i in include_dirs if os.path.isdir(i)]
+    self.cache_dir = cache_dir
+    self.workers = workers
+    self.timeout = timeout
+    self._compiler_digest = None
+
+  @classmethod
+  def locate(cls, path, platform, stop=None):
+    # searches path and its parents for <dir>/scripting or <dir>/addons/sourcemod/scripting
+    path = os.path.abspath(path)
+    stop = os.path.abspath(stop) if not stop is None else None
+    while True:
+      for scripting_dir in [os.path.join(path, 'scripting'), os.path.join(path, 'addons', 'sourcemod', 'scripting')]:
+        for name in cls.compilers.get(platform, []):
+          spcomp = os.path.join(scripting_dir, name)
+          if os.path.isfile(spcomp):
+            return spcomp
+      parent = os.path.dirname(path)
+      if parent == path or path == stop:
+        return None
+      path = parent
+
+  @classmethod
+  def hash_file(cls, h, path):
+    with open(path, 'rb') as fh:
+      while True:
+        b = fh.read(cls.buffer_size)
+        if not b:
+          break
+        h.update(b)
+
+  def compiler_digest(self):
+    # the compiler binary and a stat signature of the include files
+    if self._compiler_digest is None:
+      h = hashlib.sha256()
+      self.hash_file(h, self.spcomp)
+      for include_dir in self.include_dirs:
+        for root, dirs, files in os.walk(include_dir):
+          dirs.sort()
+          for f in sorted(files):
+            st = os.stat(os.path.join(root, f))
+            h.update(bytes('{}\0{}\0{}\0'.format(os.path.relpath(os.path.join(root, f), include_dir), st.st_size, st.st_mtime_ns), 'utf8'))
+      self._compiler_digest = h.hexdigest()
+    return self._compiler_digest
+
+  def cache_key(self, source):
+    h = hashlib.sha256()
+    self.hash_file(h, source)
+    h.update(bytes(self.compiler_digest(), 'ascii'))
+    return h.hexdigest()
+
+  def compile(self, job):
+    key = self.cache_key(job.source)
+    cached_path = os.path.join(self.cache_dir, key + '.smx')
+    os.makedirs(os.path.dirname(job.output), exist_ok=True)
+    # outputs may be hardlinked into a live tree or the extract cache, PathUtils.copy2 breaks the link
+    if os.path.isfile(cached_path):
+      PathUtils.copy2(cached_path, job.output)
+      return self.t_result(job, True, True, '')
+    os.makedirs(self.cache_dir, exist_ok=True)
+    # unique per compile, threads may compile the same source at once
+    fd, temp_path = tempfile.mkstemp(suffix='.smx.tmp', dir=self.cache_dir)
+    os.close(fd)
+    argv = [self.spcomp, job.source, '-o{}'.format(temp_path)] + ['-i{}'.format(i) for i in self.include_dirs]
+    try:
+      proc = subprocess.run(argv, cwd=os.path.dirname(self.spcomp), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+      if os.path.isfile(temp_path):
+        os.unlink(temp_path)
+      return self.t_result(job, False, False, str(e))
+    log = proc.stdout.decode('utf8', 'replace')
+    if proc.returncode != 0 or not os.path.isfile(temp_path) or os.path.getsize(temp_path) == 0:
+      if os.path.isfile(temp_path):
+        os.unlink(temp_path)
+      return self.t_result(job, False, False, log)
+    os.replace(temp_path, cached_path)
+    PathUtils.copy2(cached_path, job.output)
+    return self.t_result(job, True, False, log)
+
+  def compile_all(self, jobs):
+    self.compiler_digest()
+    if self.workers <= 1 or len(jobs) <= 1:
+      return [self.compile(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      return list(pool.map(self.compile, jobs))
@@ -0,0 +1,126 @@
+import os
+import shutil
+from src.logger import init_logger
+
+logger = init_logger('staging')
+
+# builds a new tree next to base_dir and swaps it in with rename.
+# the swap is two renames (live tree out, staging tree in), so it is not
+# atomic: a crash in between leaves no base_dir at all. recover() finishes an
+# interrupted commit or rollback and runs before anything touches the tree.
+# the staging tree is seeded with hardlinks to the live tree so untouched files
+# cost nothing; writers must break the link before writing (PathUtils.copy2),
+# otherwise the live file is modified through the shared inode.
+class StagedTree:
+
+  staging_suffix = '.staging'
+  snapshot_suffix = '.rollback'
+  swap_suffix = '.swap'
+
+  def __init__(self, base_dir):
+    self.base_dir = os.path.normpath(os.path.abspath(base_dir))
+    self.staging_dir = self.base_dir + self.staging_suffix
+    self.snapshot_dir = self.base_dir + self.snapshot_suffix
+    self._swap_dir = self.base_dir + self.swap_suffix
+
+  @staticmethod
+  def link_tree(src, dst):
+    n_link = 0
+    n_copy = 0
+    os.makedirs(dst, exist_ok=True)
+    for root, dirs, files in os.walk(src):
+      rel_root = os.path.join(dst, os.path.relpath(root, src))
+      for d in dirs:
+        os.makedirs(os.path.join(rel_root, d), exist_ok=True)
+      for f in files:
+        src_file = os.path.join(root, f)
+        dst_file = os.path.join(rel_root, f)
+        if os.path.islink(src_file):
+          os.symlink(os.readlink(src_file), dst_file)
+          continue
+        try:
+          os.link(src_file, dst_file)
+          n_link += 1
+        except OSError:
+          shutil.copy2(src_file, dst_file)
+          n_copy += 1
+    return n_link, n_copy
+
+  @staticmethod
+  def _rmtree(path):
+    if os.path.lexists(path):
+      shutil.rmtree(path)
+
+  def has_snapshot(self):
+    return os.path.isdir(self.snapshot_dir)
+
+  def remap(self, path):
+    # paths outside base_dir are returned as is
+    path = os.path.normpath(os.path.abspath(path))
+    if path == self.base_dir or path.startswith(self.base_dir + os.sep):
+      return self.staging_dir + path[len(self.base_dir):]
+    return path
+
+  def prepare(self):
+    self._rmtree(self.staging_dir)
+    if os.path.isdir(self.base_dir):
+      n_link, n_copy = self.link_tree(self.base_dir, self.staging_dir)
+      logger.info('seeded staging tree: {} linked, {} copied'.format(n_link, n_copy))
+    else:
+      os.makedirs(self.staging_dir)
+    return self.staging_dir
+
+  def recover(self):
+    # returns what was recovered, None when no swap was interrupted
+    if os.path.isdir(self.base_dir):
+      if os.path.isdir(self._swap_dir) and not self.has_snapshot():
+        # rollback stopped before keeping the replaced tree as the snapshot
+        os.rename(self._swap_dir, self.snapshot_dir)
+        return 'finished interrupted rollback'
+      return None
+    if os.path.isdir(self._swap_dir):
+      if self.has_snapshot():
+        # rollback stopped after moving the live tree away
+        os.rename(self.snapshot_dir, self.base_dir)
+        os.rename(self._swap_dir, self.snapshot_dir)
+        return 'finished interrupted rollback'
+      os.rename(self._swap_dir, self.base_dir)
+      return 'restored live tree of an interrupted rollback'
+    if self.has_snapshot():
+      if os.path.isdir(self.staging_dir):
+        # commit stopped after moving the live tree away, staging is complete
+        os.rename(self.staging_dir, self.base_dir)
+        return 'finished interrupted swap'
+      os.rename(self.snapshot_dir, self.base_dir)
+      return 'restored previous tree'
+    return None
+
+  def abort(self):
+    logger.info('discarding staging tree: {}'.format(self.staging_dir))
+    self._rmtree(self.staging_dir)
+
+  def commit(self):
+    if not os.path.isdir(self.staging_dir):
+      raise FileNotFoundError('staging tree does not exist: {}'.format(self.staging_dir))
+    self._rmtree(self.snapshot_dir)
+    if os.path.isdir(self.base_dir):
+      os.rename(self.base_dir, self.snapshot_dir)
+    try:
+      os.rename(self.staging_dir, self.base_dir)
+    except OSError:
+      if os.path.isdir(self.snapshot_dir):
+        os.rename(self.snapshot_dir, self.base_dir)
+      raise
+    logger.info('swapped staging tree into {}'.format(self.base_dir))
+
+  def rollback(self):
+    # swaps live tree and snapshot, so a second rollback undoes the first
+    if not self.has_snapshot():
+      raise FileNotFoundError('no snapshot to roll back to: {}'.format(self.snapshot_dir))
+    self._rmtree(self._swap_dir)
+    if os.path.isdir(self.base_dir):
+      os.rename(self.base_dir, self._swap_dir)
+    os.rename(self.snapshot_dir, self.base_dir)
+    if os.path.isdir(self._swap_dir):
+      os.rename(self._swap_dir, self.snapshot_dir)
+    logger.info('rolled back {}'.format(self.base_dir))
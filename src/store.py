@@ -0,0 +1,383 @@
+import os
+import gc
+import json
+import sqlite3
+from threading import Lock
+from src.appinfo import SteamAppInfo, sSteamAppInfoEntPlugin, sSteamAppInfoEntResource, sSteamAppInfoEntAddon
+from src.snapshot import AppInfoSnapshot
+from src.logger import init_logger
+
+logger = init_logger('store')
+
+# appinfo storage backends. saving is split in two steps so the model is only
+# read while the caller holds its lock: snapshot() collects what has to be
+# written, write() does the io afterwards. load() returns what it loaded from.
+class JsonAppInfoStore:
+
+  def __init__(self, path, use_snapshot=True):
+    self.path = path
+    self.use_snapshot = use_snapshot
+
+  def load(self, appinfo):
+    if self.use_snapshot:
+      # the collector would walk the young objects over and over while
+      # tens of thousands of entities are allocated in one go
+      gc_enabled = gc.isenabled()
+      gc.disable()
+      try:
+        v = AppInfoSnapshot.load(self.path)
+        if not v is None:
+          appinfo.from_tuple(v)
+          return 'snapshot'
+      finally:
+        if gc_enabled:
+          gc.enable()
+    with open(self.path, 'r') as fh:
+      appinfo.from_dict(json.load(fh))
+    if self.use_snapshot:
+      AppInfoSnapshot.save(self.path, appinfo.to_tuple())
+    return 'json'
+
+  @staticmethod
+  def write_json(path, d):
+    # temp file, fsync, rename: a crash leaves either the old or the new file
+    path = os.path.abspath(path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as fh:
+      json.dump(d, fh, indent=2)
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(temp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+      fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+
+  def snapshot(self, appinfo):
+    appinfo.take_changes()
+    return appinfo.to_dict(), appinfo.to_tuple() if self.use_snapshot else None
+
+  def write(self, batch):
+    d, v = batch
+    self.write_json(self.path, d)
+    if not v is None:
+      AppInfoSnapshot.save(self.path, v)
+
+  def close(self):
+    pass
+
+
+# config, plugins, resources and addons tables. plugins and addons are loaded
+# on first access and find() on a kind that is not loaded runs as sql, so
+# startup does not depend on the catalog size. saves only touch the rows of
+# entities changed since the last save.
+class SqliteAppInfoStore:
+
+  schema = '''
+    create table if not exists config (
+      id integer primary key check (id = 0),
+      uid text, name text, app_id text, app_id_ds text, base_dir text, workshop_dir text, platform text
+    );
+    create table if not exists plugins (
+      id integer primary key, position integer not null,
+      uid text, name text, exclude integer, rel text, depends_on text
+    );
+    create table if not exists resources (
+      id integer primary key, plugin_id integer not null references plugins(id) on delete cascade,
+      position integer not null, uid text, name text, exclude integer, platform text, url text,
+      rel text, target_path text, type text, include_paths text, exclude_paths text
+    );
+    create table if not exists addons (
+      id integer primary key, position integer not null,
+      uid text, name text, exclude integer, url text, workshop_id text
+    );
+    create index if not exists plugins_position on plugins (position);
+    create index if not exists plugins_uid on plugins (uid);
+    create index if not exists plugins_name on plugins (name collate nocase);
+    create index if not exists resources_plugin on resources (plugin_id, position);
+    create index if not exists resources_url on resources (url);
+    create index if not exists resources_platform on resources (platform);
+    create index if not exists addons_position on addons (position);
+    create index if not exists addons_uid on addons (uid);
+    create index if not exists addons_name on addons (name collate nocase);
+    create index if not exists addons_url on addons (url);
+    create index if not exists addons_workshop on addons (workshop_id);
+  '''
+
+  plugin_columns = 'id, position, name, exclude, rel, depends_on'
+  resource_columns = 'plugin_id, position, uid, name, exclude, platform, url, rel, target_path, type, include_paths, exclude_paths'
+  addon_columns = 'id, position, name, exclude, url'
+
+  # query field -> sql condition, ? is the value
+  conditions = {
+    'plugins': {
+      'uid': 'p.uid = ?',
+      'name': 'p.name = ? collate nocase',
+      'url': 'exists (select 1 from resources r where r.plugin_id = p.id and r.url = ?)',
+      'platform': 'exists (select 1 from resources r where r.plugin_id = p.id and r.platform = ?)',
+      'exclude': 'p.exclude = ?',
+    },
+    'addons': {
+      'uid': 'p.uid = ?',
+      'name': 'p.name = ? collate nocase',
+      'url': 'p.url = ?',
+      'workshop': 'p.workshop_id = ?',
+      'exclude': 'p.exclude = ?',
+    },
+  }
+  glob_conditions = {
+    'plugins': {
+      'uid': 'p.uid glob ?',
+      'name': 'lower(p.name) glob ?',
+      'url': 'exists (select 1 from resources r where r.plugin_id = p.id and r.url glob ?)',
+      'platform': 'exists (select 1 from resources r where r.plugin_id = p.id and r.platform glob ?)',
+    },
+    'addons': {
+      'uid': 'p.uid glob ?',
+      'name': 'lower(p.name) glob ?',
+      'url': 'p.url glob ?',
+      'workshop': 'p.workshop_id glob ?',
+    },
+  }
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute('pragma foreign_keys = on')
+    self.db.execute('pragma journal_mode = wal')
+    self.db.executescript(self.schema)
+    self.migrate()
+    self.positions = {kind: dict() for kind in SteamAppInfo.kinds}
+    self.next_row = {kind: self._max_row(kind) + 1 for kind in SteamAppInfo.kinds}
+
+  def migrate(self):
+    # columns added after the first release of the schema
+    columns = [i[1] for i in self.db.execute('pragma table_info(plugins)')]
+    if not 'depends_on' in columns:
+      self.db.execute('alter table plugins add column depends_on text')
+    columns = [i[1] for i in self.db.execute('pragma table_info(config)')]
+    if not 'platform' in columns:
+      self.db.execute('alter table config add column platform text')
+
+  def _max_row(self, kind):
+    return self.db.execute('select coalesce(max(id), 0) from {}'.format(kind)).fetchone()[0]
+
+  def close(self):
+    with self._lock:
+      self.db.close()
+
+  @staticmethod
+  def parse_list(v):
+    return json.loads(v) if v else []
+
+  def read_resources(self, plugin_ids):
+    # plugin id -> resources, ordered
+    resources = {i: list() for i in plugin_ids}
+    ids = list(plugin_ids)
+    for start in range(0, len(ids), 500):
+      chunk = ids[start:start + 500]
+      rows = self.db.execute(
+        'select {} from resources where plugin_id in ({}) order by plugin_id, position'.format(self.resource_columns, ','.join('?' * len(chunk))),
+        chunk,
+      )
+      for plugin_id, _, _, name, exclude, platform, url, rel, target_path, resource_type, include_paths, exclude_paths in rows:
+        resource = sSteamAppInfoEntResource()
+        resource.from_dict({
+          'name': name, 'exclude': bool(exclude), 'platform': platform, 'url': url, 'rel': rel,
+          'targetPath': target_path, 'type': resource_type,
+          'includePaths': self.parse_list(include_paths), 'excludePaths': self.parse_list(exclude_paths),
+        })
+        resources[plugin_id].append(resource)
+    return resources
+
+  def make_plugins(self, rows):
+    rows = list(rows)
+    resources = self.read_resources([i[0] for i in rows])
+    entries = list()
+    for row, position, name, exclude, rel, depends_on in rows:
+      plugin = sSteamAppInfoEntPlugin()
+      plugin.name = name
+      plugin.exclude = bool(exclude)
+      plugin.rel = rel
+      plugin.depends_on = self.parse_list(depends_on)
+      plugin.resources = resources[row]
+      plugin._row = row
+      entries.append((position, plugin))
+    return entries
+
+  @staticmethod
+  def make_addons(rows):
+    entries = list()
+    for row, position, name, exclude, url in rows:
+      addon = sSteamAppInfoEntAddon()
+      addon.name = name
+      addon.exclude = bool(exclude)
+      addon.url = url
+      addon._row = row
+      entries.append((position, addon))
+    return entries
+
+  def load_kind(self, kind):
+    with self._lock:
+      if kind == 'plugins':
+        rows = self.db.execute('select {} from plugins order by position'.format(self.plugin_columns))
+        entries = self.make_plugins(rows)
+      else:
+        rows = self.db.execute('select {} from addons order by position'.format(self.addon_columns))
+        entries = self.make_addons(rows)
+    self.positions[kind] = {ent._row: position for position, ent in entries}
+    logger.info('loaded {} {}'.format(len(entries), kind))
+    return [ent for _, ent in entries]
+
+  def load(self, appinfo):
+    with self._lock:
+      row = self.db.execute('select name, app_id, app_id_ds, base_dir, workshop_dir, platform from config where id = 0').fetchone()
+    if not row is None:
+      name, app_id, app_id_ds, base_dir, workshop_dir, platform = row
+      appinfo.config.from_dict({
+        'name': name, 'appId': app_id, 'appIdDedicatedServer': app_id_ds, 'baseDir': base_dir, 'workshopDir': workshop_dir,
+        'platform': platform,
+      })
+    for kind in SteamAppInfo.kinds:
+      appinfo.loaders[kind] = lambda kind=kind: self.load_kind(kind)
+    appinfo.store = self
+    return 'sqlite'
+
+  def find(self, kind, conditions):
+    # same semantics as SteamAppInfo.find, answered by the sql indexes
+    where = list()
+    args = list()
+    for field, value in conditions:
+      if field == 'exclude':
+        where.append(self.conditions[kind][field])
+        args.append(1 if value.lower() in ('1', 'true', 'yes', 'y') else 0)
+      elif any(c in value for c in '*?['):
+        where.append(self.glob_conditions[kind][field])
+        args.append(value.lower() if field == 'name' else value)
+      else:
+        where.append(self.conditions[kind][field])
+        args.append(value)
+    columns = self.plugin_columns if kind == 'plugins' else self.addon_columns
+    sql = 'select {} from {} p'.format(', '.join('p.' + i.strip() for i in columns.split(',')), kind)
+    if where:
+      sql += ' where ' + ' and '.join(where)
+    sql += ' order by p.position'
+    with self._lock:
+      rows = self.db.execute(sql, args)
+      if kind == 'plugins':
+        return self.make_plugins(rows)
+      return self.make_addons(rows)
+
+  # saving
+
+  @staticmethod
+  def config_row(config):
+    return (config.uid, config.name, config.appid, config.appid_ds, config.base_dir, config.workshop_dir, config.platform)
+
+  @staticmethod
+  def plugin_row(plugin, position):
+    return (plugin._row, position, plugin.uid, plugin.name, int(plugin.exclude), plugin.rel, json.dumps(plugin.depends_on))
+
+  @staticmethod
+  def resource_rows(plugin):
+    return [
+      (plugin._row, n, i.uid, i.name, int(i.exclude), i.platform, i.url, i.rel, i.target_path, i.resource_type,
+       json.dumps(i.include_paths), json.dumps(i.exclude_paths))
+      for n, i in enumerate(plugin.resources)
+    ]
+
+  @staticmethod
+  def addon_row(addon, position):
+    return (addon._row, position, addon.uid, addon.name, int(addon.exclude), addon.url, addon.workshop_id)
+
+  def snapshot(self, appinfo):
+    # rows to write, collected under the model lock. row ids are handed out
+    # here so an entity edited again before write() keeps its id.
+    changed, removed, replaced, moved = appinfo.take_changes()
+    batch = {'config': None, 'clear': set(replaced), 'delete': {kind: list() for kind in appinfo.kinds}, 'upsert': {kind: list() for kind in appinfo.kinds}, 'resources': list(), 'positions': {kind: list() for kind in appinfo.kinds}}
+    for ent in removed:
+      kind = appinfo.kind_of(ent)
+      if not kind in replaced and not ent._row is None:
+        batch['delete'][kind].append(ent._row)
+        self.positions[kind].pop(ent._row, None)
+        ent._row = None
+    for kind in replaced:
+      self.positions[kind] = dict()
+      self.next_row[kind] = 1
+      for ent in appinfo.items(kind):
+        ent._row = None
+    upserted = set()
+    for ent in changed:
+      if ent is appinfo.config:
+        batch['config'] = self.config_row(ent)
+        continue
+      if ent._owner is None:
+        continue
+      kind = appinfo.kind_of(ent)
+      if kind in replaced:
+        continue
+      self.upsert(batch, kind, ent, appinfo.position(ent))
+      upserted.add(id(ent))
+    for kind in replaced:
+      for position, ent in enumerate(appinfo.items(kind)):
+        self.upsert(batch, kind, ent, position)
+    for kind in moved - replaced:
+      if not appinfo.loaded(kind):
+        continue
+      positions = self.positions[kind]
+      for position, ent in enumerate(appinfo.items(kind)):
+        if id(ent) in upserted or ent._row is None:
+          continue
+        if positions.get(ent._row) != position:
+          positions[ent._row] = position
+          batch['positions'][kind].append((position, ent._row))
+    return batch
+
+  def upsert(self, batch, kind, ent, position):
+    if ent._row is None:
+      ent._row = self.next_row[kind]
+      self.next_row[kind] += 1
+    self.positions[kind][ent._row] = position
+    if kind == 'plugins':
+      batch['upsert'][kind].append(self.plugin_row(ent, position))
+      batch['resources'].append((ent._row, self.resource_rows(ent)))
+    else:
+      batch['upsert'][kind].append(self.addon_row(ent, position))
+
+  def write(self, batch):
+    with self._lock, self.db:
+      if not batch['config'] is None:
+        self.db.execute('insert or replace into config values (0, ?, ?, ?, ?, ?, ?, ?)', batch['config'])
+      for kind in batch['clear']:
+        if kind == 'plugins':
+          self.db.execute('delete from resources')
+        self.db.execute('delete from {}'.format(kind))
+      for kind, rows in batch['delete'].items():
+        if kind == 'plugins':
+          self.db.executemany('delete from resources where plugin_id = ?', [(i,) for i in rows])
+        self.db.executemany('delete from {} where id = ?'.format(kind), [(i,) for i in rows])
+      # positions are not unique, rows can be written in any order
+      self.db.executemany('insert or replace into plugins values (?, ?, ?, ?, ?, ?, ?)', batch['upsert']['plugins'])
+      self.db.executemany('insert or replace into addons values (?, ?, ?, ?, ?, ?, ?)', batch['upsert']['addons'])
+      for plugin_id, rows in batch['resources']:
+        self.db.execute('delete from resources where plugin_id = ?', (plugin_id,))
+        self.db.executemany('insert into resources ({}) values ({})'.format(self.resource_columns, ','.join('?' * 12)), rows)
+      for kind, rows in batch['positions'].items():
+        self.db.executemany('update {} set position = ? where id = ?'.format(kind), rows)
+
+
+stores = {
+  'json': JsonAppInfoStore,
+  'db': SqliteAppInfoStore,
+  'sqlite': SqliteAppInfoStore,
+  'sqlite3': SqliteAppInfoStore,
+}
+
+def open_store(path):
+  ext = os.path.splitext(path)[1][1:].lower()
+  if not ext in stores:
+    raise ValueError('unsupported appinfo file: {}'.format(path))
+  return stores[ext](path)
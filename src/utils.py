@@ -6,20 +6,33 @@ import tempfile
 import tarfile
 import functools
 import re
-from zipfile import ZipFile
+from fnmatch import fnmatchcase
+from zipfile import ZipFile, BadZipFile
 from io import IOBase
 from src.logger import init_logger
+from src.jobs import checkpoint
 from urllib.parse import urlparse, parse_qs
 from collections import namedtuple, deque
 from time import time
+from threading import Lock
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 logger = init_logger('utils')
 
 class PathUtils:
 
   join = os.path.join
+  abspath = os.path.abspath
+  normpath = os.path.normpath
+  lexists = os.path.lexists
+  sep = os.sep
   basename = os.path.basename
   dirname = os.path.dirname
+  relpath = os.path.relpath
 
   @staticmethod
   def isdir(path):
@@ -79,8 +92,49 @@ class PathUtils:
   @classmethod
   def copy2(cls, src, dst):
     cls.ensure_dir(os.path.dirname(dst))
+    # never write through a hardlink shared with another tree (staged installs)
+    if os.path.isfile(dst) and os.stat(dst).st_nlink > 1:
+      os.unlink(dst)
     return shutil.copy2(src, dst)
 
+  ficlone = 0x40049409
+
+  @classmethod
+  def reflink(cls, src, dst):
+    # a copy sharing the extents of src until either is written, btrfs and xfs
+    if fcntl is None:
+      raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as fh_src, open(dst, 'wb') as fh_dst:
+      fcntl.ioctl(fh_dst.fileno(), cls.ficlone, fh_src.fileno())
+
+  @classmethod
+  def place_file(cls, src, dst, link=False, reflink=False):
+    # 'skipped' when dst matches src by size and mtime. hardlinks share the
+    # file with src, reflinks do not, both fall back to copies where unsupported
+    try:
+      st_src = os.stat(src)
+      st_dst = os.stat(dst)
+      if st_dst.st_size == st_src.st_size and st_dst.st_mtime_ns == st_src.st_mtime_ns:
+        return 'skipped'
+    except FileNotFoundError:
+      pass
+    if link or reflink:
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+      temp_path = dst + '.link'
+      try:
+        if link:
+          os.link(src, temp_path)
+        else:
+          cls.reflink(src, temp_path)
+          shutil.copystat(src, temp_path)
+        os.replace(temp_path, dst)
+        return 'linked' if link else 'reflinked'
+      except OSError:
+        if os.path.lexists(temp_path):
+          os.unlink(temp_path)
+    cls.copy2(src, dst)
+    return 'copied'
+
   @classmethod
   def copy2_r(cls, src, dst):
     for root, dirs, files, in os.walk(src):
@@ -96,6 +150,49 @@ class PathUtils:
         if not d_dst is None:
           print('> {}'.format(d_dst))
 
+  @staticmethod
+  def match_path_filters(path, include=None, exclude=None):
+    # glob patterns match against the archive member path, "*" also matches "/"
+    path = path.replace('\\', '/')
+    if path.startswith('./'):
+      path = path[2:]
+    if include and not any(fnmatchcase(path, p) for p in include):
+      return False
+    if exclude and any(fnmatchcase(path, p) for p in exclude):
+      return False
+    return True
+
+  @classmethod
+  def archive_unpack_zip(cls, path, dst, include=None, exclude=None):
+    with ZipFile(path) as zh:
+      members = None
+      if include or exclude:
+        members = [i for i in zh.infolist() if cls.match_path_filters(i.filename, include, exclude)]
+      zh.extractall(dst, members)
+
+  @classmethod
+  def archive_unpack_tar(cls, path, dst, include=None, exclude=None):
+    with tarfile.open(path, mode='r') as th:
+      members = None
+      if include or exclude:
+        members = [i for i in th if cls.match_path_filters(i.name, include, exclude)]
+      th.extractall(dst, members)
+
+  @staticmethod
+  def archive_check(path, archive_type):
+    # reads the whole archive once, truncated downloads fail here
+    try:
+      if archive_type == 'zip':
+        with ZipFile(path) as zh:
+          return zh.testzip() is None
+      elif archive_type == 'tar':
+        with tarfile.open(path, mode='r') as th:
+          th.getmembers()
+    except (OSError, EOFError, tarfile.TarError, BadZipFile) as e:
+      logger.warning('corrupt archive {}: {}'.format(path, e))
+      return False
+    return True
+
   @classmethod
   def archive_extract_zip(cls, path, dst, tmpdir=None):
     if tmpdir is None:
@@ -103,9 +200,8 @@ class PathUtils:
     else:
       d_zip_tempdir = lambda: None
       zip_tempdir = tmpdir
-    with ZipFile(path) as zh:
-      zh.extractall(zip_tempdir)
-      cls.copy2_r(zip_tempdir, dst)
+    cls.archive_unpack_zip(path, zip_tempdir)
+    cls.copy2_r(zip_tempdir, dst)
     if tmpdir is None:
       d_zip_tempdir()
     else:
@@ -114,13 +210,12 @@ class PathUtils:
   @classmethod
   def archive_extract_tar(cls, path, dst, tmpdir=None):
     if tmpdir is None:
-      tar_tempdir, d_tar_tempdir = mkdtemp()
+      tar_tempdir, d_tar_tempdir = cls.mkdtemp()
     else:
       d_tar_tempdir = lambda: None
       tar_tempdir = tmpdir
-    with tarfile.open(path, mode='r') as th:
-      th.extractall(tar_tempdir)
-      cls.copy2_r(tar_tempdir, dst)
+    cls.archive_unpack_tar(path, tar_tempdir)
+    cls.copy2_r(tar_tempdir, dst)
     if tmpdir is None:
       d_tar_tempdir()
     else:
@@ -131,7 +226,12 @@ class HTTPUtils:
 
   class RetryableConnectionError(requests.exceptions.HTTPError): pass
 
-  file_info_t = namedtuple("FileInfo", field_names=['file_name', 'file_type',  'file_size', 'content_disposition', 'content_type'])
+  # url is the final url after redirects, etag and last_modified its validators
+  file_info_t = namedtuple("FileInfo", field_names=['file_name', 'file_type',  'file_size', 'content_disposition', 'content_type', 'url', 'etag', 'last_modified'], defaults=(None, None, None))
+
+  # one writer per download path, concurrent jobs may resolve to the same file
+  _path_locks = dict()
+  _path_locks_lock = Lock()
   
   @staticmethod
   def new_session(request_headers=None) -> requests.Session:
@@ -152,6 +252,8 @@ class HTTPUtils:
     for i_retry in range(1, max_retry + 1):
       for i_depth in range(max_depth):
         try:
+          # cancelled background jobs stop at their next request
+          checkpoint()
           resp = session.request(method, url, **kwargs)
           if resp.status_code == 301 or resp.status_code == 302:
             url = resp.headers.get('location')
@@ -189,6 +291,7 @@ class HTTPUtils:
       content_length = int(resp.headers.get('content-length', 0))
     try:
       for b in resp.iter_content(chunk_size):
+        checkpoint()
         buf.write(b)
         bl = len(b)
         total_l += bl
@@ -254,7 +357,17 @@ class HTTPUtils:
     _, _, file_type = PathUtils.extract_file_type(file_name)
     content_type = cls.parse_headers_content_type(headers)
     content_length = cls.parse_headers_content_length(headers)
-    return cls.file_info_t(file_name, file_type, content_length, content_disposition, content_type)
+    return cls.file_info_t(file_name, file_type, content_length, content_disposition, content_type, url, headers.get('etag'), headers.get('last-modified'))
+
+  @staticmethod
+  def source_url(url):
+    # sourcemod.net/vbcompiler.php?file_id=N compiles forum attachment N remotely
+    parsed_url = urlparse(url)
+    if parsed_url.path.endswith('vbcompiler.php'):
+      file_ids = parse_qs(parsed_url.query).get('file_id')
+      if file_ids:
+        return 'https://forums.alliedmods.net/attachment.php?attachmentid={}'.format(file_ids[0])
+    return url
 
   @classmethod
   def parse_workshop_ids(cls, string):
@@ -270,6 +383,11 @@ class HTTPUtils:
       logger.warning('missing query id on url: {}'.format(string))
     return list(ids)
 
+  @classmethod
+  def path_lock(cls, path):
+    with cls._path_locks_lock:
+      return cls._path_locks.setdefault(os.path.abspath(path), Lock())
+
   @classmethod
   def download_file(cls, session, url, dst_dir, file_name='', chunk_size=4096, head_err_max_retry=5):
     logger.info('retrieving file info: {}'.format(url))
@@ -286,33 +404,56 @@ class HTTPUtils:
 
     PathUtils.ensure_dir(dst_dir)
 
-    file_info = cls.parse_file_info(resp.headers, url)
+    file_info = cls.parse_file_info(resp.headers, url)._replace(url=resp.url)
     dst_path = os.path.join(dst_dir, file_info.file_name)
-    if PathUtils.isfile(dst_path):
-      if os.path.getsize(dst_path) != file_info.file_size:
-        logger.info('file size did not match, redownloading: {}'.format(dst_path))
+    # checked again under the lock, another job may have just written it.
+    # unfinished files are removed here too, not by the caller, so nobody
+    # deletes a file that another job already writes again
+    with cls.path_lock(dst_path):
+      if PathUtils.isfile(dst_path):
+        if os.path.getsize(dst_path) != file_info.file_size:
+          logger.info('file size did not match, redownloading: {}'.format(dst_path))
+          os.unlink(dst_path)
+        else:
+          logger.info('file already exists: {}'.format(dst_path))
+          resp.close()
+          return True, dst_path, file_info
+
+      if not skip_get_request:
+        resp = cls.http_request(session, 'GET', url, stream=True, allow_redirects=False)
+
+      if resp is None:
+        logger.error('unable to retrieve GET request')
+        return False, None, file_info
+
+      logger.info('downloading to {}'.format(dst_path))
+      with open(dst_path, 'wb') as fh:
+        status = cls.stream_to_buf(resp, fh, content_length=file_info.file_size)
+      resp.close()
+      if not status:
+        logger.warning('destroying unfinished file: {}'.format(dst_path))
         os.unlink(dst_path)
-      else:
-        logger.info('file already exists: {}'.format(dst_path))
-        resp.close()
-        return True, dst_path, file_info
+        return False, None, file_info
 
-    if not skip_get_request:
-      resp = cls.http_request(session, 'GET', url, stream=True, allow_redirects=False)
+    return status, dst_path, file_info
 
+  @classmethod
+  def fetch_file(cls, session, url, dst_path, file_size=0):
+    # plain GET of an already resolved url, without the HEAD round trip
+    resp = cls.http_request(session, 'GET', url, stream=True, allow_redirects=False)
     if resp is None:
       logger.error('unable to retrieve GET request')
-      return False, dst_path, file_info
-    
+      return False
+    PathUtils.ensure_dir(os.path.dirname(dst_path))
     logger.info('downloading to {}'.format(dst_path))
     with open(dst_path, 'wb') as fh:
-      status = cls.stream_to_buf(resp, fh, content_length=file_info.file_size)
+      status = cls.stream_to_buf(resp, fh, content_length=file_size)
     resp.close()
-
-    return status, dst_path, file_info
+    return status
 
   @classmethod
-  def download_steam_workshop(cls, session, dst_dir, workshop_id):
+  def resolve_steam_workshop(cls, session, workshop_id):
+    # file and preview urls of a workshop item, collections are expanded
     db_hostname = 'https://db.steamworkshopdownloader.io'
     db_api_path = 'prod/api/details/file'
     data = bytes(f'[{workshop_id}]', 'utf8')
@@ -320,13 +461,14 @@ class HTTPUtils:
     db_resp = cls.http_request(session, 'POST', url='{}/{}'.format(db_hostname, db_api_path), data=data)
     if db_resp is None:
       logger.warning('cannot retrieve workshop info: {}'.format(workshop_id))
-      return
+      return None
     try:
       workshop_db_res = db_resp.json()
     except requests.exceptions.JSONDecodeError as e:
       logger.error(e)
-      return
+      return None
 
+    urls = list()
     for workshop_ent in workshop_db_res:
     
       result = workshop_ent.get('result')
@@ -336,7 +478,7 @@ class HTTPUtils:
       is_collection = workshop_ent.get('show_subscribe_all', False)
       is_collection = is_collection and not workshop_ent.get('can_subscribe', False)
 
-      logger.info('downloading workshop: {}'.format(file_name))
+      logger.info('resolving workshop: {}'.format(file_name))
 
       if result: 
         if is_collection:
@@ -344,14 +486,24 @@ class HTTPUtils:
           for workshop_child_ent in workshop_ent.get('children'):
             workshop_child_id = workshop_child_ent.get('publishedfileid')
             if not workshop_child_id is None:
-              cls.download_steam_workshop(session, dst_dir, workshop_child_id)
+              child_urls = cls.resolve_steam_workshop(session, workshop_child_id)
+              if not child_urls is None:
+                urls.extend(child_urls)
         else:
-          workshop_resource_urls = [file_url, preview_url]
-          for workshop_resource_url in workshop_resource_urls:
-            if not workshop_resource_url is None:
-              export_dir = dst_dir
-              PathUtils.ensure_dir(export_dir)
-              status, download_file_path, file_info = cls.download_file(session, workshop_resource_url, export_dir)
-              if not status and not download_file_path is None:
-                logger.warning('destroying unfinished addon file')
-                PathUtils.delete_file(download_file_path)
+          urls.extend(i for i in [file_url, preview_url] if not i is None)
+    return urls
+
+  @classmethod
+  def download_steam_workshop(cls, session, dst_dir, workshop_id):
+    # True once every file of the workshop item is downloaded
+    workshop_resource_urls = cls.resolve_steam_workshop(session, workshop_id)
+    if workshop_resource_urls is None:
+      return False
+    ok = True
+    for workshop_resource_url in workshop_resource_urls:
+      export_dir = dst_dir
+      PathUtils.ensure_dir(export_dir)
+      status, _, _ = cls.download_file(session, workshop_resource_url, export_dir)
+      if not status:
+        ok = False
+    return ok
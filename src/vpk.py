@@ -0,0 +1,175 @@
+import re
+import mmap
+import struct
+from collections import namedtuple
+from src.fstree import FileTree
+
+# valve pak v1/v2 directory reader. only the header and the directory tree
+# are touched through mmap, file data is never read.
+class VpkDirectory:
+
+  t_entry = namedtuple('VpkEntry', ['path', 'crc', 'preload_size', 'archive_index', 'offset', 'length'])
+
+  signature = 0x55aa1234
+  s_header_v1 = struct.Struct('<III')
+  s_header_v2 = struct.Struct('<IIIIIII')
+  s_entry = struct.Struct('<IHHIIH')
+  s_preload = struct.Struct('<H')
+  preload_offset = 4
+
+  @classmethod
+  def header_size(cls, mm):
+    signature, version, tree_size = cls.s_header_v1.unpack_from(mm, 0)
+    if signature != cls.signature:
+      raise ValueError('not a vpk file')
+    if version == 1:
+      return cls.s_header_v1.size, tree_size
+    elif version == 2:
+      return cls.s_header_v2.size, tree_size
+    raise ValueError('unsupported vpk version: {}'.format(version))
+
+  @classmethod
+  def walk(cls, mm, with_entries=False, lower=False):
+    # yields internal paths, or (path, entry fields) with with_entries.
+    # the directory tree is copied out once, strings stay bytes until the full
+    # path is joined so every entry costs a single decode.
+    pos, tree_size = cls.header_size(mm)
+    tree = mm[pos:pos + tree_size]
+    find = tree.find
+    unpack_entry = cls.s_entry.unpack_from
+    unpack_preload = cls.s_preload.unpack_from
+    entry_size = cls.s_entry.size
+    preload_offset = cls.preload_offset
+    pos = 0
+    def read_str():
+      nonlocal pos
+      end = find(b'\x00', pos)
+      if end < 0:
+        raise ValueError('truncated vpk directory')
+      v = tree[pos:end]
+      pos = end + 1
+      return v
+    while pos < tree_size:
+      ext = read_str()
+      if not ext:
+        break
+      ext = b'' if ext == b' ' else b'.' + ext
+      while True:
+        directory = read_str()
+        if not directory:
+          break
+        prefix = b'' if directory == b' ' else directory + b'/'
+        while True:
+          end = find(b'\x00', pos)
+          if end < 0:
+            raise ValueError('truncated vpk directory')
+          if end == pos:
+            pos += 1
+            break
+          path = prefix + tree[pos:end] + ext
+          path = (path.lower() if lower else path).decode('utf8', 'replace')
+          pos = end + 1
+          if with_entries:
+            fields = unpack_entry(tree, pos)
+            yield path, fields[:5]
+            preload_size = fields[1]
+          else:
+            yield path
+            preload_size = unpack_preload(tree, pos + preload_offset)[0]
+          pos += entry_size + preload_size
+
+  @classmethod
+  def open(cls, path):
+    fh = open(path, 'rb')
+    try:
+      return fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      fh.close()
+      raise
+
+  @classmethod
+  def list_paths(cls, path, lower=False):
+    fh, mm = cls.open(path)
+    try:
+      return list(cls.walk(mm, lower=lower))
+    finally:
+      mm.close()
+      fh.close()
+
+  @classmethod
+  def list_entries(cls, path):
+    fh, mm = cls.open(path)
+    try:
+      return [cls.t_entry(p, *fields) for p, fields in cls.walk(mm, with_entries=True)]
+    finally:
+      mm.close()
+      fh.close()
+
+
+# internal path -> addons index across a workshop directory. the source engine
+# resolves paths case-insensitively, so keys are lower cased. most paths belong
+# to a single addon, so the index holds the first addon id and only paths seen
+# again get a list in overrides.
+class VpkConflictIndex:
+
+  t_conflict = namedtuple('AddonConflict', ['addons', 'paths'])
+
+  # files every addon ships, they never take part in a conflict
+  ignored = {'addoninfo.txt', 'addonimage.jpg', 'addonimage.vtf'}
+
+  # data chunks of multi-part paks, the directory lives in <name>_dir.vpk
+  r_chunk = re.compile(r'_\d{3}\.vpk$')
+
+  def __init__(self):
+    self.index: dict[str, int] = dict()
+    self.overrides: dict[str, list] = dict()
+    self.addons = list()
+    self.errors = list()
+
+  def add(self, addon_path):
+    try:
+      paths = VpkDirectory.list_paths(addon_path, lower=True)
+    except (OSError, ValueError, struct.error) as e:
+      self.errors.append((addon_path, e))
+      return 0
+    addon_id = len(self.addons)
+    self.addons.append(addon_path)
+    setdefault = self.index.setdefault
+    for path in paths:
+      owner = setdefault(path, addon_id)
+      if owner != addon_id:
+        owners = self.overrides.setdefault(path, [owner])
+        if owners[-1] != addon_id:
+          owners.append(addon_id)
+    return len(paths)
+
+  def add_dir(self, path, workers=1):
+    n = 0
+    for scan_info in FileTree.scan_dir(path, workers=workers):
+      if scan_info.isdir:
+        continue
+      name = scan_info.path.lower()
+      if name.endswith('.vpk') and not self.r_chunk.search(name):
+        self.add(scan_info.path)
+        n += 1
+    return n
+
+  def owners(self, path):
+    path = path.lower()
+    if path in self.overrides:
+      return [self.addons[i] for i in self.overrides[path]]
+    if path in self.index:
+      return [self.addons[self.index[path]]]
+    return []
+
+  def conflicts(self):
+    # grouped by the set of addons overriding the same paths
+    groups = dict()
+    for path, owners in self.overrides.items():
+      if path in self.ignored:
+        continue
+      groups.setdefault(tuple(owners), list()).append(path)
+    return [
+      self.t_conflict(tuple(self.addons[i] for i in k), sorted(v))
+      for k, v in sorted(groups.items(), key=lambda x: -len(x[1]))
+    ]
@@ -0,0 +1,238 @@
+import os
+import sys
+import select
+import struct
+import ctypes
+import ctypes.util
+from bisect import bisect_left
+from threading import Thread, Event, RLock
+from src.fstree import FileTree
+from src.logger import init_logger
+
+logger = init_logger('watcher')
+
+class Inotify:
+
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_DELETE_SELF = 0x400
+  IN_MOVE_SELF = 0x800
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x1000000
+  IN_ISDIR = 0x40000000
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+
+  s_event = struct.Struct('iIII')
+
+  _libc = None
+
+  @classmethod
+  def libc(cls):
+    if cls._libc is None:
+      cls._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return cls._libc
+
+  @classmethod
+  def supported(cls):
+    if not sys.platform.startswith('linux'):
+      return False
+    try:
+      return hasattr(cls.libc(), 'inotify_init1')
+    except OSError:
+      return False
+
+  def __init__(self):
+    self.fd = self.libc().inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+
+  def add_watch(self, path, mask):
+    wd = self.libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    return wd
+
+  def read(self):
+    # (wd, mask, cookie, name) tuples of everything currently queued
+    try:
+      data = os.read(self.fd, 1 << 16)
+    except BlockingIOError:
+      return []
+    events = list()
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = self.s_event.unpack_from(data, offset)
+      offset += self.s_event.size
+      name = os.fsdecode(data[offset:offset + length].rstrip(b'\x00'))
+      offset += length
+      events.append((wd, mask, cookie, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+# FileTree kept current by inotify. events are coalesced per directory and
+# applied after a quiet period by re-listing only the touched directories;
+# on queue overflow the whole tree is rescanned.
+class LiveFileTree(FileTree):
+
+  mask = Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | \
+    Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF | \
+    Inotify.IN_MOVE_SELF | Inotify.IN_ONLYDIR
+
+  def __init__(self, path, workers=1, debounce=0.1):
+    super().__init__(self.ModeEnum.folder, workers)
+    self.path = os.path.normpath(path)
+    self.debounce = debounce
+    self.n_events = 0
+    self.n_overflows = 0
+    self._lock = RLock()
+    self._inotify = None
+    self._wds = dict()
+    self._thread = None
+    self._stop = Event()
+
+  @property
+  def running(self):
+    return not self._thread is None and self._thread.is_alive()
+
+  def start(self):
+    self._inotify = Inotify()
+    with self._lock:
+      self.scan_incremental(self.path)
+      for d in self.index:
+        self._watch(d)
+    self._stop.clear()
+    self._thread = Thread(target=self._run, name='watch {}'.format(self.path), daemon=True)
+    self._thread.start()
+    logger.info('watching {} ({} dirs)'.format(self.path, len(self._wds)))
+
+  def stop(self):
+    self._stop.set()
+    if not self._thread is None:
+      self._thread.join()
+      self._thread = None
+    if not self._inotify is None:
+      self._inotify.close()
+      self._inotify = None
+    self._wds.clear()
+
+  def _watch(self, path):
+    try:
+      self._wds[self._inotify.add_watch(path, self.mask)] = path
+    except OSError as e:
+      logger.warning('cannot watch {}: {}'.format(path, e))
+
+  def _run(self):
+    poller = select.poll()
+    poller.register(self._inotify.fd, select.POLLIN)
+    while not self._stop.is_set():
+      if not poller.poll(500):
+        continue
+      pending = set()
+      overflow = False
+      # keep draining until the queue stays quiet for the debounce period
+      while True:
+        for wd, mask, cookie, name in self._inotify.read():
+          self.n_events += 1
+          if mask & Inotify.IN_Q_OVERFLOW:
+            overflow = True
+            continue
+          if mask & Inotify.IN_IGNORED:
+            self._wds.pop(wd, None)
+            continue
+          path = self._wds.get(wd)
+          if not path is None:
+            pending.add(path)
+        if not poller.poll(int(self.debounce * 1000)):
+          break
+      try:
+        self._apply(pending, overflow)
+      except Exception as e:
+        logger.error('failed to apply file events: {}'.format(e))
+
+  def _drop(self, path):
+    prefix = path + os.sep
+    for d in [i for i in self.index if i == path or i.startswith(prefix)]:
+      del self.index[d]
+
+  def _refresh(self, path):
+    if not os.path.isdir(path):
+      self._drop(path)
+      return
+    old = self.index.get(path)
+    listing, subdirs = self.list_dir(path)
+    if listing is None:
+      return
+    hashes = dict()
+    if not old is None:
+      hashes = {i.path: i for i in old[2] if not i.hash is None}
+    files = list()
+    for f in listing[1]:
+      h = hashes.get(f.path)
+      if not h is None and h.size == f.size and h.mtime == f.mtime:
+        f = f._replace(hash=h.hash)
+      files.append(f)
+    self.index[path] = (os.stat(path).st_mtime_ns, sorted(subdirs), sorted(files, key=lambda x: x.path))
+    for subdir in subdirs:
+      if not subdir in self.index:
+        self._add_subtree(subdir)
+    if not old is None:
+      for subdir in set(old[1]) - set(subdirs):
+        self._drop(subdir)
+
+  def _add_subtree(self, path):
+    for root, listing in self.fanout(path, self.list_dir, self.workers):
+      if listing is None:
+        continue
+      subdirs = [i.path for i in listing[0] if not os.path.islink(i.path)]
+      self.index[root] = (os.stat(root).st_mtime_ns, sorted(subdirs), sorted(listing[1], key=lambda x: x.path))
+      self._watch(root)
+
+  def _apply(self, pending, overflow):
+    with self._lock:
+      if overflow:
+        self.n_overflows += 1
+        logger.warning('event queue overflow, rescanning {}'.format(self.path))
+        self.scan_incremental(self.path, full=True)
+        for d in self.index:
+          self._watch(d)
+        return
+      for path in sorted(pending):
+        self._refresh(path)
+      self.list = self.flatten_index(self.index)
+
+  def hash(self, *args, **kwargs):
+    with self._lock:
+      return super().hash(*args, **kwargs)
+
+  def snapshot(self):
+    with self._lock:
+      return list(self.list)
+
+  def lookup(self, path):
+    path = os.path.normpath(path)
+    with self._lock:
+      if path in self.index:
+        return self.t_scan_info(True, path, 0, self.index[path][0])
+      entry = self.index.get(os.path.dirname(path))
+      if entry is None:
+        return None
+      files = entry[2]
+      i = bisect_left(files, path, key=lambda x: x.path)
+      if i < len(files) and files[i].path == path:
+        return files[i]
+    return None
+
+  def exists(self, path):
+    return not self.lookup(path) is None